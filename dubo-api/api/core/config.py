@@ -7,6 +7,7 @@ from typing import Any, Dict, Optional
 from pydantic import (
     BaseSettings,
     Field,
+    SecretStr,
     root_validator,
 )
 
@@ -32,6 +33,11 @@ class Settings(BaseSettings):
     dd_app_key: str = Field("", env="DD_APP_KEY")
     dd_enabled: bool = str(Field("false", env="DD_ENABLED")).lower() == "true"
 
+    # In-process metrics, exposed on /metrics. If the token is set, scrapes must send
+    # it as a bearer token.
+    metrics_enabled: bool = Field(False, env="METRICS_ENABLED")
+    metrics_token: Optional[SecretStr] = Field(None, env="METRICS_TOKEN")
+
     # Datadog initialization config
     dd_init_kwargs: Dict[str, Any] = {}
     if dd_enabled:
@@ -6,7 +6,7 @@ from datadog import initialize
 from api.handlers.api import router as api_router
 from api.core.config import get_settings
 from api.core.logging import get_logger
-from api.core.stats import attach_stats_middleware, stats
+from api.core.stats import add_metrics_route, attach_stats_middleware, stats
 from api.handlers.census import router as census_router
 from api.handlers.api import router as api_router
 
@@ -16,6 +16,7 @@ logger = get_logger(__name__)
 settings = get_settings()
 initialize(**settings.dd_init_kwargs)
 attach_stats_middleware(app)
+add_metrics_route(app)
 
 app.include_router(api_router, prefix="/v1")
 app.include_router(census_router, prefix="/demos")
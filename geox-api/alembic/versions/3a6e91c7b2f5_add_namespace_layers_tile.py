@@ -0,0 +1,35 @@
+"""Add multi-layer tiles with a layer per namespace
+
+Revision ID: 3a6e91c7b2f5
+Revises: 8f3b52c1d0e4
+Create Date: 2026-10-18 21:14:05.328417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from alembic_utils.pg_function import PGFunction
+from sqlalchemy import text as sql_text
+
+# revision identifiers, used by Alembic.
+revision = '3a6e91c7b2f5'
+down_revision = '8f3b52c1d0e4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    public_generate_namespace_layers_tile = PGFunction(
+        schema="public",
+        signature="generate_namespace_layers_tile(z integer, x integer, y integer, filter_organization_id uuid, namespace_ids uuid[], property_names text[])",
+        definition='returns bytea\n LANGUAGE plpgsql\n STABLE PARALLEL SAFE\nAS $function$\nDECLARE\n    result bytea;\nBEGIN\n    WITH\n    bounds AS (\n      SELECT ST_TileEnvelope(z, x, y) AS geom\n    )\n    , mvtgeom AS (\n      -- Use the precomputed geometry simplified for the zoom level\n      SELECT ST_AsMVTGeom(\n        CASE\n          WHEN z <= 5 THEN sh.geom_3857_z5\n          WHEN z <= 9 THEN sh.geom_3857_z9\n          WHEN z <= 12 THEN sh.geom_3857_z12\n          ELSE sh.geom_3857\n        END\n        , bounds.geom\n      ) AS geom\n      , CASE\n          WHEN property_names IS NULL THEN sh.properties - \'__uuid\'\n          ELSE (\n            SELECT COALESCE(jsonb_object_agg(key, value), \'{}\'::JSONB)\n            FROM jsonb_each(sh.properties)\n            WHERE key = ANY(property_names) AND key <> \'__uuid\'\n          )\n        END AS properties\n      , sh.uuid AS "__uuid"\n      , sh.namespace_id AS "__namespace_id"\n      FROM public.shapes sh, bounds\n      WHERE 1=1\n        AND sh.organization_id = filter_organization_id\n        AND sh.deleted_at IS NULL\n        -- Bounding box test only: ST_AsMVTGeom() clips the geometries and returns\n        -- NULL for those outside of the tile\n        AND sh.geom && ST_Transform(bounds.geom, 4326)\n        -- If the namespace parameter is empty, get all data\n        AND COALESCE(sh.namespace_id = ANY(namespace_ids), TRUE)\n    )\n    , layers AS (\n      SELECT\n        mvtgeom."__namespace_id" AS namespace_id\n        , ST_AsMVT(mvtgeom.*, mvtgeom."__namespace_id"::TEXT) AS layer\n      FROM mvtgeom\n      WHERE mvtgeom.geom IS NOT NULL\n      GROUP BY mvtgeom."__namespace_id"\n    )\n    -- A tile with several layers is the concatenation of the layers\n    SELECT COALESCE(string_agg(layers.layer, \'\'::bytea ORDER BY layers.namespace_id), \'\'::bytea)\n    INTO result\n    FROM layers\n    ;\n\n    RETURN result\n    ;\nEND;\n$function$'
+    )
+    op.create_entity(public_generate_namespace_layers_tile)
+
+
+def downgrade() -> None:
+    public_generate_namespace_layers_tile = PGFunction(
+        schema="public",
+        signature="generate_namespace_layers_tile(z integer, x integer, y integer, filter_organization_id uuid, namespace_ids uuid[], property_names text[])",
+        definition='returns bytea\n LANGUAGE plpgsql\n STABLE PARALLEL SAFE\nAS $function$\nDECLARE\n    result bytea;\nBEGIN\n    WITH\n    bounds AS (\n      SELECT ST_TileEnvelope(z, x, y) AS geom\n    )\n    , mvtgeom AS (\n      -- Use the precomputed geometry simplified for the zoom level\n      SELECT ST_AsMVTGeom(\n        CASE\n          WHEN z <= 5 THEN sh.geom_3857_z5\n          WHEN z <= 9 THEN sh.geom_3857_z9\n          WHEN z <= 12 THEN sh.geom_3857_z12\n          ELSE sh.geom_3857\n        END\n        , bounds.geom\n      ) AS geom\n      , CASE\n          WHEN property_names IS NULL THEN sh.properties - \'__uuid\'\n          ELSE (\n            SELECT COALESCE(jsonb_object_agg(key, value), \'{}\'::JSONB)\n            FROM jsonb_each(sh.properties)\n            WHERE key = ANY(property_names) AND key <> \'__uuid\'\n          )\n        END AS properties\n      , sh.uuid AS "__uuid"\n      , sh.namespace_id AS "__namespace_id"\n      FROM public.shapes sh, bounds\n      WHERE 1=1\n        AND sh.organization_id = filter_organization_id\n        AND sh.deleted_at IS NULL\n        -- Bounding box test only: ST_AsMVTGeom() clips the geometries and returns\n        -- NULL for those outside of the tile\n        AND sh.geom && ST_Transform(bounds.geom, 4326)\n        -- If the namespace parameter is empty, get all data\n        AND COALESCE(sh.namespace_id = ANY(namespace_ids), TRUE)\n    )\n    , layers AS (\n      SELECT\n        mvtgeom."__namespace_id" AS namespace_id\n        , ST_AsMVT(mvtgeom.*, mvtgeom."__namespace_id"::TEXT) AS layer\n      FROM mvtgeom\n      WHERE mvtgeom.geom IS NOT NULL\n      GROUP BY mvtgeom."__namespace_id"\n    )\n    -- A tile with several layers is the concatenation of the layers\n    SELECT COALESCE(string_agg(layers.layer, \'\'::bytea ORDER BY layers.namespace_id), \'\'::bytea)\n    INTO result\n    FROM layers\n    ;\n\n    RETURN result\n    ;\nEND;\n$function$'
+    )
+    op.drop_entity(public_generate_namespace_layers_tile)
@@ -0,0 +1,36 @@
+"""Add the state of incremental shape exports
+
+Revision ID: 5c1f8a3d9e27
+Revises: b7d2e4f19a60
+Create Date: 2026-10-18 23:52:12.481906
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '5c1f8a3d9e27'
+down_revision = 'b7d2e4f19a60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('shape_exports',
+    sa.Column('organization_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('exported_until', sa.DateTime(), nullable=False, comment='High-water mark of the exports. Shapes updated after it are exported by the next delta export.'),
+    sa.Column('snapshot_export_id', sa.String(), nullable=True, comment='ID of the last snapshot export.'),
+    sa.Column('num_deltas', sa.Integer(), server_default='0', nullable=False, comment='Number of delta exports since the last snapshot export.'),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['organization_id'], ['organizations.id'], name=op.f('fk_shape_exports_organization_id'), ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('organization_id', name=op.f('pk_shape_exports')),
+    comment='State of the incremental exports of the shapes of an organization.'
+    )
+    op.create_index('ix_shapes_organization_id_updated_at', 'shapes', ['organization_id', 'updated_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_shapes_organization_id_updated_at', table_name='shapes')
+    op.drop_table('shape_exports')
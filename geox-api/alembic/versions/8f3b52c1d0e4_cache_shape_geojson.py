@@ -0,0 +1,78 @@
+"""Cache the GeoJSON feature of shapes
+
+Revision ID: 8f3b52c1d0e4
+Revises: cd24f478bf77
+Create Date: 2026-10-18 19:02:47.215083
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from alembic_utils.pg_function import PGFunction
+from alembic_utils.pg_trigger import PGTrigger
+from sqlalchemy import text as sql_text
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '8f3b52c1d0e4'
+down_revision = 'cd24f478bf77'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    conn = op.get_bind()
+    op.add_column("shapes", sa.Column("geojson", postgresql.JSONB, nullable=True))
+
+    public_shape_geojson = PGFunction(
+        schema="public",
+        signature="shape_geojson(uuid UUID, geom GEOMETRY, properties JSONB, name TEXT)",
+        definition="RETURNS JSONB\nLANGUAGE SQL\nSTABLE\nAS\n$function$\n    SELECT jsonb_build_object(\n        'type',\n        'Feature',\n        'geometry',\n        ST_AsGeoJSON(geom) :: JSONB,\n        'properties',\n        properties || jsonb_build_object('name', name, '__uuid', uuid :: TEXT),\n        'id',\n        to_jsonb(uuid :: TEXT),\n        'bbox',\n        jsonb_build_array(ST_xmin(geom), ST_ymin(geom), ST_xmax(geom), ST_ymax(geom))\n    )\n$function$",
+    )
+    op.replace_entity(public_shape_geojson)
+
+    public_set_shape_geojson = PGFunction(
+        schema="public",
+        signature="set_shape_geojson()",
+        definition="RETURNS trigger\nLANGUAGE plpgsql\nAS $function$\n    BEGIN\n        -- Cache the GeoJSON feature so that reads do not serialize the geometry\n        NEW.geojson := shape_geojson(NEW.uuid, NEW.geom, NEW.properties, NEW.name);\n        RETURN NEW;\n    END;\n$function$",
+    )
+    op.create_entity(public_set_shape_geojson)
+
+    public_shapes_shapes_geojson_trigger = PGTrigger(
+        schema="public",
+        signature="shapes_geojson_trigger",
+        on_entity="public.shapes",
+        is_constraint=False,
+        definition="BEFORE INSERT OR UPDATE OF uuid, geom, properties, name ON public.shapes\n        FOR EACH ROW\n        EXECUTE FUNCTION set_shape_geojson()",
+    )
+    op.create_entity(public_shapes_shapes_geojson_trigger)
+
+    conn.execute(
+        sql_text("UPDATE shapes SET geojson = shape_geojson(uuid, geom, properties, name)")
+    )
+
+
+def downgrade() -> None:
+    public_shapes_shapes_geojson_trigger = PGTrigger(
+        schema="public",
+        signature="shapes_geojson_trigger",
+        on_entity="public.shapes",
+        is_constraint=False,
+        definition="BEFORE INSERT OR UPDATE OF uuid, geom, properties, name ON public.shapes\n        FOR EACH ROW\n        EXECUTE FUNCTION set_shape_geojson()",
+    )
+    op.drop_entity(public_shapes_shapes_geojson_trigger)
+
+    public_set_shape_geojson = PGFunction(
+        schema="public",
+        signature="set_shape_geojson()",
+        definition="RETURNS trigger\nLANGUAGE plpgsql\nAS $function$\n    BEGIN\n        -- Cache the GeoJSON feature so that reads do not serialize the geometry\n        NEW.geojson := shape_geojson(NEW.uuid, NEW.geom, NEW.properties, NEW.name);\n        RETURN NEW;\n    END;\n$function$",
+    )
+    op.drop_entity(public_set_shape_geojson)
+
+    public_shape_geojson = PGFunction(
+        schema="public",
+        signature="shape_geojson(uuid UUID, geom GEOMETRY, properties JSONB, name TEXT)",
+        definition="RETURNS JSONB\nLANGUAGE SQL\nSTABLE\nAS\n$function$\n    SELECT jsonb_build_object(\n        'geometry',\n        ST_AsGeoJSON(geom),\n        'properties',\n        properties || jsonb_build_object('name', name, '__uuid', uuid :: TEXT),\n        'id',\n        to_jsonb(uuid :: TEXT),\n        'bbox',\n        jsonb_build_array(ST_xmin(geom), ST_ymin(geom), ST_xmax(geom), ST_ymax(geom))\n    )\n$function$",
+    )
+    op.replace_entity(public_shape_geojson)
+
+    op.drop_column("shapes", "geojson")
@@ -0,0 +1,57 @@
+"""Index live shapes by organization and geometry
+
+Revision ID: b7d2e4f19a60
+Revises: 3a6e91c7b2f5
+Create Date: 2026-10-18 22:41:37.906215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from alembic_utils.pg_function import PGFunction
+from sqlalchemy import text as sql_text
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2e4f19a60'
+down_revision = '3a6e91c7b2f5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    conn = op.get_bind()
+    conn.execute(sql_text("CREATE EXTENSION IF NOT EXISTS btree_gist;"))
+    op.create_index(
+        "ix_shapes_organization_id_geom_live",
+        "shapes",
+        ["organization_id", "geom"],
+        postgresql_using="gist",
+        postgresql_where=sa.text("deleted_at IS NULL"),
+    )
+    op.create_index(
+        "ix_shapes_organization_id_centroid",
+        "shapes",
+        ["organization_id", sa.text("ST_Centroid(geom)")],
+    )
+    conn.execute(sql_text("ALTER TABLE shapes CLUSTER ON ix_shapes_organization_id_centroid;"))
+
+    # STABLE so that organization_id = app_user_org() can be an index condition
+    public_app_user_org = PGFunction(
+        schema="public",
+        signature="app_user_org()",
+        definition="RETURNS UUID as\n  $$\n    SELECT nullif(current_setting('app.user_org', TRUE), '') :: UUID;\n  $$ language SQL STABLE"
+    )
+    op.replace_entity(public_app_user_org)
+
+
+def downgrade() -> None:
+    public_app_user_org = PGFunction(
+        schema="public",
+        signature="app_user_org()",
+        definition="RETURNS UUID as\n  $$\n    SELECT nullif(current_setting('app.user_org', TRUE), '') :: UUID;\n  $$ language SQL"
+    )
+    op.replace_entity(public_app_user_org)
+
+    conn = op.get_bind()
+    conn.execute(sql_text("ALTER TABLE shapes SET WITHOUT CLUSTER;"))
+    op.drop_index("ix_shapes_organization_id_centroid", table_name="shapes")
+    op.drop_index("ix_shapes_organization_id_geom_live", table_name="shapes")
@@ -0,0 +1,71 @@
+"""Add web mercator and simplified geometries for tiles
+
+Revision ID: cd24f478bf77
+Revises: 20af224aa468
+Create Date: 2026-10-18 09:12:31.482913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from alembic_utils.pg_function import PGFunction
+from geoalchemy2 import Geometry
+from sqlalchemy import text as sql_text
+
+# revision identifiers, used by Alembic.
+revision = 'cd24f478bf77'
+down_revision = '20af224aa468'
+branch_labels = None
+depends_on = None
+
+# Web Mercator is undefined at the poles, so geometries are clipped to its latitude
+# bounds before they are transformed.
+_GEOM_3857 = (
+    "ST_Transform(ST_ClipByBox2D("
+    "geom, ST_MakeEnvelope(-180, -85.0511287798, 180, 85.0511287798, 4326)"
+    "), 3857)"
+)
+
+# Simplification tolerances are the size of a tile pixel at the highest zoom level
+# that each column is used for. See app/db/metadata/shapes.py
+_GEOM_COLUMNS = {
+    "geom_3857": _GEOM_3857,
+    "geom_3857_z5": f"ST_Simplify({_GEOM_3857}, 305.7, true)",
+    "geom_3857_z9": f"ST_Simplify({_GEOM_3857}, 19.1, true)",
+    "geom_3857_z12": f"ST_Simplify({_GEOM_3857}, 2.39, true)",
+}
+
+
+def upgrade() -> None:
+    # Adding stored generated columns rewrites shapes under an ACCESS EXCLUSIVE
+    # lock, which blocks reads and writes of shapes until it is done, and computes
+    # the four geometries of every row. They take about four times the storage of
+    # geom. Run it during a maintenance window on large databases.
+    for name, expr in _GEOM_COLUMNS.items():
+        op.add_column(
+            "shapes",
+            sa.Column(
+                name,
+                Geometry(srid=3857, spatial_index=False),
+                sa.Computed(expr, persisted=True),  # type: ignore
+                nullable=True,
+            ),
+        )
+
+    public_generate_shape_tile = PGFunction(
+        schema="public",
+        signature="generate_shape_tile(z integer, x integer, y integer, filter_organization_id uuid, namespace_ids uuid[])",
+        definition='returns bytea\n LANGUAGE plpgsql\n STABLE PARALLEL SAFE\nAS $function$\nDECLARE\n    result bytea;\nBEGIN\n    WITH\n    bounds AS (\n      SELECT ST_TileEnvelope(z, x, y) AS geom\n    )\n    , mvtgeom AS (\n      -- Use the precomputed geometry simplified for the zoom level\n      SELECT ST_AsMVTGeom(\n        CASE\n          WHEN z <= 5 THEN sh.geom_3857_z5\n          WHEN z <= 9 THEN sh.geom_3857_z9\n          WHEN z <= 12 THEN sh.geom_3857_z12\n          ELSE sh.geom_3857\n        END\n        , bounds.geom\n      ) AS geom\n      , sh.properties - \'__uuid\' AS properties\n      , sh.uuid AS "__uuid"\n      , sh.namespace_id AS "__namespace_id"\n      FROM public.shapes sh, bounds\n      WHERE 1=1\n        AND sh.organization_id = filter_organization_id\n        AND sh.deleted_at IS NULL\n        -- Bounding box test only: ST_AsMVTGeom() clips the geometries and returns\n        -- NULL for those outside of the tile\n        AND sh.geom && ST_Transform(bounds.geom, 4326)\n\t-- If the namespace parameter is empty, get all data\n\tAND COALESCE(namespace_id = ANY(namespace_ids), TRUE)\n    )\n    SELECT ST_AsMVT(mvtgeom.*)::bytea\n    INTO result\n    FROM mvtgeom\n    WHERE mvtgeom.geom IS NOT NULL\n    ;\n\n    RETURN result\n    ;\nEND;\n$function$'
+    )
+    op.replace_entity(public_generate_shape_tile)
+
+
+def downgrade() -> None:
+    public_generate_shape_tile = PGFunction(
+        schema="public",
+        signature="generate_shape_tile(z integer, x integer, y integer, filter_organization_id uuid, namespace_ids uuid[])",
+        definition='returns bytea\n LANGUAGE plpgsql\n STABLE PARALLEL SAFE\nAS $function$\nDECLARE\n    result bytea;\nBEGIN\n    WITH\n    bounds AS (\n      SELECT ST_TileEnvelope(z, x, y) AS geom\n    )\n    , mvtgeom AS (\n      SELECT ST_AsMVTGeom(ST_Transform(sh.geom, 3857), bounds.geom) AS geom\n      , sh.properties - \'__uuid\' AS properties\n      , sh.uuid AS "__uuid"\n      , sh.namespace_id AS "__namespace_id"\n      FROM public.shapes sh, bounds\n      WHERE 1=1\n        AND sh.organization_id = filter_organization_id\n        AND sh.deleted_at IS NULL\n        AND ST_Intersects(sh.geom, ST_Transform(bounds.geom, 4326))\n\t-- If the namespace parameter is empty, get all data\n\tAND COALESCE(namespace_id = ANY(namespace_ids), TRUE)\n    )\n    SELECT ST_AsMVT(mvtgeom.*)::bytea\n    INTO result\n    FROM mvtgeom\n    ;\n\n    RETURN result\n    ;\nEND;\n$function$'
+    )
+    op.replace_entity(public_generate_shape_tile)
+
+    for name in reversed(list(_GEOM_COLUMNS)):
+        op.drop_column("shapes", name)
@@ -0,0 +1,216 @@
+"""Key-value caches shared by the API.
+
+The app uses a walrus (Redis) cache when one is configured. :class:`MemoryCache`
+implements the same :class:`Cache` protocol in-process and is used wherever Redis
+is not available.
+
+Users and organizations are read on every request, so they are cached in-process in
+front of Redis by :class:`TieredCache`, see :func:`get_user_cache`.
+"""
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Iterable, Optional, Protocol, Tuple
+
+import walrus
+
+from app.core.config import get_settings
+from app.core.logging import get_logger
+from app.core.stats import count_cache_lookup
+
+logger = get_logger(__name__)
+
+
+class Cache(Protocol):
+    """Abstract protocol for what methods a cache needs to contain."""
+
+    def set(self, key: Any, value: Any, timeout: Optional[Any] = None) -> Any:
+        ...
+
+    def get(self, key: Any, default: Optional[Any] = None) -> Any:
+        ...
+
+    def delete(self, key: Any) -> Any:
+        ...
+
+
+class MemoryCache:
+    """Bounded in-process cache with least-recently-used eviction and key timeouts.
+
+    Args:
+        maxsize: Maximum number of keys held. The least recently used key is evicted
+            when a new key is added to a full cache.
+        default_timeout: Default key timeout in seconds. ``None`` or ``0`` means that
+            keys never expire.
+
+    """
+
+    def __init__(self, maxsize: int = 1024, default_timeout: Optional[float] = None):
+        self.maxsize = maxsize
+        self.default_timeout = default_timeout
+        self._data: "OrderedDict[Any, Tuple[Optional[float], Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                return default
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Any, value: Any, timeout: Optional[Any] = None) -> bool:
+        if timeout is None:
+            timeout = self.default_timeout
+        expires_at = time.monotonic() + float(timeout) if timeout else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return True
+
+    def delete(self, key: Any) -> int:
+        with self._lock:
+            return 1 if self._data.pop(key, None) is not None else 0
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+@lru_cache()
+def get_redis() -> Optional[walrus.Database]:
+    """Return the Redis database of the app cache, or ``None`` if it is disabled."""
+    settings = get_settings()
+    opts = settings.cache
+    conn = settings.redis_connection
+    if opts.enabled:
+        try:
+            return walrus.Database(
+                host=conn.host,
+                port=conn.port,
+                db=int(conn.path[1:]) if conn.path else None,
+                password=conn.password,
+            )
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error("Error initializing the cache: %s", exc)
+    return None
+
+
+@lru_cache()
+def get_cache() -> Optional[Cache]:
+    db = get_redis()
+    if db is None:
+        return None
+    cache: walrus.Cache = db.cache(default_timeout=get_settings().cache.timeout)
+    return cache
+
+
+class TieredCache:
+    """In-process cache in front of a shared cache.
+
+    Reads are served from ``local`` when possible, and values read from ``remote``
+    are copied to ``local``. Writes and deletes go to both caches. Errors of
+    ``remote``, e.g. if Redis is down, are logged and ``local`` is used alone.
+
+    Deletes only reach the ``local`` cache of the current process. Other processes
+    see the change once their local copy times out, so ``local`` should have a short
+    timeout.
+
+    Args:
+        local: In-process cache.
+        remote: Shared cache, e.g. from :func:`get_cache`.
+        name: Name of the cache in the metrics of its hits and misses.
+
+    """
+
+    def __init__(
+        self, local: MemoryCache, remote: Optional[Cache] = None, name: str = "tiered"
+    ):
+        self.local = local
+        self.remote = remote
+        self.name = name
+
+    def get(self, key: Any, default: Optional[Any] = None) -> Any:
+        value = self.local.get(key)
+        if value is not None:
+            count_cache_lookup(self.name, "local_hit")
+            return value
+        if self.remote is not None:
+            try:
+                value = self.remote.get(key)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.warning("Cache error: %s", exc)
+            if value is not None:
+                self.local.set(key, value)
+                count_cache_lookup(self.name, "remote_hit")
+                return value
+        count_cache_lookup(self.name, "miss")
+        return default
+
+    def set(self, key: Any, value: Any, timeout: Optional[Any] = None) -> bool:
+        self.local.set(key, value)
+        if self.remote is not None:
+            try:
+                self.remote.set(key, value, timeout)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.warning("Cache error: %s", exc)
+                return False
+        return True
+
+    def delete(self, key: Any) -> int:
+        deleted = self.local.delete(key)
+        if self.remote is not None:
+            try:
+                deleted = max(deleted, self.remote.delete(key) or 0)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.warning("Cache error: %s", exc)
+        return deleted
+
+
+@lru_cache()
+def get_user_cache() -> Optional[Cache]:
+    """Return the cache of users and their organizations.
+
+    It is an in-process cache in front of :func:`get_cache`, or an in-process cache
+    alone if the app cache is unavailable.
+
+    Returns:
+        The cache, or ``None`` if the cache is disabled.
+
+    """
+    opts = get_settings().cache
+    if not opts.enabled:
+        return None
+    local = MemoryCache(maxsize=opts.local_maxsize, default_timeout=opts.local_timeout)
+    return TieredCache(local, get_cache(), name="users")
+
+
+def user_org_key(user_id: int) -> str:
+    """Return the cache key of the active organization of a user."""
+    return f"app:cache:user_org:{user_id}"
+
+
+def invalidate_user_orgs(user_ids: Iterable[int]) -> None:
+    """Remove the cached active organizations of users.
+
+    Call it after changing the organizations that users are members of, which one
+    is active, or the organizations themselves, e.g. their subscriptions.
+    """
+    cache = get_user_cache()
+    if cache is None:
+        return
+    for user_id in set(user_ids):
+        try:
+            cache.delete(user_org_key(user_id))
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Cache error: %s", exc)
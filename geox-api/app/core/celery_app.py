@@ -1,5 +1,6 @@
 """Celery queue."""
 from celery import Celery
+from celery.schedules import crontab
 
 from app.core.config import get_settings
 
@@ -8,3 +9,35 @@ _settings = get_settings()
 celery_app = Celery(
     "worker", broker=_settings.redis_connection, backend=_settings.redis_connection
 )
+
+
+def parse_crontab(expr: str) -> crontab:
+    """Parse a crontab expression ``minute hour day_of_month month day_of_week``.
+
+    Times are in UTC, the default timezone of Celery.
+    """
+    fields = expr.split()
+    if len(fields) != 5:
+        raise ValueError(f"Invalid crontab expression: {expr!r}")
+    minute, hour, day_of_month, month_of_year, day_of_week = fields
+    return crontab(
+        minute=minute,
+        hour=hour,
+        day_of_month=day_of_month,
+        month_of_year=month_of_year,
+        day_of_week=day_of_week,
+    )
+
+
+# Run by `celery --app app.worker beat`
+celery_app.conf.beat_schedule = {}
+if _settings.shapes_cluster_schedule:
+    celery_app.conf.beat_schedule["cluster-shapes"] = {
+        "task": "app.worker.cluster_shapes",
+        "schedule": parse_crontab(_settings.shapes_cluster_schedule),
+    }
+if _settings.tile_cache.seed_schedule:
+    celery_app.conf.beat_schedule["seed-tiles"] = {
+        "task": "app.worker.seed_all_tiles",
+        "schedule": parse_crontab(_settings.tile_cache.seed_schedule),
+    }
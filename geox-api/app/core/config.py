@@ -54,7 +54,9 @@ class EngineOptions(BaseModel):
 
     echo: bool = False
     echo_pool: bool = False
-    pool_timeout: int = Field(30, ge=1)
+    # Short, so that requests waiting for a connection fail with 503 instead of
+    # holding threads of the threadpool, see app.db.pool
+    pool_timeout: int = Field(5, ge=1)
     pool_recycle: int = -1
     # SQLAlchemy default is 5
     pool_size: int = Field(10, ge=1)
@@ -80,7 +82,7 @@ class TilerPoolOptions(BaseModel):
 class CacheOptions(BaseModel):
     """Options for the user/organization cache.
 
-    The cache is defined in app.dependencies.Cache. It caches user and organization
+    The cache is defined in app.core.cache.Cache. It caches user and organization
     info for each request.
     """
 
@@ -88,6 +90,57 @@ class CacheOptions(BaseModel):
         True, description="If true, then use a cache. If false, no cache."
     )
     timeout: int = Field(3600, ge=0, description="Cache key default timeout in seconds.")
+    local_maxsize: int = Field(
+        1024, ge=1, description="Maximum number of keys held in-process."
+    )
+    local_timeout: int = Field(
+        30,
+        ge=0,
+        description="Timeout of keys held in-process in seconds. Changes made by other "
+        "processes can take this long to be seen. 0 means no timeout.",
+    )
+
+
+class TileCacheOptions(BaseModel):
+    """Options for the MVT tile cache.
+
+    The tile cache is defined in app.tiler.cache.TileCache. It stores rendered
+    ``/backsplash`` tiles in the app cache until a shape write touches the tile.
+    Tiles are not cached if the app cache is unavailable, since in-process caches
+    would miss the invalidations made by other processes.
+    """
+
+    enabled: bool = Field(True, description="If true, then cache rendered tiles.")
+    timeout: int = Field(
+        3600, ge=0, description="Timeout of cached tiles in seconds. 0 means no timeout."
+    )
+    max_tiles_per_organization: int = Field(
+        10000,
+        ge=1,
+        description="Maximum number of tiles cached per organization. "
+        "The oldest tiles are evicted first.",
+    )
+    seed_after_import: bool = Field(
+        True, description="If true, then pre-render tiles after shapes are imported."
+    )
+    seed_schedule: Optional[str] = Field(
+        None,
+        description="Crontab expression (minute hour day_of_month month day_of_week, in "
+        "UTC) of the pre-rendering of the tiles of all organizations by Celery beat, "
+        "e.g. '30 3 * * *'. Disabled by default.",
+    )
+    seed_min_zoom: int = Field(
+        0, ge=0, le=22, description="Lowest zoom level of pre-rendered tiles."
+    )
+    seed_max_zoom: int = Field(
+        14, ge=0, le=22, description="Highest zoom level of pre-rendered tiles."
+    )
+    seed_max_tiles: int = Field(
+        1000,
+        ge=0,
+        description="Maximum number of tiles pre-rendered at once. Tiles of the lowest "
+        "zoom levels are rendered first.",
+    )
 
 
 class Settings(BaseSettings):
@@ -107,6 +160,21 @@ class Settings(BaseSettings):
     auth_audience: str = Field(..., env="AUTH0_API_AUDIENCE")
     # TODO: AUTH0_ALGORITHMS should be an enum/literal set
     auth_algorithms: str = Field("RS256", env="AUTH0_ALGORITHMS")
+    auth_jwks_lifespan: int = Field(
+        3600,
+        ge=0,
+        description="Seconds after which the cached JWKS signing keys are refreshed in "
+        "the background.",
+    )
+    auth_token_cache_timeout: int = Field(
+        60,
+        ge=0,
+        description="Maximum seconds that verified tokens are cached. Tokens are never "
+        "cached past their expiration. 0 disables the cache.",
+    )
+    auth_token_cache_maxsize: int = Field(
+        4096, ge=1, description="Maximum number of verified tokens cached."
+    )
 
     # Bucket to use for data exports
     aws_s3_url: Optional[S3Url] = Field(
@@ -136,6 +204,11 @@ class Settings(BaseSettings):
     dd_app_key: str = Field("", env="DD_APP_KEY")
     dd_enabled: bool = str(Field("false", env="DD_ENABLED")).lower() == "true"
 
+    # In-process metrics, exposed on /metrics. If the token is set, scrapes must send
+    # it as a bearer token.
+    metrics_enabled: bool = Field(False, env="METRICS_ENABLED")
+    metrics_token: Optional[SecretStr] = Field(None, env="METRICS_TOKEN")
+
     # Datadog initialization config
     dd_init_kwargs: Dict[str, Any] = {}
     if dd_enabled:
@@ -236,6 +309,65 @@ class Settings(BaseSettings):
         description="Options to apply to the connections used by Celery workers to access the app database.",
     )
 
+    bulk_import_chunk_size: int = Field(
+        10000,
+        ge=1,
+        description="Number of shapes inserted per transaction by bulk import tasks.",
+    )
+
+    export_batch_size: int = Field(
+        50_000,
+        ge=1,
+        description="Number of shapes per row group of the Parquet files of exports.",
+    )
+
+    export_max_file_size: int = Field(
+        128 * 2**20,
+        ge=1,
+        description="Size in bytes after which the Parquet files of exports are split. "
+        "Files are larger by at most a row group.",
+    )
+
+    export_snapshot_every: int = Field(
+        24,
+        ge=0,
+        description="Number of delta exports of shapes between snapshot exports. "
+        "0 makes every export a snapshot.",
+    )
+
+    export_overlap: int = Field(
+        300,
+        ge=0,
+        description="Seconds re-exported by consecutive delta exports, so that shapes "
+        "written by transactions committed after an export started are not missed.",
+    )
+
+    batch_query_max_size: int = Field(
+        1_000_000,
+        ge=1,
+        description="Maximum number of points or geometries in a batch spatial query.",
+    )
+    batch_query_max_bytes: int = Field(
+        256 * 2**20,
+        ge=1,
+        description="Maximum size in bytes of the body of a batch spatial query. Larger "
+        "bodies are rejected before they are read entirely.",
+    )
+
+    shapes_cluster_schedule: Optional[str] = Field(
+        None,
+        description="Crontab expression (minute hour day_of_month month day_of_week, in "
+        "UTC) of the reorderings of the shapes table (CLUSTER) scheduled by Celery beat, "
+        "e.g. '0 4 * * sun'. CLUSTER blocks all reads and writes of shapes while it runs, "
+        "so schedule it off-peak. Disabled by default.",
+    )
+    shapes_cluster_lock_timeout: int = Field(
+        10,
+        ge=0,
+        description="Seconds CLUSTER waits for its lock on shapes before giving up. "
+        "Queries of shapes are blocked while it waits. 0 means no timeout.",
+    )
+
     # pylint: disable=no-self-argument
     # validation is done in the order fields are defined. sqlalchemy_database_uri
     # needs to be defined after its subcomponents
@@ -268,6 +400,12 @@ class Settings(BaseSettings):
         description="Options for the tiling server connection pool.",
     )
 
+    pgbouncer: bool = Field(
+        False,
+        description="If true, the app database is reached through PgBouncer in "
+        "transaction pooling mode. Connection pools do not rely on session state.",
+    )
+
     redis_connection: RedisDsn = Field(
         cast(RedisDsn, "redis://localhost:6379/0"),
         description="Redis connection info that can be used for celery and the cache.",
@@ -279,6 +417,12 @@ class Settings(BaseSettings):
         env="APP_CACHE",
     )
 
+    tile_cache: TileCacheOptions = Field(
+        TileCacheOptions(),  # type: ignore
+        description="Tile cache options.",
+        env="APP_TILE_CACHE",
+    )
+
     git_commit: Optional[GitCommitHash] = Field(
         None, description="Git commit of the app source code being used."
     )  # type: ignore
@@ -74,6 +74,17 @@ class MapProjection(int, Enum):
     WEB_MERCATOR = 3857
 
 
+class ShapeFormat(str, Enum):
+    """Response formats for lists of shapes."""
+
+    json = "json"
+    """JSON array of shapes."""
+    ndjson = "ndjson"
+    """Newline delimited GeoJSON features, streamed."""
+    geojson_stream = "geojson-stream"
+    """GeoJSON feature collection, streamed."""
+
+
 if TYPE_CHECKING:
     Latitude = float
     Longitude = float
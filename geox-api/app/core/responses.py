@@ -0,0 +1,19 @@
+"""Responses serialized without pydantic."""
+from typing import Iterable
+
+from fastapi.responses import JSONResponse
+
+
+class JSONArrayResponse(JSONResponse):
+    """JSON array response whose items are already serialized.
+
+    Used for the trusted rows of read routes, which the database serializes as JSON.
+    This skips parsing the rows into pydantic models and validating the response model,
+    which dominate the time of responses with many items.
+
+    Routes using it should still declare their ``response_model``, for the OpenAPI
+    schema.
+    """
+
+    def render(self, content: Iterable[str]) -> bytes:
+        return f"[{','.join(content)}]".encode("utf-8")
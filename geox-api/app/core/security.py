@@ -1,13 +1,110 @@
+import hashlib
+import threading
+import time
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Type, Union
 
 import jwt
 from fastapi.security import HTTPBearer
 
+from app.core.cache import MemoryCache
 from app.core.config import Settings
+from app.core.logging import get_logger
+
+logger = get_logger(__name__)
 
 token_auth_scheme = HTTPBearer()
 
 
+class CachedJWKClient(jwt.PyJWKClient):
+    """JWKS client that caches the signing keys.
+
+    Keys older than ``lifespan`` are still used while they are refreshed in a
+    background thread. A token signed with an unknown key refreshes the keys
+    immediately, since the keys may have been rotated, but at most once every
+    ``min_refresh_interval`` seconds so that invalid tokens cannot flood the JWKS
+    endpoint.
+
+    Args:
+        uri: URL of the JWKS.
+        lifespan: Seconds after which the keys are refreshed.
+        min_refresh_interval: Minimum seconds between refreshes for unknown keys.
+
+    """
+
+    def __init__(
+        self, uri: str, lifespan: float = 3600, min_refresh_interval: float = 60
+    ) -> None:
+        super().__init__(uri, cache_keys=False)
+        self.lifespan = lifespan
+        self.min_refresh_interval = min_refresh_interval
+        self._keys: List[jwt.PyJWK] = []
+        self._fetched_at: Optional[float] = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _age(self) -> float:
+        if self._fetched_at is None:
+            return float("inf")
+        return time.monotonic() - self._fetched_at
+
+    def refresh(self) -> List[jwt.PyJWK]:
+        """Fetch the signing keys."""
+        keys = super().get_signing_keys()
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+        return keys
+
+    def _refresh_in_background(self) -> None:
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run() -> None:
+            try:
+                self.refresh()
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.warning("Error refreshing JWKS: %s", exc)
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def get_signing_keys(self) -> List[jwt.PyJWK]:
+        if self._fetched_at is None:
+            return self.refresh()
+        if self._age() > self.lifespan:
+            self._refresh_in_background()
+        return self._keys
+
+    def get_signing_key(self, kid: str) -> jwt.PyJWK:
+        keys = self.get_signing_keys()
+        if kid not in {key.key_id for key in keys} and (
+            self._age() >= self.min_refresh_interval
+        ):
+            # The keys may have been rotated
+            keys = self.refresh()
+        for key in keys:
+            if key.key_id == kid:
+                return key
+        raise jwt.PyJWKClientError(f'Unable to find a signing key that matches: "{kid}"')
+
+
+@lru_cache(None)
+def get_jwks_client(domain: str, lifespan: float) -> CachedJWKClient:
+    """Return the JWKS client of an Auth0 domain, shared by all requests."""
+    return CachedJWKClient(f"https://{domain}/.well-known/jwks.json", lifespan=lifespan)
+
+
+@lru_cache(None)
+def get_verified_token_cache(maxsize: int) -> MemoryCache:
+    """Return the cache of verified token payloads, keyed by token hash."""
+    return MemoryCache(maxsize=maxsize)
+
+
 class VerifyToken:
     """Verify Auth0 token.
 
@@ -32,12 +129,52 @@ class VerifyToken:
 
         # This gets the JWKS from a given URL and does processing so you can use any of
         # the keys available
-        jwks_url = f"https://{self.domain}/.well-known/jwks.json"
-        self.jwks_client = jwt.PyJWKClient(jwks_url)
+        self.jwks_client = get_jwks_client(self.domain, settings.auth_jwks_lifespan)
         self.signing_key: Any = None
+        self.token_cache_timeout = settings.auth_token_cache_timeout
+        self.token_cache = (
+            get_verified_token_cache(settings.auth_token_cache_maxsize)
+            if self.token_cache_timeout
+            else None
+        )
 
     def verify(self) -> Dict[str, Any]:
-        """Verify the JWT."""
+        """Verify the JWT.
+
+        Verified payloads are cached for ``auth_token_cache_timeout`` seconds, or
+        until the token expires if it is sooner.
+        """
+        payload = self._decode()
+        if payload.get("status") == "error":
+            return payload
+
+        if self.scopes:
+            result = self._check_claims(payload, "scope", str, self.scopes.split(" "))
+            if result.get("error"):
+                return result
+
+        if self.permissions:
+            result = self._check_claims(payload, "permissions", list, self.permissions)
+            if result.get("error"):
+                return result
+
+        return payload
+
+    def _decode(self) -> Dict[str, Any]:
+        key = hashlib.sha256(self.token.encode()).hexdigest()
+        if self.token_cache is not None:
+            payload = self.token_cache.get(key)
+            if payload is not None:
+                return dict(payload)
+        payload = self._decode_uncached()
+        exp = payload.get("exp")
+        if self.token_cache is not None and isinstance(exp, (int, float)):
+            timeout = min(self.token_cache_timeout, exp - time.time())
+            if timeout > 0:
+                self.token_cache.set(key, dict(payload), timeout)
+        return payload
+
+    def _decode_uncached(self) -> Dict[str, Any]:
         # This gets the 'kid' from the passed token
         try:
             self.signing_key = self.jwks_client.get_signing_key_from_jwt(self.token).key
@@ -55,17 +192,6 @@ class VerifyToken:
             )
         except Exception as e:  # pylint: disable=broad-except
             return {"status": "error", "msg": str(e)}
-
-        if self.scopes:
-            result = self._check_claims(payload, "scope", str, self.scopes.split(" "))
-            if result.get("error"):
-                return result
-
-        if self.permissions:
-            result = self._check_claims(payload, "permissions", list, self.permissions)
-            if result.get("error"):
-                return result
-
         return payload
 
     def _check_claims(
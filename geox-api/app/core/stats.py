@@ -1,13 +1,37 @@
+"""App metrics.
+
+Metrics are sent to every backend of :data:`stats`:
+
+- DataDog, with ``ThreadStats``.
+- An in-process :class:`MetricsRegistry` of ``prometheus_client`` metrics, exposed on
+  ``/metrics`` by :func:`add_metrics_route`, if ``METRICS_ENABLED`` is true. This
+  needs no agent or external service. If ``METRICS_TOKEN`` is set, scrapes must send
+  it as a bearer token.
+
+The registry only holds the metrics of the current process. When the app runs with
+several workers, each scrape of ``/metrics`` reaches one of them, and series are
+distinguished by their ``worker`` label.
+"""
 import logging
 import random
+import re
+import secrets
+import threading
 import time
-
 from contextlib import contextmanager
 from string import ascii_letters, digits
-from typing import Any, Callable
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
 from datadog.threadstats import ThreadStats
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response, status
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
 
 from app.core.config import get_settings
 from app.core.logging import get_logger
@@ -19,15 +43,190 @@ worker_id = "".join(
     [random.choice(ascii_letters + digits) for _ in range(settings.worker_id_length)]
 )
 
-stats = ThreadStats(
-    namespace=f"{settings.app_env}.{settings.app_name}",
-    constant_tags=[
-        f"app:{settings.app_name}",
-        f"version:{settings.version}",
-        f"env:{settings.app_env}",
-        f"worker:{worker_id}",
-    ],
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
 )
+"""Upper bounds of the buckets of histograms, in seconds for durations."""
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+
+
+def _label_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _labels(tags: Optional[Sequence[str]]) -> Dict[str, str]:
+    """Convert DataDog tags, ``key:value`` or ``value``, to Prometheus labels."""
+    labels: Dict[str, str] = {}
+    for tag in tags or ():
+        key, sep, value = tag.partition(":")
+        if sep:
+            labels[_label_name(key)] = value
+        else:
+            labels["tag"] = key
+    return labels
+
+
+class MetricsRegistry:
+    """In-process registry of ``prometheus_client`` counters, gauges and histograms.
+
+    It has the methods of ``ThreadStats`` used by the app, so that it can be one of
+    the backends of :class:`Stats`. A metric is created on its first use, with the
+    labels of its tags. The labels of a metric are fixed then: labels missing from
+    later tags are empty, and new labels are dropped.
+
+    Args:
+        namespace: Prefix of metric names.
+        constant_tags: Tags of all metrics.
+        buckets: Upper bounds of the buckets of histograms.
+
+    """
+
+    def __init__(
+        self,
+        namespace: str = "",
+        constant_tags: Optional[Sequence[str]] = None,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.namespace = namespace
+        self.constant_tags = list(constant_tags or [])
+        self.buckets = sorted(buckets)
+        self.registry = CollectorRegistry(auto_describe=True)
+        self._metrics: Dict[str, Tuple[Any, List[str]]] = {}
+        self._lock = threading.Lock()
+
+    def _series(
+        self, cls: Any, metric: str, tags: Optional[Sequence[str]], **kwargs: Any
+    ) -> Any:
+        """Return the series of a metric with the labels of its tags."""
+        name = f"{self.namespace}.{metric}" if self.namespace else metric
+        name = _metric_name(name)
+        labels = _labels([*self.constant_tags, *(tags or [])])
+        with self._lock:
+            if name not in self._metrics:
+                labelnames = sorted(labels)
+                collector = cls(
+                    name, name, labelnames=labelnames, registry=self.registry, **kwargs
+                )
+                self._metrics[name] = (collector, labelnames)
+            collector, labelnames = self._metrics[name]
+        if not labelnames:
+            return collector
+        return collector.labels(*(labels.get(x, "") for x in labelnames))
+
+    def start(self) -> None:
+        """Do nothing, the registry is read when scraped."""
+
+    def increment(
+        self,
+        metric: str,
+        value: float = 1,
+        tags: Optional[Sequence[str]] = None,
+        **_: Any,
+    ) -> None:
+        """Increment a counter."""
+        self._series(Counter, metric, tags).inc(value)
+
+    def gauge(
+        self, metric: str, value: float, tags: Optional[Sequence[str]] = None, **_: Any
+    ) -> None:
+        """Set a gauge."""
+        self._series(Gauge, metric, tags).set(value)
+
+    def histogram(
+        self, metric: str, value: float, tags: Optional[Sequence[str]] = None, **_: Any
+    ) -> None:
+        """Add a value to a histogram."""
+        self._series(Histogram, metric, tags, buckets=self.buckets).observe(value)
+
+    timing = histogram
+
+    def render(self) -> bytes:
+        """Return the metrics in the Prometheus text format."""
+        return generate_latest(self.registry)
+
+
+class Stats:
+    """Send metrics to several backends with the interface of ``ThreadStats``.
+
+    Args:
+        backends: Objects with the methods ``start``, ``increment``, ``gauge``,
+            ``histogram`` and ``timing`` of ``ThreadStats``.
+
+    """
+
+    def __init__(self, *backends: Any) -> None:
+        self.backends = list(backends)
+
+    def start(self) -> None:
+        for backend in self.backends:
+            backend.start()
+
+    def increment(
+        self, metric: str, value: float = 1, tags: Optional[Sequence[str]] = None
+    ) -> None:
+        for backend in self.backends:
+            backend.increment(metric, value, tags=tags)
+
+    def gauge(
+        self, metric: str, value: float, tags: Optional[Sequence[str]] = None
+    ) -> None:
+        for backend in self.backends:
+            backend.gauge(metric, value, tags=tags)
+
+    def histogram(
+        self, metric: str, value: float, tags: Optional[Sequence[str]] = None
+    ) -> None:
+        for backend in self.backends:
+            backend.histogram(metric, value, tags=tags)
+
+    def timing(
+        self, metric: str, value: float, tags: Optional[Sequence[str]] = None
+    ) -> None:
+        for backend in self.backends:
+            backend.timing(metric, value, tags=tags)
+
+    @contextmanager
+    def timer(self, metric: str, tags: Optional[Sequence[str]] = None):
+        """Time a block of code in seconds."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(metric, time.perf_counter() - start_time, tags=tags)
+
+
+constant_tags = [
+    f"app:{settings.app_name}",
+    f"version:{settings.version}",
+    f"env:{settings.app_env}",
+    f"worker:{worker_id}",
+]
+
+thread_stats = ThreadStats(
+    namespace=f"{settings.app_env}.{settings.app_name}", constant_tags=constant_tags
+)
+
+registry: Optional[MetricsRegistry] = None
+if settings.metrics_enabled:
+    registry = MetricsRegistry(namespace=settings.app_name, constant_tags=constant_tags)
+
+stats = Stats(thread_stats, *([registry] if registry is not None else []))
 
 
 def attach_stats_middleware(app: FastAPI):
@@ -59,9 +258,31 @@ def attach_stats_middleware(app: FastAPI):
         return response
 
 
+def add_metrics_route(app: FastAPI) -> None:
+    """Add the ``/metrics`` endpoint, if the in-process registry is enabled."""
+    if registry is None:
+        return
+    metrics_registry: MetricsRegistry = registry
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics(request: Request) -> Response:
+        if settings.metrics_token is not None:
+            token = settings.metrics_token.get_secret_value()
+            if not secrets.compare_digest(
+                request.headers.get("Authorization", ""), f"Bearer {token}"
+            ):
+                return Response(status_code=status.HTTP_401_UNAUTHORIZED)
+        return Response(metrics_registry.render(), media_type=CONTENT_TYPE_LATEST)
+
+
 @contextmanager
 def time_db_query(query_name: str):
     tags = [f"query_name:{query_name}"]
     stats.increment(f"db.num_queries", tags=tags)
     with stats.timer("db.query_execution_duration_s", tags=tags):
         yield
+
+
+def count_cache_lookup(cache: str, result: str) -> None:
+    """Count a lookup of a cache, e.g. ``hit`` or ``miss``."""
+    stats.increment("cache.num_lookups", tags=[f"cache:{cache}", f"result:{result}"])
@@ -0,0 +1,155 @@
+"""Edit versions of organizations and namespaces.
+
+Every write to shapes or namespaces bumps the version of its organization and of the
+namespaces it touched. Read routes use the versions as ETags, so that conditional
+requests (``If-None-Match``) for unchanged data return ``304 Not Modified`` without
+querying the database.
+
+Versions are kept in the app cache so that they are shared by all workers. If the
+app cache is disabled or unavailable, no ETags are issued.
+"""
+import hashlib
+import time
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from fastapi import Request, Response, status
+from pydantic import UUID4  # pylint: disable=no-name-in-module
+
+from app.core.cache import Cache, get_cache
+from app.core.config import get_settings
+from app.core.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class EditVersions:
+    """Monotonically increasing edit versions stored in a cache.
+
+    A missing version (never bumped, or evicted from the cache) is initialized from
+    the clock, so that it never repeats a version issued before.
+    """
+
+    def __init__(self, cache: Cache) -> None:
+        self.cache = cache
+
+    @staticmethod
+    def _organization_key(organization_id: UUID4) -> str:
+        return f"app:cache:version:organization:{organization_id}"
+
+    @staticmethod
+    def _namespace_key(namespace_id: UUID4) -> str:
+        return f"app:cache:version:namespace:{namespace_id}"
+
+    def _get(self, key: str) -> int:
+        version = self.cache.get(key)
+        if not isinstance(version, int):
+            version = time.time_ns()
+            # versions do not expire
+            self.cache.set(key, version, 0)
+        return version
+
+    def _bump(self, key: str) -> None:
+        version = self.cache.get(key)
+        new_version = time.time_ns()
+        if isinstance(version, int) and version >= new_version:
+            new_version = version + 1
+        self.cache.set(key, new_version, 0)
+
+    def get(
+        self,
+        organization_id: UUID4,
+        namespace_ids: Optional[Sequence[UUID4]] = None,
+    ) -> Optional[str]:
+        """Return the version of an organization or of some of its namespaces.
+
+        Returns:
+            The version as a string, or ``None`` if the cache is unavailable.
+
+        """
+        try:
+            if namespace_ids:
+                keys = [
+                    self._namespace_key(x) for x in sorted(set(namespace_ids), key=str)
+                ]
+            else:
+                keys = [self._organization_key(organization_id)]
+            return "-".join(str(self._get(key)) for key in keys)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Version cache error: %s", exc)
+            return None
+
+    def bump(
+        self, organization_id: UUID4, namespace_ids: Iterable[Optional[UUID4]] = ()
+    ) -> None:
+        """Bump the version of an organization and of the namespaces modified."""
+        try:
+            for namespace_id in {x for x in namespace_ids if x is not None}:
+                self._bump(self._namespace_key(namespace_id))
+            self._bump(self._organization_key(organization_id))
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Version cache error: %s", exc)
+
+
+@lru_cache()
+def get_edit_versions() -> Optional[EditVersions]:
+    """Return the edit versions, or ``None`` if the app cache is disabled."""
+    cache = get_cache()
+    if cache is None:
+        return None
+    return EditVersions(cache)
+
+
+def get_etag(
+    organization_id: UUID4,
+    namespace_ids: Optional[Sequence[UUID4]] = None,
+    *parts: object,
+) -> Optional[str]:
+    """Return an ETag for data of an organization, or some of its namespaces.
+
+    Args:
+        organization_id: Organization of the data.
+        namespace_ids: If given, only the versions of these namespaces are used.
+        parts: Other values that the response depends on, e.g. the user.
+
+    Returns:
+        The ETag, or ``None`` if the edit versions are unavailable.
+
+    """
+    versions = get_edit_versions()
+    version = versions.get(organization_id, namespace_ids) if versions else None
+    if version is None:
+        return None
+    return make_etag(organization_id, version, *parts)
+
+
+def make_etag(*parts: object) -> str:
+    """Return a strong ETag for the parts and the app version."""
+    value = ":".join([get_settings().version, *(str(x) for x in parts)])
+    return f'"{hashlib.sha1(value.encode()).hexdigest()}"'
+
+
+def etag_matches(request: Request, etag: Optional[str]) -> bool:
+    """Check whether ``etag`` matches the ``If-None-Match`` header of a request."""
+    if etag is None:
+        return False
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison function
+    tags: List[str] = [x.strip().removeprefix("W/") for x in header.split(",")]
+    return etag in tags
+
+
+def not_modified(etag: str, headers: Optional[Dict[str, str]] = None) -> Response:
+    """Return a ``304 Not Modified`` response.
+
+    ``headers`` are other headers of the response, e.g. ``Vary``, which must be the
+    same as in the ``200`` response.
+    """
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED,
+        headers={**(headers or {}), "ETag": etag},
+    )
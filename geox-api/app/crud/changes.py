@@ -0,0 +1,62 @@
+"""Propagate writes to shapes and namespaces to caches.
+
+Writes bump the edit versions used as ETags and evict the cached tiles they touch.
+Both happen after the write's transaction commits.
+"""
+from functools import partial
+from typing import Iterable, Optional
+
+from pydantic import UUID4  # pylint: disable=no-name-in-module
+from sqlalchemy.engine import Connection
+
+from app.core.versions import get_edit_versions
+from app.db.hooks import after_commit
+from app.tiler.cache import BBox, invalidate_tiles
+
+
+def _propagate_changes(
+    organization_id: UUID4,
+    namespace_ids: Iterable[Optional[UUID4]],
+    bbox: Optional[BBox],
+    evict_all_tiles: bool,
+) -> None:
+    # Bump the versions before evicting tiles: tiles rendered concurrently with the
+    # write are only cached if the version did not change while they were rendered.
+    versions = get_edit_versions()
+    if versions is not None:
+        versions.bump(organization_id, namespace_ids)
+    if evict_all_tiles:
+        invalidate_tiles(organization_id)
+    elif bbox is not None:
+        invalidate_tiles(organization_id, bbox)
+
+
+def record_changes(
+    conn: Connection,
+    organization_id: UUID4,
+    *,
+    namespace_ids: Iterable[Optional[UUID4]] = (),
+    bbox: Optional[BBox] = None,
+    evict_all_tiles: bool = False,
+) -> None:
+    """Record a write to the shapes or namespaces of an organization.
+
+    Args:
+        conn: Connection used for the write.
+        organization_id: Organization modified.
+        namespace_ids: Namespaces modified.
+        bbox: Bounding box of the geometries modified. Cached tiles intersecting it
+            are evicted.
+        evict_all_tiles: If true, evict all of the organization's cached tiles.
+
+    """
+    after_commit(
+        conn,
+        partial(
+            _propagate_changes,
+            organization_id,
+            list(namespace_ids),
+            bbox,
+            evict_all_tiles,
+        ),
+    )
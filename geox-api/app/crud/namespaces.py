@@ -29,6 +29,7 @@ from sqlalchemy.exc import IntegrityError
 
 from app.core.logging import get_logger
 from app.core.stats import time_db_query
+from app.crud.changes import record_changes
 from app.db.metadata import namespaces as namespaces_tbl
 from app.db.metadata import shapes as shapes_tbl
 from app.schemas import Namespace
@@ -237,7 +238,9 @@ def create_namespace(
             cast(Namespace, existing_namespace).slug,
             cast(Namespace, existing_namespace).id,
         ) from None
-    return Namespace.from_orm(res)
+    namespace = Namespace.from_orm(res)
+    record_changes(conn, res.organization_id, namespace_ids=[namespace.id])
+    return namespace
 
 def delete_none(_dict):
     """Delete None values recursively from all of the dictionaries"""
@@ -300,7 +303,9 @@ def update_namespace(
     # If None is returned - then no row was updated - meaning
     # that the namespace doesn't exist. However, we checked for existence
     # with get_namespace()
-    return Namespace.from_orm(res)
+    namespace = Namespace.from_orm(res)
+    record_changes(conn, res.organization_id, namespace_ids=[namespace.id])
+    return namespace
 
 
 def delete_namespace(conn: Connection, id_: UUID4) -> List[UUID4]:
@@ -319,7 +324,7 @@ def delete_namespace(conn: Connection, id_: UUID4) -> List[UUID4]:
         .where(
             namespaces_tbl.c.deleted_at.is_(None)
         )  # cannot delete a namespace that already was deleted
-        .returning(namespaces_tbl.c.id)
+        .returning(namespaces_tbl.c.id, namespaces_tbl.c.organization_id)
     )
     with time_db_query("delete_namespace"):
         res = conn.execute(del_namespace_stmt, params).first()
@@ -337,4 +342,10 @@ def delete_namespace(conn: Connection, id_: UUID4) -> List[UUID4]:
     with time_db_query("delete_namespace_shapes"):
         rows = conn.execute(del_shapes_stmt, params).fetchall()
     shapes_deleted = [row.uuid for row in rows]
+    record_changes(
+        conn,
+        res.organization_id,
+        namespace_ids=[id_],
+        evict_all_tiles=bool(shapes_deleted),
+    )
     return shapes_deleted
@@ -5,7 +5,9 @@ from pydantic import UUID4  # pylint: disable=no-name-in-module
 from sqlalchemy import insert, select, text
 from sqlalchemy.engine import Connection
 
+from app.core.cache import invalidate_user_orgs
 from app.core.stats import time_db_query
+from app.db.hooks import after_commit
 from app.db.metadata import organization_members as org_mbr_tbl
 from app.db.metadata import organizations as org_tbl
 from app.schemas import Organization, User
@@ -97,6 +99,7 @@ def add_user_to_org(conn: Connection, *, user_id: int, organization_id: UUID4) -
         res = conn.execute(
             stmt, {"organization_id": organization_id, "user_id": user_id}
         ).first()
+    after_commit(conn, lambda: invalidate_user_orgs([user_id]))
     return res.id
 
 
@@ -156,6 +159,7 @@ def set_active_organization(
     )
     with time_db_query("set_active_organization"):
         conn.execute(stmt, {"user_id": user_id, "organization_id": organization_id})
+    after_commit(conn, lambda: invalidate_user_orgs([user_id]))
 
 
 def get_active_org_id(conn: Connection, user_id: int) -> UUID4:
@@ -336,6 +340,7 @@ def create_org_member(
             stmt,
             {"organization_id": organization_id, "user_id": user_id, "active": active},
         )
+    after_commit(conn, lambda: invalidate_user_orgs([user_id]))
 
     return True
 
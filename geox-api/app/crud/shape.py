@@ -1,11 +1,15 @@
 """CRUD functions for interacting with shapes."""
+import base64
 import datetime
+import itertools
 import logging
 from enum import Enum
+from functools import lru_cache
 from typing import (
     Any,
     Dict,
     Generator,
+    Iterator,
     List,
     Optional,
     Sequence,
@@ -14,6 +18,7 @@ from typing import (
     Union,
     cast,
 )
+from uuid import UUID
 
 import jinja2
 import sqlalchemy as sa
@@ -24,14 +29,17 @@ from pydantic import Field, NonNegativeInt
 from sqlalchemy import String, and_, func, insert, or_, select, update
 from sqlalchemy.engine import Connection
 from sqlalchemy.sql import ColumnElement, Select, bindparam
+from sqlalchemy.sql.expression import TextClause
 
 from app.core.datatypes import MapProjection
 from app.core.logging import get_logger
 from app.core.stats import time_db_query
+from app.crud.changes import record_changes
 from app.crud.namespaces import get_default_namespace
 from app.db.metadata import shapes as shapes_tbl
 from app.schemas import GeoShape, GeoShapeCreate, GeoShapeMetadata, ViewportBounds
 from app.schemas.common import BaseModel
+from app.tiler.cache import bbox_union
 
 T = TypeVar("T")
 
@@ -53,11 +61,35 @@ GEOSHAPE_COLS = [
     shapes_tbl.c.namespace_id,
     shapes_tbl.c.created_at,
     shapes_tbl.c.updated_at,
-    func.shape_geojson(
-        shapes_tbl.c.uuid, shapes_tbl.c.geom, shapes_tbl.c.properties, shapes_tbl.c.name
-    ).label("geojson"),
+    # Cached GeoJSON feature, see shape_geojson()
+    shapes_tbl.c.geojson,
 ]
 
+FEATURE_COL = sa.cast(shapes_tbl.c.geojson, sa.Text).label("feature")
+"""GeoJSON feature of the shape, serialized by the database."""
+
+
+def _json_col(cols: Sequence[ColumnElement[Any]]) -> ColumnElement[Any]:
+    """Return a JSON object of ``cols``, serialized by the database."""
+    args = itertools.chain.from_iterable((col.name, col) for col in cols)
+    return sa.cast(func.json_build_object(*args), sa.Text).label("json")
+
+
+GEOSHAPE_JSON_COL = _json_col([c for c in GEOSHAPE_COLS if c.name in GeoShape.__fields__])
+"""Shape as a :class:`app.schemas.GeoShape` JSON object, serialized by the database."""
+
+METADATA_JSON_COL = _json_col(METADATA_COLS)
+"""Shape metadata as a :class:`app.schemas.GeoShapeMetadata` JSON object, serialized by
+the database."""
+
+BBOX_COLS = [
+    func.ST_XMin(shapes_tbl.c.geom).label("min_x"),
+    func.ST_YMin(shapes_tbl.c.geom).label("min_y"),
+    func.ST_XMax(shapes_tbl.c.geom).label("max_x"),
+    func.ST_YMax(shapes_tbl.c.geom).label("max_y"),
+]
+"""Bounding box of the shape geometry. Used to evict cached tiles."""
+
 # Read Shapes
 
 
@@ -69,6 +101,35 @@ class ShapeDoesNotExist(Exception):
         return f"Shape {self.id} does not exist."
 
 
+def _record_shapes_changes(
+    conn: Connection, organization_id: UUID4, shapes: Sequence[GeoShape]
+) -> None:
+    """Record that shapes were written."""
+    if shapes:
+        record_changes(
+            conn,
+            organization_id,
+            namespace_ids=[shp.namespace_id for shp in shapes],
+            bbox=bbox_union(shp.geojson.bbox for shp in shapes),
+        )
+
+
+def _record_rows_changes(conn: Connection, rows: Sequence[Any]) -> None:
+    """Record that rows with ``organization_id``, ``namespace_id`` and ``BBOX_COLS`` were written."""
+    by_org: Dict[UUID4, List[Any]] = {}
+    for row in rows:
+        by_org.setdefault(row.organization_id, []).append(row)
+    for organization_id, org_rows in by_org.items():
+        record_changes(
+            conn,
+            organization_id,
+            namespace_ids=[row.namespace_id for row in org_rows],
+            bbox=bbox_union(
+                (row.min_x, row.min_y, row.max_x, row.max_y) for row in org_rows
+            ),
+        )
+
+
 # Create Shapes
 
 
@@ -106,7 +167,9 @@ def create_shape(
     values["properties"] = values.get("properties") or {}
     with time_db_query("create_shape"):
         res = conn.execute(stmt, values).first()
-    return GeoShape.from_orm(res)
+    shape = GeoShape.from_orm(res)
+    _record_shapes_changes(conn, organization_id, [shape])
+    return shape
 
 
 def _get_name(d: Dict[str, Any]) -> Optional[str]:
@@ -136,38 +199,52 @@ def _parse_shape_args(
         # returning geom as a string makes it easier to include as a param in input/update queries
         out["geom"] = geom_new.json()
 
-    # Name
+    feature_properties = geojson.properties if geojson is not None else None
+    out["name"] = _shape_name(name, properties, feature_properties)
+    out["properties"] = _shape_properties(properties, feature_properties)
+    if keep_none:
+        return out
+    return {k: v for k, v in out.items() if v is not None}
+
+
+def _shape_name(
+    name: Optional[str],
+    properties: Optional[Dict[str, Any]],
+    feature_properties: Optional[Dict[str, Any]],
+) -> Optional[str]:
+    """Return the name of a shape from its name, properties or GeoJSON properties."""
     name_new = None
     # Ignore some values that are not names
     if name and name.lower() not in {"New shape", "New upload"}:
         name_new = name
     elif name_new := _get_name(properties or {}):
         pass
-    elif name_new := _get_name(geojson.properties or {}) if geojson else None:
+    elif name_new := _get_name(feature_properties or {}):
         pass
     elif name:
         name_new = name
-    if name_new:
-        out["name"] = str(name_new)
+    return str(name_new) if name_new else None
+
 
+def _shape_properties(
+    properties: Optional[Dict[str, Any]],
+    feature_properties: Optional[Dict[str, Any]],
+) -> Optional[Dict[str, Any]]:
+    """Return the properties of a shape from its properties or GeoJSON properties."""
     # This allows {} to remove properties
-    # Properties
     properties_new: Optional[Dict[str, Any]] = None
     if properties is not None:
         properties_new = properties
-    elif geojson is not None and geojson.properties is not None:
-        properties_new = {**geojson.properties}
-    if properties_new is not None:
-        delete_keys: Set[str] = {"__uuid"}
-        properties_new = {
-            k: v
-            for k, v in properties_new.items()
-            if k not in delete_keys and str(k).lower().strip() != "name"
-        }
-        out["properties"] = properties_new
-    if keep_none:
-        return out
-    return {k: v for k, v in out.items() if v is not None}
+    elif feature_properties is not None:
+        properties_new = {**feature_properties}
+    if properties_new is None:
+        return None
+    delete_keys: Set[str] = {"__uuid"}
+    return {
+        k: v
+        for k, v in properties_new.items()
+        if k not in delete_keys and str(k).lower().strip() != "name"
+    }
 
 
 class CreateManyShapesResult(BaseModel):
@@ -177,6 +254,7 @@ class CreateManyShapesResult(BaseModel):
     shapes_failed: List[NonNegativeInt] = Field(
         default_factory=list, description="Indices of shapes with bad data"
     )
+    num_created: NonNegativeInt = Field(0, description="Number of shapes created")
 
 
 def create_many_shapes(
@@ -221,7 +299,10 @@ def create_many_shapes(
         logger.warning("No shapes uploaded.")
         new_shapes = []
     shapes = [GeoShape.from_orm(row) for row in new_shapes]
-    return CreateManyShapesResult(shapes_created=shapes, shapes_failed=failures)
+    _record_shapes_changes(conn, organization_id, shapes)
+    return CreateManyShapesResult(
+        shapes_created=shapes, shapes_failed=failures, num_created=len(shapes)
+    )
 
 
 def shape_exists(conn: Connection, shape_id: UUID4, include_deleted=False) -> bool:
@@ -244,6 +325,25 @@ def get_shape(conn: Connection, shape_id: UUID4, include_deleted=False) -> GeoSh
     return GeoShape.parse_obj(dict(res))
 
 
+def encode_cursor(shape_id: UUID4) -> str:
+    """Encode the id of the last shape of a page as an opaque pagination cursor."""
+    return base64.urlsafe_b64encode(shape_id.bytes).rstrip(b"=").decode()
+
+
+def decode_cursor(cursor: str) -> UUID4:
+    """Decode a pagination cursor returned by :func:`encode_cursor`.
+
+    Raises:
+        ValueError: The cursor is invalid.
+
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return cast(UUID4, UUID(bytes=data))
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from None
+
+
 def _select_shapes_query(
     shape_id: Union[None, UUID4, Sequence[UUID4]] = None,
     created_by_user_id: Union[None, int, Sequence[int]] = None,
@@ -253,6 +353,7 @@ def _select_shapes_query(
     offset: Optional[int] = 0,
     bbox: Optional[ViewportBounds] = None,
     columns: Optional[Sequence[Union[ColumnElement[Any], int, str]]] = None,
+    after: Optional[UUID4] = None,
 ) -> Select:
     if columns:
         cols = [shapes_tbl.c[c] if isinstance(c, str) else c for c in columns]
@@ -270,6 +371,9 @@ def _select_shapes_query(
         stmt = stmt.where(shapes_tbl.c.namespace_id.in_(listify(namespace_id)))
     if organization_id:
         stmt = stmt.where(shapes_tbl.c.organization_id.in_(listify(organization_id)))
+    if after is not None:
+        # Keyset pagination: unlike OFFSET, does not scan the previous pages
+        stmt = stmt.where(shapes_tbl.c.uuid > after)
     if bbox:
         stmt = stmt.where(
             func.ST_Intersects(
@@ -299,6 +403,7 @@ def select_shapes(
     limit: Optional[int] = None,
     offset: Optional[int] = 0,
     bbox: Optional[ViewportBounds] = None,
+    after: Optional[UUID4] = None,
 ) -> Generator[GeoShape, None, None]:
     # This will be called many times - use more advanced caching
     stmt = _select_shapes_query(
@@ -309,6 +414,7 @@ def select_shapes(
         offset=offset,
         bbox=bbox,
         shape_id=shape_id,
+        after=after,
         columns=GEOSHAPE_COLS,
     )
     with time_db_query("select_shapes"):
@@ -317,6 +423,64 @@ def select_shapes(
         yield GeoShape.parse_obj(dict(row))
 
 
+def select_shapes_json(conn: Connection, **kwargs: Any) -> List[Any]:
+    """Query shapes as JSON serialized by the database.
+
+    This is a fast path for :func:`select_shapes` which does not parse and validate the
+    shapes. It takes the same arguments.
+
+    Returns:
+        Rows with the ``uuid`` of the shape and its ``json``, a
+        :class:`app.schemas.GeoShape` JSON object.
+
+    """
+    stmt = _select_shapes_query(columns=[shapes_tbl.c.uuid, GEOSHAPE_JSON_COL], **kwargs)
+    with time_db_query("select_shapes_json"):
+        return conn.execute(stmt).fetchall()
+
+
+def stream_shape_features(
+    conn: Connection,
+    *,
+    shape_id: Union[None, UUID4, Sequence[UUID4]] = None,
+    created_by_user_id: Union[None, int, Sequence[int]] = None,
+    organization_id: Union[None, UUID4, Sequence[UUID4]] = None,
+    namespace_id: Union[None, UUID4, Sequence[UUID4]] = None,
+    limit: Optional[int] = None,
+    offset: Optional[int] = 0,
+    bbox: Optional[ViewportBounds] = None,
+    after: Optional[UUID4] = None,
+    batch_size: int = 1000,
+) -> Iterator[List[str]]:
+    """Query shapes as GeoJSON features serialized by the database.
+
+    Rows are fetched with a server-side cursor and are not parsed, so memory use does
+    not depend on the number of shapes.
+
+    Returns:
+        Iterator over batches of at most ``batch_size`` GeoJSON features as JSON
+        strings. The connection must stay open until it is exhausted.
+
+    """
+    stmt = _select_shapes_query(
+        created_by_user_id=created_by_user_id,
+        organization_id=organization_id,
+        namespace_id=namespace_id,
+        limit=limit,
+        offset=offset,
+        bbox=bbox,
+        shape_id=shape_id,
+        after=after,
+        columns=[FEATURE_COL],
+    )
+    with time_db_query("stream_shape_features"):
+        res = conn.execute(
+            stmt,
+            execution_options={"stream_results": True, "max_row_buffer": batch_size},
+        )
+    return res.scalars().partitions(batch_size)
+
+
 def select_shape_metadata(
     conn: Connection,
     *,
@@ -325,6 +489,7 @@ def select_shape_metadata(
     organization_id: Union[None, UUID4, Sequence[UUID4]] = None,
     namespace_id: Union[None, UUID4, Sequence[UUID4]] = None,
     bbox: Optional[ViewportBounds] = None,
+    after: Optional[UUID4] = None,
     limit: Optional[int] = None,
     offset: Optional[int] = 0,
 ) -> Generator[GeoShapeMetadata, None, None]:
@@ -338,6 +503,7 @@ def select_shape_metadata(
         offset=offset,
         bbox=bbox,
         shape_id=shape_id,
+        after=after,
         columns=METADATA_COLS,
     )
     with time_db_query("select_shape_metadata"):
@@ -346,31 +512,60 @@ def select_shape_metadata(
         yield GeoShapeMetadata.parse_obj(dict(row))
 
 
+def select_shape_metadata_json(conn: Connection, **kwargs: Any) -> List[Any]:
+    """Query shape metadata as JSON serialized by the database.
+
+    This is a fast path for :func:`select_shape_metadata`, see
+    :func:`select_shapes_json`.
+
+    Returns:
+        Rows with the ``uuid`` of the shape and its ``json``, a
+        :class:`app.schemas.GeoShapeMetadata` JSON object.
+
+    """
+    stmt = _select_shapes_query(columns=[shapes_tbl.c.uuid, METADATA_JSON_COL], **kwargs)
+    with time_db_query("select_shape_metadata_json"):
+        return conn.execute(stmt).fetchall()
+
+
+_SEARCH_SQL = jinja2.Template(
+    """
+    SELECT
+    {% if json %}
+      json_build_object(
+        'uuid', uuid
+      , 'name', name
+      , 'namespace_id', namespace_id
+      , 'properties', properties - '__uuid'
+      , 'created_at', created_at
+      , 'updated_at', updated_at
+      ) :: TEXT AS json
+    {% else %}
+      uuid
+    , name
+    , properties - '__uuid' AS properties
+    , created_at
+    , updated_at
+    , namespace_id
+    {% endif %}
+    FROM shapes
+    , websearch_to_tsquery(:query_text) query
+    , SIMILARITY(:query_text, properties::VARCHAR) similarity
+    WHERE 1=1
+      AND (query @@ fts OR similarity > 0)
+      AND deleted_at IS NULL
+    ORDER BY ts_rank_cd(fts, query, 12) DESC, similarity DESC
+    LIMIT :limit
+    OFFSET :offset
+"""
+)
+
+
 def get_shape_metadata_matching_search(
     conn: Connection, search_query: str, limit: Optional[int] = None, offset: int = 0
 ) -> List[GeoShapeMetadata]:
     """Get all shapes matching a search string."""
-    stmt = sa.text(
-        """
-        SELECT
-          uuid
-        , name
-        , properties - '__uuid' AS properties
-        , created_at
-        , updated_at
-        , ts_rank_cd(fts, query, 12) AS rank
-        , namespace_id
-        FROM shapes
-        , websearch_to_tsquery(:query_text) query
-        , SIMILARITY(:query_text, properties::VARCHAR) similarity
-        WHERE 1=1
-          AND (query @@ fts OR similarity > 0)
-          AND deleted_at IS NULL
-        ORDER BY rank DESC, similarity DESC
-        LIMIT :limit
-        OFFSET :offset
-    """
-    )
+    stmt = sa.text(_SEARCH_SQL.render(json=False))
     with time_db_query("get_shape_metadata_matching_search"):
         res = conn.execute(
             stmt, {"query_text": search_query, "limit": limit, "offset": offset}
@@ -378,6 +573,25 @@ def get_shape_metadata_matching_search(
     return [GeoShapeMetadata.parse_obj(dict(g)) for g in list(res)]
 
 
+def get_shape_metadata_matching_search_json(
+    conn: Connection, search_query: str, limit: Optional[int] = None, offset: int = 0
+) -> List[str]:
+    """Get all shapes matching a search string as JSON serialized by the database.
+
+    This is a fast path for :func:`get_shape_metadata_matching_search`.
+
+    Returns:
+        :class:`app.schemas.GeoShapeMetadata` JSON objects.
+
+    """
+    stmt = sa.text(_SEARCH_SQL.render(json=True))
+    with time_db_query("get_shape_metadata_matching_search_json"):
+        res = conn.execute(
+            stmt, {"query_text": search_query, "limit": limit, "offset": offset}
+        ).scalars()
+        return list(res)
+
+
 ## Updating ###
 
 
@@ -411,17 +625,38 @@ def update_shape(
     # If geojson is not specified, then these are updated.
     if namespace_id:
         values["namespace_id"] = namespace_id
+    # Join the row to itself to return the namespace and bounding box of the shape before
+    # the update
+    old = shapes_tbl.alias("old")
     stmt = (
         update(shapes_tbl)
         .where(shapes_tbl.c.uuid == id_)
+        .where(old.c.uuid == shapes_tbl.c.uuid)
         .values(**values)
-        .returning(*GEOSHAPE_COLS)
+        .returning(
+            *GEOSHAPE_COLS,
+            shapes_tbl.c.organization_id,
+            old.c.namespace_id.label("old_namespace_id"),
+            func.ST_XMin(old.c.geom).label("min_x"),
+            func.ST_YMin(old.c.geom).label("min_y"),
+            func.ST_XMax(old.c.geom).label("max_x"),
+            func.ST_YMax(old.c.geom).label("max_y"),
+        )
     )
     with time_db_query("update_shape"):
         res = conn.execute(stmt, params).first()
     if res is None:
         raise ShapeDoesNotExist(id_)
-    return GeoShape.from_orm(res)
+    shape = GeoShape.from_orm(res)
+    record_changes(
+        conn,
+        res.organization_id,
+        namespace_ids=[res.old_namespace_id, shape.namespace_id],
+        bbox=bbox_union(
+            [(res.min_x, res.min_y, res.max_x, res.max_y), shape.geojson.bbox]
+        ),
+    )
+    return shape
 
 
 ### Deleting ###
@@ -433,11 +668,16 @@ def delete_shape(conn: Connection, id_: UUID4, *, user_id: int) -> None:
         "deleted_at": datetime.datetime.now(),
         "deleted_by_user_id": user_id,
     }
-    stmt = update(shapes_tbl).where(shapes_tbl.c.uuid == id_)
+    stmt = (
+        update(shapes_tbl)
+        .where(shapes_tbl.c.uuid == id_)
+        .returning(shapes_tbl.c.organization_id, shapes_tbl.c.namespace_id, *BBOX_COLS)
+    )
     with time_db_query("delete_shape"):
-        res = conn.execute(stmt, values)
-    if not res.rowcount:
+        rows = conn.execute(stmt, values).fetchall()
+    if not rows:
         raise ShapeDoesNotExist(id_)
+    _record_rows_changes(conn, rows)
 
 
 def listify(value: T) -> List[T]:
@@ -481,7 +721,12 @@ def delete_many_shapes(
     stmt = (
         update(shapes_tbl)
         .where(shapes_tbl.c.deleted_at.is_(None))
-        .returning(shapes_tbl.c.uuid)
+        .returning(
+            shapes_tbl.c.uuid,
+            shapes_tbl.c.organization_id,
+            shapes_tbl.c.namespace_id,
+            *BBOX_COLS,
+        )
     )
     filters = []
     if namespace_id:
@@ -497,8 +742,9 @@ def delete_many_shapes(
     else:
         stmt = stmt.where(or_(False, *filters))
     with time_db_query("delete_many_shapes"):
-        res = conn.execute(stmt, values)
-    return [row.uuid for row in res]
+        rows = conn.execute(stmt, values).fetchall()
+    _record_rows_changes(conn, rows)
+    return [row.uuid for row in rows]
 
 
 def get_shape_count(conn: Connection) -> int:
@@ -513,22 +759,26 @@ def get_shape_count(conn: Connection) -> int:
     return res
 
 
-def get_shapes_containing_point(
-    conn: Connection, lat: float, lng: float
-) -> List[Feature]:
-    """Get the shape that contains a point."""
-    stmt = sa.text(
-        """
-    SELECT shape_geojson(uuid, geom, properties, name) AS geojson
+_SHAPES_CONTAINING_POINT_STMT = sa.text(
+    """
+    SELECT geojson
     FROM shapes
     WHERE 1=1
       AND ST_Contains(geom, ST_GeomFromText('POINT(:lng :lat)', 4326))
       AND deleted_at IS NULL
       AND organization_id = public.app_user_org()
     """
-    )
+)
+
+
+def get_shapes_containing_point(
+    conn: Connection, lat: float, lng: float
+) -> List[Feature]:
+    """Get the shape that contains a point."""
     with time_db_query("get_shapes_containing_point"):
-        res = conn.execute(stmt, {"lat": lat, "lng": lng}).fetchall()
+        res = conn.execute(
+            _SHAPES_CONTAINING_POINT_STMT, {"lat": lat, "lng": lng}
+        ).fetchall()
     return [row.geojson for row in res]
 
 
@@ -541,16 +791,12 @@ class GeometryOperation(str, Enum):
     crosses = "crosses"
 
 
-def get_shapes_related_to_geom(
-    conn: Connection,
-    operation: GeometryOperation,
-    geom: Union[Point, Polygon, LineString],
-) -> List[Feature]:
-    """Get the shape that contains a point."""
-    stmt = sa.text(
+@lru_cache()
+def _shapes_related_to_geom_stmt(operation: GeometryOperation) -> TextClause:
+    return sa.text(
         jinja2.Template(
             """
-    SELECT shape_geojson(uuid, geom, properties, name) AS geojson
+    SELECT geojson
     FROM shapes
     WHERE 1=1
       AND ST_{{operation}}(geom, ST_GeomFromGeoJSON(:geom))
@@ -559,6 +805,15 @@ def get_shapes_related_to_geom(
     """
         ).render(operation=operation.title())
     )
+
+
+def get_shapes_related_to_geom(
+    conn: Connection,
+    operation: GeometryOperation,
+    geom: Union[Point, Polygon, LineString],
+) -> List[Feature]:
+    """Get the shape that contains a point."""
+    stmt = _shapes_related_to_geom_stmt(operation)
     with time_db_query("get_shapes_related_to_geom"):
         res = conn.execute(stmt, {"geom": geom.json()})
     return [row.geojson for row in res]
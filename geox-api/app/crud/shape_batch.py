@@ -0,0 +1,394 @@
+"""Batch spatial queries of shapes.
+
+These run a single set-based query for many input geometries, instead of a query per
+geometry. The inputs are sent to the database as an array of WKB, built for the whole
+batch at once with shapely, and split back into rows with ``unnest``. Each row is then
+joined laterally to the shapes it matches, using the spatial index of live shapes.
+
+Results are fetched with a server-side cursor, so that they can be streamed.
+"""
+import io
+import json
+from enum import Enum
+from functools import lru_cache
+from typing import Any, Iterator, List, Optional, Sequence, Tuple
+
+import jinja2
+import numpy as np
+import shapely
+import sqlalchemy as sa
+from pydantic import UUID4  # pylint: disable=no-name-in-module
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql.expression import TextClause
+
+from app.core.datatypes import MapProjection
+from app.core.stats import time_db_query
+from app.crud.shape_bulk import GEOMETRY_TYPES
+
+BATCH_MEDIA_TYPES = {
+    "application/json": "json",
+    "application/vnd.apache.arrow.stream": "arrow",
+    "application/vnd.apache.arrow.file": "arrow",
+    "application/vnd.apache.parquet": "parquet",
+    "application/x-parquet": "parquet",
+}
+"""Formats of the inputs of batch queries, by media type."""
+
+_Match = Tuple[int, str, Optional[float]]
+
+
+class BatchOperation(str, Enum):
+    """Operations of batch spatial queries.
+
+    The operations of :class:`app.crud.shape.GeometryOperation`, and:
+
+    - ``dwithin``: shapes within a distance in meters.
+    - ``nearest``: the nearest shapes.
+    """
+
+    contains = "contains"
+    intersects = "intersects"
+    touches = "touches"
+    crosses = "crosses"
+    dwithin = "dwithin"
+    nearest = "nearest"
+
+
+class InvalidGeometriesError(ValueError):
+    """Geometries cannot be parsed, or are not in WGS84 coordinates."""
+
+
+class InvalidPointsError(InvalidGeometriesError):
+    """Points cannot be parsed, or are not valid WGS84 coordinates."""
+
+
+def _format(media_type: str) -> str:
+    format_ = BATCH_MEDIA_TYPES.get(media_type.split(";")[0].strip().lower())
+    if format_ is None:
+        raise InvalidGeometriesError(f"Unsupported media type: {media_type}")
+    return format_
+
+
+def _read_table(data: bytes, format_: str, columns: List[str]) -> Any:
+    # pylint: disable=import-outside-toplevel
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if format_ == "parquet":
+        return pq.read_table(io.BytesIO(data), columns=columns)
+    try:
+        return pa.ipc.open_stream(data).read_all()
+    except pa.ArrowInvalid:
+        return pa.ipc.open_file(data).read_all()
+
+
+def _points_from_json(data: bytes) -> np.ndarray:
+    try:
+        positions = np.asarray(json.loads(data), dtype=np.float64)
+    except (TypeError, ValueError):
+        raise InvalidPointsError(
+            "Points must be a JSON array of [longitude, latitude] positions."
+        ) from None
+    if positions.size == 0:
+        return np.empty((0, 2))
+    if positions.ndim != 2 or positions.shape[1] != 2:
+        raise InvalidPointsError(
+            "Points must be a JSON array of [longitude, latitude] positions."
+        )
+    return positions
+
+
+def _points_from_table(data: bytes, format_: str) -> np.ndarray:
+    # pylint: disable=import-outside-toplevel
+    import pyarrow as pa
+
+    try:
+        table = _read_table(data, format_, ["lng", "lat"])
+        # Nulls are NaN, which are not valid coordinates
+        columns = [
+            table.column(name).combine_chunks().to_numpy(zero_copy_only=False)
+            for name in ("lng", "lat")
+        ]
+        return np.column_stack(columns).astype(np.float64)
+    except (pa.ArrowException, KeyError, ValueError) as exc:
+        raise InvalidPointsError(
+            f"Points must be a table with float columns lng and lat: {exc}"
+        ) from None
+
+
+def parse_points(data: bytes, media_type: str = "application/json") -> np.ndarray:
+    """Parse points in WGS84 coordinates.
+
+    Args:
+        data: Points as a JSON array of ``[longitude, latitude]`` positions, or as an
+            Arrow or Parquet table with the columns ``lng`` and ``lat``.
+        media_type: Media type of ``data``, one of :data:`BATCH_MEDIA_TYPES`.
+
+    Returns:
+        Array of shape ``(n, 2)`` with the longitude and latitude of the points.
+
+    Raises:
+        InvalidPointsError: The points cannot be parsed or are out of range.
+
+    """
+    try:
+        format_ = _format(media_type)
+    except InvalidGeometriesError as exc:
+        raise InvalidPointsError(str(exc)) from None
+    if format_ == "json":
+        points = _points_from_json(data)
+    else:
+        points = _points_from_table(data, format_)
+    lng, lat = points[:, 0], points[:, 1]
+    valid = (np.abs(lng) <= 180) & (np.abs(lat) <= 90)
+    if not valid.all():
+        idx = int(np.argmin(valid))
+        raise InvalidPointsError(f"Point {idx} is not a valid longitude and latitude.")
+    return points
+
+
+def _geometries_from_json(data: bytes) -> np.ndarray:
+    try:
+        items = json.loads(data)
+    except ValueError:
+        items = None
+    if not isinstance(items, list):
+        raise InvalidGeometriesError(
+            "Geometries must be a JSON array of GeoJSON geometries or features."
+        )
+    geometries: List[str] = []
+    for idx, item in enumerate(items):
+        if isinstance(item, dict) and item.get("type") == "Feature":
+            item = item.get("geometry")
+        if not isinstance(item, dict) or item.get("type") not in GEOMETRY_TYPES:
+            raise InvalidGeometriesError(f"Geometry {idx} is not a GeoJSON geometry.")
+        geometries.append(json.dumps(item))
+    return shapely.from_geojson(np.array(geometries, dtype=object), on_invalid="ignore")
+
+
+def _geometries_from_table(data: bytes, format_: str) -> np.ndarray:
+    # pylint: disable=import-outside-toplevel
+    import pyarrow as pa
+
+    try:
+        table = _read_table(data, format_, ["geometry"])
+        column = table.column("geometry")
+        if not (pa.types.is_binary(column.type) or pa.types.is_large_binary(column.type)):
+            raise ValueError(f"column geometry is {column.type}, not binary")
+        # Nulls are None, which are missing geometries
+        wkb = column.combine_chunks().to_numpy(zero_copy_only=False)
+    except (pa.ArrowException, KeyError, ValueError) as exc:
+        raise InvalidGeometriesError(
+            f"Geometries must be a table with a WKB column geometry: {exc}"
+        ) from None
+    return shapely.from_wkb(wkb, on_invalid="ignore")
+
+
+def parse_geometries(data: bytes, media_type: str = "application/json") -> np.ndarray:
+    """Parse geometries in WGS84 coordinates.
+
+    Args:
+        data: Geometries as a JSON array of GeoJSON geometries or features, or as an
+            Arrow or Parquet table with the WKB column ``geometry``, as in GeoParquet.
+        media_type: Media type of ``data``, one of :data:`BATCH_MEDIA_TYPES`.
+
+    Returns:
+        Array of shapely geometries.
+
+    Raises:
+        InvalidGeometriesError: The geometries cannot be parsed, are empty or are out
+            of range.
+
+    """
+    format_ = _format(media_type)
+    if format_ == "json":
+        geoms = _geometries_from_json(data)
+    else:
+        geoms = _geometries_from_table(data, format_)
+    if len(geoms) == 0:
+        return geoms
+    valid = ~(shapely.is_missing(geoms) | shapely.is_empty(geoms))
+    if valid.all():
+        bounds = shapely.bounds(geoms)
+        valid = (np.abs(bounds[:, [0, 2]]) <= 180).all(axis=1) & (
+            np.abs(bounds[:, [1, 3]]) <= 90
+        ).all(axis=1)
+    if not valid.all():
+        idx = int(np.argmin(valid))
+        raise InvalidGeometriesError(f"Geometry {idx} is not a valid WGS84 geometry.")
+    return geoms
+
+
+def _to_wkb(geoms: np.ndarray) -> List[bytes]:
+    """Return the WKB of each of ``geoms``."""
+    return shapely.to_wkb(geoms).tolist()
+
+
+NEAREST_OVERSAMPLING = 10
+"""Candidates per nearest shape, see :func:`stream_shapes_related_to_geoms`."""
+
+_SHAPES_RELATED_TO_GEOMS_SQL = """
+    {%- set filters -%}
+            shapes.organization_id = public.app_user_org()
+            AND shapes.deleted_at IS NULL
+            AND COALESCE(shapes.namespace_id = ANY(CAST(:namespace_ids AS UUID[])), TRUE)
+    {%- endset %}
+    {%- set distance -%}
+        ST_Distance(shapes.geom :: GEOGRAPHY, inputs.geom :: GEOGRAPHY)
+    {%- endset %}
+    WITH inputs AS (
+        SELECT wkb.idx - 1 AS idx, ST_GeomFromWKB(wkb.wkb, :srid) AS geom
+        FROM unnest(CAST(:geoms AS BYTEA[])) WITH ORDINALITY AS wkb(wkb, idx)
+    )
+    {%- if operation == "dwithin" %}
+    -- Bounding box of the points within the distance of each input, in degrees, which
+    -- can use the index of shapes. A degree of latitude is at least 110574 m, and a
+    -- degree of longitude at least 111319 m times the cosine of the latitude.
+    , search_boxes AS (
+        SELECT
+            inputs.idx,
+            inputs.geom,
+            ST_Expand(
+                inputs.geom,
+                LEAST(
+                    :distance / (111319.0 * GREATEST(cos(radians(lat.max_lat)), 1e-6)),
+                    360
+                ),
+                :distance / 110574.0
+            ) AS search_box
+        FROM inputs
+        CROSS JOIN LATERAL (
+            SELECT LEAST(
+                GREATEST(abs(ST_YMin(inputs.geom)), abs(ST_YMax(inputs.geom)))
+                    + :distance / 110574.0,
+                90
+            ) AS max_lat
+        ) AS lat
+    )
+    {%- endif %}
+    SELECT inputs.idx, matches.uuid, matches.distance
+    FROM {{ "search_boxes AS inputs" if operation == "dwithin" else "inputs" }}
+    CROSS JOIN LATERAL (
+        {%- if operation == "nearest" %}
+        -- The nearest shapes in coordinates, which can use the index of shapes, are
+        -- candidates ranked by their distance in meters.
+        SELECT candidates.uuid, candidates.distance
+        FROM (
+            SELECT shapes.uuid :: TEXT AS uuid, {{ distance }} AS distance
+            FROM shapes
+            WHERE {{ filters }}
+            ORDER BY shapes.geom <-> inputs.geom
+            LIMIT :num_candidates
+        ) AS candidates
+        ORDER BY candidates.distance
+        {%- else %}
+        SELECT
+            shapes.uuid :: TEXT AS uuid,
+            {%- if operation == "dwithin" %}
+            {{ distance }} AS distance
+            {%- else %}
+            CAST(NULL AS FLOAT) AS distance
+            {%- endif %}
+        FROM shapes
+        WHERE {{ filters }}
+            {%- if operation == "dwithin" %}
+            -- Boxes crossing the antimeridian are also searched on its other side
+            AND (
+                shapes.geom && inputs.search_box
+                OR shapes.geom && ST_Translate(inputs.search_box, 360, 0)
+                OR shapes.geom && ST_Translate(inputs.search_box, -360, 0)
+            )
+            AND ST_DWithin(shapes.geom :: GEOGRAPHY, inputs.geom :: GEOGRAPHY, :distance)
+            {%- else %}
+            AND ST_{{ operation.title() }}(shapes.geom, inputs.geom)
+            {%- endif %}
+        {%- endif %}
+        LIMIT :limit
+    ) AS matches
+"""
+
+
+@lru_cache()
+def _shapes_related_to_geoms_stmt(operation: BatchOperation) -> TextClause:
+    return sa.text(
+        jinja2.Template(_SHAPES_RELATED_TO_GEOMS_SQL).render(operation=operation.value)
+    )
+
+
+def stream_shapes_related_to_geoms(
+    conn: Connection,
+    operation: BatchOperation,
+    geoms: np.ndarray,
+    namespace_ids: Optional[Sequence[UUID4]] = None,
+    distance: Optional[float] = None,
+    limit: Optional[int] = None,
+    batch_size: int = 10000,
+) -> Iterator[List[_Match]]:
+    """Query the shapes related to each of many geometries.
+
+    Args:
+        operation: Relation of the shapes to the geometries, e.g. ``contains`` for the
+            shapes containing each geometry.
+        geoms: Geometries in WGS84 coordinates, see :func:`parse_geometries`.
+        namespace_ids: If given, only shapes in these namespaces are matched.
+        distance: Distance in meters of ``dwithin``.
+        limit: Maximum number of shapes matched per geometry. Defaults to 1 for
+            ``nearest``, and to all shapes otherwise. The nearest shapes are found
+            among the :data:`NEAREST_OVERSAMPLING` times ``limit`` shapes nearest in
+            longitude and latitude, which are ranked by their distance in meters.
+
+    Returns:
+        Iterator over batches of at most ``batch_size`` matches. A match is the index
+        of a geometry, the ID of a shape related to it and, for ``dwithin`` and
+        ``nearest``, the distance between them in meters. The nearest shapes of a
+        geometry are ordered by their distance in meters, other matches are not
+        sorted, so that they are streamed as they are found. The connection must stay
+        open until it is exhausted.
+
+    """
+    if operation == BatchOperation.dwithin and (distance is None or distance < 0):
+        raise ValueError("dwithin requires a non-negative distance.")
+    if operation == BatchOperation.nearest and limit is None:
+        limit = 1
+    params = {
+        "geoms": _to_wkb(geoms),
+        "srid": MapProjection.WGS84.value,
+        "namespace_ids": [str(x) for x in namespace_ids] if namespace_ids else None,
+        "distance": distance,
+        "limit": limit,
+        "num_candidates": limit * NEAREST_OVERSAMPLING if limit is not None else None,
+    }
+    with time_db_query(f"stream_shapes_related_to_geoms_{operation.value}"):
+        res = conn.execute(
+            _shapes_related_to_geoms_stmt(operation),
+            params,
+            execution_options={"stream_results": True, "max_row_buffer": batch_size},
+        )
+    return (
+        [(row.idx, row.uuid, row.distance) for row in partition]
+        for partition in res.partitions(batch_size)
+    )
+
+
+def stream_shapes_containing_points(
+    conn: Connection,
+    points: np.ndarray,
+    namespace_ids: Optional[Sequence[UUID4]] = None,
+    batch_size: int = 10000,
+) -> Iterator[List[_Match]]:
+    """Query the shapes containing each of many points.
+
+    Args:
+        points: Longitude and latitude of the points, see :func:`parse_points`.
+
+    Returns:
+        Iterator over batches of matches, see :func:`stream_shapes_related_to_geoms`.
+
+    """
+    return stream_shapes_related_to_geoms(
+        conn,
+        BatchOperation.contains,
+        shapely.points(points),
+        namespace_ids=namespace_ids,
+        batch_size=batch_size,
+    )
@@ -0,0 +1,291 @@
+"""Bulk ingestion of shapes.
+
+Shapes are streamed with ``COPY`` into a temporary staging table, then inserted into
+``shapes`` with a single ``INSERT ... SELECT``. This avoids a round trip and a
+statement execution per row, which dominates the time of large uploads with
+:func:`app.crud.shape.create_many_shapes`.
+
+Shapes are parsed from the decoded JSON without pydantic models. Geometries are
+validated and converted to WKB for the whole batch at once with shapely.
+"""
+import csv
+import io
+import json
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from uuid import UUID as PyUUID
+
+import numpy as np
+import shapely
+import sqlalchemy as sa
+from pydantic import UUID4  # pylint: disable=no-name-in-module
+from sqlalchemy import (
+    Column,
+    Integer,
+    LargeBinary,
+    MetaData,
+    Table,
+    Text,
+    func,
+    insert,
+    select,
+)
+from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateTable, DropTable
+
+from app.core.datatypes import MapProjection
+from app.core.logging import get_logger
+from app.core.stats import time_db_query
+from app.crud.changes import record_changes
+from app.crud.namespaces import get_default_namespace
+from app.crud.shape import (
+    BBOX_COLS,
+    GEOSHAPE_COLS,
+    CreateManyShapesResult,
+    _record_shapes_changes,
+    _shape_name,
+    _shape_properties,
+)
+from app.db.metadata import shapes as shapes_tbl
+from app.schemas import GeoShape
+from app.tiler.cache import bbox_union
+
+logger = get_logger(__name__)
+
+staging_tbl = Table(
+    "shapes_staging",
+    MetaData(),
+    Column("idx", Integer, nullable=False),
+    Column("name", Text),
+    Column("properties", JSONB),
+    Column("namespace_id", UUID(as_uuid=True)),
+    # WKB
+    Column("geom", LargeBinary, nullable=False),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
+"""Staging table for shapes. It is dropped at the end of the transaction."""
+
+
+class _CsvReader:
+    """File-like object that formats rows as CSV as they are read.
+
+    Used as the input of ``COPY ... FROM STDIN`` so that rows are never all in
+    memory at the same time.
+    """
+
+    def __init__(self, rows: Iterable[Sequence[Any]]) -> None:
+        self._rows = iter(rows)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+
+    def read(self, size: int = -1) -> str:
+        for row in self._rows:
+            self._writer.writerow(row)
+            if 0 <= size <= self._buffer.tell():
+                break
+        data = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+
+GEOMETRY_TYPES = frozenset(
+    [
+        "Point",
+        "MultiPoint",
+        "LineString",
+        "MultiLineString",
+        "Polygon",
+        "MultiPolygon",
+        "GeometryCollection",
+    ]
+)
+
+_ParsedShape = Tuple[Optional[str], Optional[Dict[str, Any]], Any, Optional[PyUUID]]
+
+
+def _parse_shape(item: Any) -> Optional[_ParsedShape]:
+    """Parse a shape in the format of :class:`app.schemas.GeoShapeCreate`.
+
+    This follows :func:`app.crud.shape._parse_shape_args`, without building the
+    pydantic models.
+
+    Returns:
+        The name, properties, GeoJSON geometry and namespace of the shape, or ``None``
+        if the shape is invalid.
+
+    """
+    if not isinstance(item, dict):
+        return None
+    feature = item.get("geojson")
+    if feature is not None and not isinstance(feature, dict):
+        return None
+    geometry = item.get("geometry") if feature is None else feature.get("geometry")
+    if not isinstance(geometry, dict) or geometry.get("type") not in GEOMETRY_TYPES:
+        return None
+    properties = item.get("properties")
+    feature_properties = feature.get("properties") if feature is not None else None
+    if not all(
+        isinstance(x, (dict, type(None))) for x in (properties, feature_properties)
+    ):
+        return None
+    name = item.get("name")
+    try:
+        namespace = item.get("namespace")
+        namespace_id = PyUUID(str(namespace)) if namespace is not None else None
+    except ValueError:
+        return None
+    return (
+        _shape_name(
+            str(name) if name is not None else None, properties, feature_properties
+        ),
+        _shape_properties(properties, feature_properties),
+        geometry,
+        namespace_id,
+    )
+
+
+def parse_shapes(
+    data: Sequence[Any], namespace_id: UUID4
+) -> Tuple[List[List[Any]], List[int]]:
+    """Parse shapes into rows of the staging table.
+
+    Args:
+        data: Shapes in the format of :class:`app.schemas.GeoShapeCreate`, decoded from
+            JSON. GeoJSON features are also accepted.
+        namespace_id: Namespace of the shapes without one.
+
+    Returns:
+        The rows of the staging table and the indexes of the invalid shapes.
+
+    """
+    failures: List[int] = []
+    rows: List[List[Any]] = []
+    geometries: List[str] = []
+    for idx, item in enumerate(data):
+        if isinstance(item, dict) and item.get("type") == "Feature":
+            item = {"geojson": item}
+        parsed = _parse_shape(item)
+        if parsed is None:
+            failures.append(idx)
+            continue
+        name, properties, geometry, shape_namespace_id = parsed
+        rows.append(
+            [
+                idx,
+                name,
+                json.dumps(properties) if properties is not None else None,
+                shape_namespace_id or namespace_id,
+            ]
+        )
+        geometries.append(json.dumps(geometry))
+    # Parse, validate and convert all geometries at once
+    wkb = shapely.to_wkb(
+        shapely.from_geojson(np.array(geometries, dtype=object), on_invalid="ignore"),
+        hex=True,
+    )
+    valid_rows: List[List[Any]] = []
+    for row, geom in zip(rows, wkb):
+        if geom is None:
+            failures.append(row[0])
+        else:
+            # hex format of bytea
+            valid_rows.append([*row, f"\\x{geom}"])
+    return valid_rows, sorted(failures)
+
+
+def copy_rows(conn: Connection, table: Table, rows: Iterable[Sequence[Any]]) -> None:
+    """Load rows into a table with ``COPY``.
+
+    ``None`` values are loaded as ``NULL``. Empty strings are also loaded as ``NULL``.
+    """
+    columns = ", ".join(c.name for c in table.columns)
+    sql = f"COPY {table.name} ({columns}) FROM STDIN WITH (FORMAT csv)"
+    # The DBAPI connection shares the transaction of conn
+    with conn.connection.cursor() as cursor:  # type: ignore
+        cursor.copy_expert(sql, _CsvReader(rows))
+
+
+def copy_many_shapes(
+    conn: Connection,
+    data: Sequence[Any],
+    user_id: int,
+    organization_id: UUID4,
+    namespace_id: Optional[UUID4] = None,
+    include_shapes: bool = False,
+) -> CreateManyShapesResult:
+    """Create many new shapes with ``COPY``.
+
+    This is equivalent to :func:`app.crud.shape.create_many_shapes`, but much faster
+    for large numbers of shapes.
+
+    Args:
+        data: Shapes to create, see :func:`parse_shapes`.
+        include_shapes: If true, return the created shapes. Otherwise only their number
+            is returned.
+
+    """
+    default_namespace = namespace_id or get_default_namespace(conn, organization_id).id
+    rows, failures = parse_shapes(data, default_namespace)
+    with time_db_query("copy_many_shapes_staging"):
+        conn.execute(CreateTable(staging_tbl))
+        copy_rows(conn, staging_tbl, rows)
+    insert_stmt = insert(shapes_tbl).from_select(
+        [
+            "name",
+            "properties",
+            "namespace_id",
+            "geom",
+            "created_by_user_id",
+            "updated_by_user_id",
+            "organization_id",
+        ],
+        select(
+            staging_tbl.c.name,
+            func.coalesce(staging_tbl.c.properties, sa.cast({}, JSONB)),
+            staging_tbl.c.namespace_id,
+            func.ST_GeomFromWKB(staging_tbl.c.geom, MapProjection.WGS84.value),
+            sa.literal(user_id, Integer),
+            sa.literal(user_id, Integer),
+            sa.literal(organization_id, UUID(as_uuid=True)),
+        ).order_by(staging_tbl.c.idx),
+    )
+    if include_shapes:
+        with time_db_query("copy_many_shapes"):
+            rows = conn.execute(insert_stmt.returning(*GEOSHAPE_COLS)).fetchall()
+            conn.execute(DropTable(staging_tbl))
+        shapes = [GeoShape.from_orm(row) for row in rows]
+        _record_shapes_changes(conn, organization_id, shapes)
+        return CreateManyShapesResult(
+            shapes_created=shapes, shapes_failed=failures, num_created=len(shapes)
+        )
+    # Only aggregates are needed to record the changes
+    inserted = insert_stmt.returning(shapes_tbl.c.namespace_id, *BBOX_COLS).cte(
+        "inserted"
+    )
+    summary_stmt = select(
+        inserted.c.namespace_id,
+        func.count().label("num_created"),
+        func.min(inserted.c.min_x).label("min_x"),
+        func.min(inserted.c.min_y).label("min_y"),
+        func.max(inserted.c.max_x).label("max_x"),
+        func.max(inserted.c.max_y).label("max_y"),
+    ).group_by(inserted.c.namespace_id)
+    with time_db_query("copy_many_shapes"):
+        summary = conn.execute(summary_stmt).fetchall()
+        conn.execute(DropTable(staging_tbl))
+    if summary:
+        record_changes(
+            conn,
+            organization_id,
+            namespace_ids=[row.namespace_id for row in summary],
+            bbox=bbox_union(
+                (row.min_x, row.min_y, row.max_x, row.max_y) for row in summary
+            ),
+        )
+    else:
+        logger.warning("No shapes uploaded.")
+    return CreateManyShapesResult(
+        shapes_failed=failures, num_created=sum(row.num_created for row in summary)
+    )
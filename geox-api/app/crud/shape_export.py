@@ -0,0 +1,370 @@
+"""Export of shapes as GeoParquet.
+
+Shapes are read with a server-side cursor and each batch is written as a row group
+of a Parquet file as soon as it is read, so the memory used by an export does not
+depend on the number of shapes of the organization. Writing to a file opened with
+``s3fs`` uploads it in parts as row groups are written.
+
+The files of an export are partitioned by namespace, and a namespace is split into
+files of bounded size, so that Snowflake loads them in parallel. A manifest listing
+the files is written last: an export without a manifest is incomplete. Snowpipe loads
+files independently, so Snowflake loads the manifests too, and only reads an export
+once as many rows as its manifest lists are loaded.
+
+Geometries are written as WKB, with the ``geo`` metadata of GeoParquet. The other
+columns are those of the tables loaded into Snowflake, see
+``snowflake/mercator_snowflake/sql/geofencer_shares.sql.j2``.
+
+Exports are incremental. A delta export only has the shapes updated or deleted since
+the high-water mark of the previous export, kept in the ``shape_exports`` table, and
+deleted shapes are exported as tombstones: rows with ``deleted_at`` and no geometry.
+Every few deltas, a snapshot export compacts them: it has all live shapes, and the
+tombstones of the shapes deleted since the previous export. The current shapes are
+the latest row of each shape in the exports since the last snapshot, when it is not
+a tombstone.
+"""
+import datetime
+import itertools
+import json
+from enum import Enum
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from uuid import uuid4
+
+import jinja2
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlalchemy as sa
+from pydantic import UUID4  # pylint: disable=no-name-in-module
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Connection, Row
+
+from app.core.stats import time_db_query
+from app.db.metadata import shape_exports as shape_exports_tbl
+
+
+class ExportType(str, Enum):
+    """Types of exports."""
+
+    snapshot = "snapshot"
+    delta = "delta"
+
+
+GEOPARQUET_METADATA = {
+    "version": "1.0.0",
+    "primary_column": "geom",
+    # No CRS means OGC:CRS84, i.e. longitude and latitude in WGS84
+    "columns": {"geom": {"encoding": "WKB", "geometry_types": []}},
+}
+"""GeoParquet metadata of exports."""
+
+EXPORT_SCHEMA = pa.schema(
+    [
+        pa.field("uuid", pa.string(), nullable=False),
+        pa.field("name", pa.string()),
+        # NULL for tombstones
+        pa.field("geom", pa.binary()),
+        # JSON
+        pa.field("properties", pa.string()),
+        pa.field("created_at", pa.timestamp("us")),
+        pa.field("updated_at", pa.timestamp("us")),
+        pa.field("deleted_at", pa.timestamp("us")),
+        pa.field("exported_at", pa.timestamp("us"), nullable=False),
+        pa.field("organization_id", pa.string(), nullable=False),
+        pa.field("namespace_id", pa.string()),
+        pa.field("namespace_name", pa.string()),
+        pa.field("namespace_slug", pa.string()),
+        pa.field("export_id", pa.string(), nullable=False),
+        pa.field("export_type", pa.string(), nullable=False),
+    ],
+    metadata={"geo": json.dumps(GEOPARQUET_METADATA)},
+)
+"""Schema of the Parquet files of exports."""
+
+_EXPORT_SHAPES_SQL = """
+    SELECT
+        s.uuid :: TEXT AS uuid,
+        s.name,
+        CASE WHEN s.deleted_at IS NULL THEN ST_AsBinary(s.geom) END AS geom,
+        s.properties :: TEXT AS properties,
+        -- ensure that there is no timezone
+        s.created_at :: TIMESTAMP AS created_at,
+        s.updated_at :: TIMESTAMP AS updated_at,
+        s.deleted_at :: TIMESTAMP AS deleted_at,
+        CAST(:exported_at AS TIMESTAMP) AS exported_at,
+        s.organization_id :: TEXT AS organization_id,
+        s.namespace_id :: TEXT AS namespace_id,
+        n.name :: TEXT AS namespace_name,
+        n.slug :: TEXT AS namespace_slug,
+        CAST(:export_id AS TEXT) AS export_id,
+        '{{ export_type }}' AS export_type
+    FROM shapes AS s
+    INNER JOIN namespaces AS n
+    ON TRUE
+        AND s.namespace_id = n.id
+        AND n.organization_id = :organization_id
+        AND s.organization_id = :organization_id
+        {%- if export_type == "snapshot" %}
+        AND (s.deleted_at IS NULL OR s.updated_at > CAST(:since AS TIMESTAMP))
+        {%- else %}
+        AND s.updated_at > CAST(:since AS TIMESTAMP)
+        {%- endif %}
+    ORDER BY s.namespace_id, s.uuid
+"""
+
+_EXPORT_SHAPES_STMTS = {
+    export_type: sa.text(
+        jinja2.Template(_EXPORT_SHAPES_SQL).render(export_type=export_type.value)
+    )
+    for export_type in ExportType
+}
+
+
+def get_export_time(conn: Connection) -> datetime.datetime:
+    """Return the time of an export, the current UTC time of the database."""
+    return conn.execute(
+        sa.text("SELECT (now() AT TIME ZONE 'utc') :: TIMESTAMP")
+    ).scalar_one()
+
+
+def new_export_id(exported_at: datetime.datetime) -> str:
+    """Return a unique ID for an export.
+
+    IDs start with the export time, so that they sort in the order of exports.
+    """
+    now = exported_at
+    rnd = str(uuid4())[:6]
+    return (
+        f"{now.year}/{now.month:02d}/{now.day:02d}/{now.hour:02d}/{now.minute:02d}/"
+        f"{now.second:02d}/{now.microsecond:06d}/{rnd}"
+    )
+
+
+def rows_to_batch(
+    rows: Iterable[Any], schema: pa.Schema = EXPORT_SCHEMA
+) -> pa.RecordBatch:
+    """Convert rows with the columns of ``schema`` into a record batch."""
+    columns = list(zip(*rows)) or [()] * len(schema)
+    return pa.RecordBatch.from_arrays(
+        [pa.array(col, type=field.type) for col, field in zip(columns, schema)],
+        schema=schema,
+    )
+
+
+def stream_export_batches(
+    conn: Connection,
+    organization_id: UUID4,
+    exported_at: datetime.datetime,
+    export_id: str,
+    export_type: ExportType = ExportType.snapshot,
+    since: Optional[datetime.datetime] = None,
+    batch_size: int = 50_000,
+) -> Iterator[pa.RecordBatch]:
+    """Query the shapes of an organization to export.
+
+    Args:
+        export_type: A snapshot exports all live shapes, and the tombstones of shapes
+            deleted after ``since``. A delta exports the shapes updated or deleted
+            after ``since``.
+        since: High-water mark of the previous export, see :func:`next_export`.
+
+    Returns:
+        Iterator over record batches of at most ``batch_size`` shapes, with the schema
+        :data:`EXPORT_SCHEMA`. Batches are sorted by namespace, and the shapes of a
+        batch are all in the same namespace. The connection must stay open until it is
+        exhausted.
+
+    """
+    params = {
+        "organization_id": organization_id,
+        "exported_at": exported_at,
+        "export_id": export_id,
+        "since": since,
+    }
+    if export_type == ExportType.delta and since is None:
+        raise ValueError("Delta exports require the time of the previous export.")
+    with time_db_query(f"stream_export_shapes_{export_type.value}"):
+        res = conn.execute(
+            _EXPORT_SHAPES_STMTS[export_type],
+            params,
+            execution_options={"stream_results": True, "max_row_buffer": batch_size},
+        )
+    return (
+        rows_to_batch(rows)
+        for partition in res.partitions(batch_size)
+        for _, rows in itertools.groupby(partition, key=lambda row: row.namespace_id)
+    )
+
+
+MANIFEST_NAME = "manifest.json"
+"""Name of the manifest of an export, in the directory of its files."""
+
+
+def partition_path(namespace_id: str, part: int) -> str:
+    """Return the path of a file of an export, relative to the export directory."""
+    return f"namespace_id={namespace_id}/part-{part:05d}.parquet"
+
+
+def write_partitioned_geoparquet(
+    open_file: Callable[[str], IO[bytes]],
+    batches: Iterable[pa.RecordBatch],
+    max_file_size: int = 128 * 2**20,
+    schema: pa.Schema = EXPORT_SCHEMA,
+) -> List[Dict[str, Any]]:
+    """Write record batches to GeoParquet files partitioned by namespace.
+
+    Each non-empty batch is written as a row group. A file is started for each
+    namespace, and when the current file is larger than ``max_file_size``, so files
+    are larger by at most a row group.
+
+    Args:
+        open_file: Open a file for writing from its path, see :func:`partition_path`.
+        batches: Batches sorted by namespace, each with shapes of a single namespace,
+            as returned by :func:`stream_export_batches`.
+
+    Returns:
+        The files written, with their path, namespace, number of rows and size in
+        bytes.
+
+    """
+    namespace_idx = schema.get_field_index("namespace_id")
+    files: List[Dict[str, Any]] = []
+    f: Optional[IO[bytes]] = None
+    writer: Optional[pq.ParquetWriter] = None
+
+    def close() -> None:
+        assert f is not None and writer is not None
+        writer.close()
+        files[-1]["size"] = f.tell()
+        f.close()
+
+    try:
+        for batch in batches:
+            if not batch.num_rows:
+                continue
+            namespace_id = batch.column(namespace_idx)[0].as_py()
+            if (
+                f is None
+                or namespace_id != files[-1]["namespace_id"]
+                or f.tell() >= max_file_size
+            ):
+                if f is not None:
+                    close()
+                part = sum(1 for x in files if x["namespace_id"] == namespace_id)
+                path = partition_path(namespace_id, part)
+                f = open_file(path)
+                writer = pq.ParquetWriter(f, schema, compression="snappy")
+                files.append(
+                    {"path": path, "namespace_id": namespace_id, "num_rows": 0, "size": 0}
+                )
+            assert writer is not None
+            writer.write_table(pa.Table.from_batches([batch], schema=schema))
+            files[-1]["num_rows"] += batch.num_rows
+        if f is not None:
+            close()
+    except BaseException:
+        # Abort the upload of the file being written, instead of completing it
+        if f is not None and not f.closed:
+            getattr(f, "discard", f.close)()
+        raise
+    return files
+
+
+def export_manifest(
+    organization_id: UUID4,
+    export_id: str,
+    export_type: ExportType,
+    exported_at: datetime.datetime,
+    files: List[Dict[str, Any]],
+) -> Dict[str, Any]:
+    """Return the manifest of an export."""
+    return {
+        "organization_id": str(organization_id),
+        "export_id": export_id,
+        "export_type": export_type.value,
+        "exported_at": exported_at.isoformat(),
+        "num_rows": sum(x["num_rows"] for x in files),
+        "files": files,
+    }
+
+
+def get_export_state(conn: Connection, organization_id: UUID4) -> Optional[Row]:
+    """Return the state of the exports of an organization.
+
+    The state is locked until the end of the transaction, so that concurrent exports
+    of an organization wait for each other.
+
+    Returns:
+        The row of ``shape_exports``, or ``None`` if the organization was never
+        exported.
+
+    """
+    stmt = (
+        select(shape_exports_tbl)
+        .where(shape_exports_tbl.c.organization_id == organization_id)
+        .with_for_update()
+    )
+    with time_db_query("get_export_state"):
+        return conn.execute(stmt).first()
+
+
+def next_export(
+    state: Optional[Row], snapshot_every: int, snapshot: bool = False
+) -> Tuple[ExportType, Optional[datetime.datetime]]:
+    """Return the type of the next export of an organization and its high-water mark.
+
+    Args:
+        state: State of the exports, see :func:`get_export_state`.
+        snapshot_every: Number of delta exports between snapshot exports.
+        snapshot: If true, the next export is a snapshot.
+
+    """
+    since = state.exported_until if state is not None else None
+    if (
+        snapshot
+        or state is None
+        or state.snapshot_export_id is None
+        or state.num_deltas >= snapshot_every
+    ):
+        return ExportType.snapshot, since
+    return ExportType.delta, since
+
+
+def save_export_state(
+    conn: Connection,
+    organization_id: UUID4,
+    exported_until: datetime.datetime,
+    export_type: Optional[ExportType] = None,
+    export_id: Optional[str] = None,
+) -> None:
+    """Save the state of the exports of an organization after an export.
+
+    Args:
+        exported_until: New high-water mark. Shapes updated after it are exported by
+            the next export.
+        export_type: Type of the export written, or ``None`` if no file was written.
+        export_id: ID of the export written.
+
+    """
+    tbl = shape_exports_tbl
+    values = {"exported_until": exported_until, "updated_at": datetime.datetime.utcnow()}
+    if export_type == ExportType.snapshot:
+        values.update(snapshot_export_id=export_id, num_deltas=0)
+    elif export_type == ExportType.delta:
+        values.update(num_deltas=tbl.c.num_deltas + 1)
+    stmt = (
+        insert(tbl)
+        .values(
+            organization_id=organization_id,
+            exported_until=exported_until,
+            snapshot_export_id=values.get("snapshot_export_id"),
+        )
+        .on_conflict_do_update(
+            index_elements=[tbl.c.organization_id],
+            set_=values,
+            # The high-water mark never goes back
+            where=tbl.c.exported_until <= exported_until,
+        )
+    )
+    with time_db_query("save_export_state"):
+        conn.execute(stmt)
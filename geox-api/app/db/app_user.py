@@ -61,3 +61,30 @@ def get_app_user_org(conn: Connection) -> Optional[UUID]:
     with time_db_query("get_app_user_org"):
         res = conn.execute(stmt).scalar()
     return UUID(res) if res else None
+
+
+_SET_APP_USER_SETTINGS = text(
+    """
+    SELECT
+        set_config('role', 'app_user', TRUE)
+        , set_config('app.user_id', :user_id, TRUE)
+        , set_config('app.user_org', :org_id, TRUE)
+    """
+)
+
+
+def set_app_user_settings(conn: Connection, user_id: int, org_id: UUID) -> None:
+    """Set up a SQLAlchemy session for RLS.
+
+    - Set role to `app_user`
+    - Set `app.user_id` setting to the ``user_id``
+    - Set `app.user_org` setting to the ``org_id``
+
+    The settings are local to the transaction, like ``SET LOCAL``, and are set in a
+    single round trip to the database.
+
+    """
+    with time_db_query("set_app_user_settings"):
+        conn.execute(
+            _SET_APP_USER_SETTINGS, {"user_id": str(user_id), "org_id": str(org_id)}
+        )
@@ -0,0 +1,53 @@
+"""Callbacks run after a transaction commits.
+
+Caches and edit versions must only change once the data they describe is visible to
+other connections, otherwise a concurrent read could cache data from before the
+write under the new version.
+"""
+from contextlib import contextmanager
+from typing import Callable, Iterator, List
+from weakref import WeakKeyDictionary
+
+from sqlalchemy.engine import Connection, Engine
+
+from app.core.logging import get_logger
+
+logger = get_logger(__name__)
+
+_after_commit: "WeakKeyDictionary[Connection, List[Callable[[], None]]]" = (
+    WeakKeyDictionary()
+)
+
+
+def after_commit(conn: Connection, callback: Callable[[], None]) -> None:
+    """Run ``callback`` after the transaction of ``conn`` commits.
+
+    Callbacks are only deferred for connections opened with :func:`begin`. They are
+    discarded if the transaction is rolled back. For other connections, e.g. in tests
+    or scripts, ``callback`` is run immediately.
+
+    """
+    callbacks = _after_commit.get(conn)
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+
+@contextmanager
+def begin(engine: Engine) -> Iterator[Connection]:
+    """Yield a connection with an open transaction, like :meth:`Engine.begin`.
+
+    Callbacks registered with :func:`after_commit` run after the transaction commits.
+    """
+    with engine.begin() as conn:
+        _after_commit[conn] = []
+        try:
+            yield conn
+        finally:
+            callbacks = _after_commit.pop(conn, [])
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Error in after commit callback: %s", exc)
@@ -0,0 +1,55 @@
+"""Maintenance of the app database.
+
+:func:`cluster_shapes` physically reorders the ``shapes`` table so that the shapes of
+an organization, and shapes close to each other, are stored in the same pages. Tile
+and bounding box queries then read fewer pages. The order degrades as shapes are
+written, so this runs periodically, see the ``cluster_shapes`` Celery task.
+
+``CLUSTER`` rewrites the table and holds an ``ACCESS EXCLUSIVE`` lock on it while it
+runs: it must be scheduled when the app is idle. It is not scheduled by default, see
+``shapes_cluster_schedule``. While ``CLUSTER`` waits for its lock, e.g. behind a long
+transaction, it also blocks all queries of shapes, so it gives up after
+``shapes_cluster_lock_timeout`` seconds. ``pg_repack`` reorders tables without
+holding this lock for the whole rewrite, where it is installed.
+
+Usage::
+
+    python -m app.db.maintenance
+"""
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from app.core.logging import get_logger
+from app.core.stats import time_db_query
+
+logger = get_logger(__name__)
+
+SHAPES_CLUSTER_INDEX = "ix_shapes_organization_id_centroid"
+"""Index defining the order of shapes, see :mod:`app.db.metadata.shapes`."""
+
+
+def cluster_shapes(engine: Engine, lock_timeout: int = 0) -> None:
+    """Reorder the shapes table along :data:`SHAPES_CLUSTER_INDEX` and analyze it.
+
+    Args:
+        lock_timeout: Seconds to wait for the lock on shapes. ``0`` means no timeout.
+
+    Raises:
+        sqlalchemy.exc.OperationalError: The lock was not acquired in time.
+
+    """
+    with engine.begin() as conn:
+        conn.execute(text(f"SET LOCAL lock_timeout = '{int(lock_timeout)}s'"))
+        with time_db_query("cluster_shapes"):
+            conn.execute(text(f"CLUSTER shapes USING {SHAPES_CLUSTER_INDEX}"))
+        # CLUSTER resets the correlation statistics used by the planner
+        with time_db_query("analyze_shapes"):
+            conn.execute(text("ANALYZE shapes"))
+    logger.info("Clustered shapes.")
+
+
+if __name__ == "__main__":
+    from app.core.config import get_settings
+    from app.db.engine import engine
+
+    cluster_shapes(engine, get_settings().shapes_cluster_lock_timeout)
@@ -4,6 +4,7 @@ from app.db.engine import engine
 from app.db.metadata.common import *
 from app.db.metadata.namespaces import *
 from app.db.metadata.organizations import *
+from app.db.metadata.shape_exports import *
 from app.db.metadata.shapes import *
 from app.db.metadata.users import *
 
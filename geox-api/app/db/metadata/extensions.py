@@ -2,7 +2,7 @@ from typing import List
 
 from alembic_utils.pg_extension import PGExtension
 
-extensions = ["postgis", "pg_trgm"]
+extensions = ["postgis", "pg_trgm", "btree_gist"]
 
 entities: List[PGExtension] = [
     PGExtension(schema="public", signature=ext) for ext in extensions
@@ -10,4 +10,5 @@ entities = [
     create_default_organization,
     create_default_namespace,
     shape_geojson_uuid_geometry_jsonb_text,
+    set_shape_geojson,
 ]
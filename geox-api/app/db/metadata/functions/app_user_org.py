@@ -9,6 +9,6 @@ app_user_org = PGFunction(
   RETURNS UUID as
   $$
     SELECT nullif(current_setting('app.user_org', TRUE), '') :: UUID;
-  $$ language SQL;
+  $$ language SQL STABLE;
   """,
 )
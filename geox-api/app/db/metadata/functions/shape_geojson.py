@@ -2,7 +2,7 @@ from textwrap import dedent
 
 from alembic_utils.pg_function import PGFunction
 
-__all__ = ["shape_geojson_uuid_geometry_jsonb_text"]
+__all__ = ["shape_geojson_uuid_geometry_jsonb_text", "set_shape_geojson"]
 
 shape_geojson_uuid_geometry_jsonb_text = PGFunction(
     schema="public",
@@ -15,8 +15,10 @@ shape_geojson_uuid_geometry_jsonb_text = PGFunction(
         AS
         $function$
             SELECT jsonb_build_object(
+                'type',
+                'Feature',
                 'geometry',
-                ST_AsGeoJSON(geom),
+                ST_AsGeoJSON(geom) :: JSONB,
                 'properties',
                 properties || jsonb_build_object('name', name, '__uuid', uuid :: TEXT),
                 'id',
@@ -28,3 +30,21 @@ shape_geojson_uuid_geometry_jsonb_text = PGFunction(
         """
     ).strip(),
 )
+
+set_shape_geojson = PGFunction(
+    schema="public",
+    signature="set_shape_geojson()",
+    definition=dedent(
+        """
+        RETURNS trigger
+        LANGUAGE plpgsql
+        AS $function$
+            BEGIN
+                -- Cache the GeoJSON feature so that reads do not serialize the geometry
+                NEW.geojson := shape_geojson(NEW.uuid, NEW.geom, NEW.properties, NEW.name);
+                RETURN NEW;
+            END;
+        $function$
+        """
+    ).strip(),
+)
@@ -0,0 +1,40 @@
+"""State of the incremental exports of shapes."""
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Table
+from sqlalchemy.dialects.postgresql import UUID
+
+from app.db.metadata.common import TimestampMixin, metadata
+
+__all__ = ["shape_exports"]
+
+shape_exports = Table(
+    "shape_exports",
+    metadata,
+    Column(
+        "organization_id",
+        UUID(as_uuid=True),
+        ForeignKey("organizations.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Column(
+        "exported_until",
+        DateTime,
+        nullable=False,
+        comment="High-water mark of the exports. Shapes updated after it are exported "
+        "by the next delta export.",
+    ),
+    Column(
+        "snapshot_export_id",
+        String,
+        nullable=True,
+        comment="ID of the last snapshot export.",
+    ),
+    Column(
+        "num_deltas",
+        Integer,
+        nullable=False,
+        server_default="0",
+        comment="Number of delta exports since the last snapshot export.",
+    ),
+    *TimestampMixin(),
+    comment="State of the incremental exports of the shapes of an organization.",
+)
@@ -13,6 +13,7 @@ from sqlalchemy import (
     String,
     Table,
     func,
+    text,
 )
 from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR, UUID
 
@@ -20,6 +21,11 @@ from app.db.metadata.common import metadata
 
 __all__ = ["shapes"]
 
+_GEOM_3857 = (
+    "ST_Transform(ST_ClipByBox2D("
+    "geom, ST_MakeEnvelope(-180, -85.0511287798, 180, 85.0511287798, 4326)"
+    "), 3857)"
+)
 
 shapes = Table(
     "shapes",
@@ -62,6 +68,32 @@ shapes = Table(
     Column("deleted_at", DateTime, nullable=True, index=True),
     Column("deleted_by_user_id", Integer, ForeignKey("users.id"), nullable=True),
     Column("geom", Geometry(srid=4326), nullable=True),
+    # Web Mercator geometries used by generate_shape_tile(), clipped to the latitude
+    # bounds of Web Mercator, which is undefined at the poles.
+    # The simplified geometries are used for low zoom levels. Each is simplified to
+    # the size of a tile pixel (4096 pixels per tile) at the highest zoom level it is
+    # used for: 9784 m / 2 ** z. Collapsed geometries are kept so that small shapes
+    # still appear in low zoom tiles.
+    Column(
+        "geom_3857",
+        Geometry(srid=3857, spatial_index=False),
+        Computed(_GEOM_3857, persisted=True),
+    ),
+    Column(
+        "geom_3857_z5",
+        Geometry(srid=3857, spatial_index=False),
+        Computed(f"ST_Simplify({_GEOM_3857}, 305.7, true)", persisted=True),
+    ),
+    Column(
+        "geom_3857_z9",
+        Geometry(srid=3857, spatial_index=False),
+        Computed(f"ST_Simplify({_GEOM_3857}, 19.1, true)", persisted=True),
+    ),
+    Column(
+        "geom_3857_z12",
+        Geometry(srid=3857, spatial_index=False),
+        Computed(f"ST_Simplify({_GEOM_3857}, 2.39, true)", persisted=True),
+    ),
     Column(
         "properties",
         JSONB,
@@ -69,6 +101,9 @@ shapes = Table(
         default=dict,
         server_default="json_build_object()",
     ),
+    # GeoJSON feature of the shape, with its bounding box. Maintained by
+    # shapes_geojson_trigger from uuid, geom, properties and name.
+    Column("geojson", JSONB, nullable=True),
     Column(
         "organization_id",
         UUID(as_uuid=True),
@@ -96,3 +131,31 @@ shapes = Table(
         ["namespaces.id", "namespaces.organization_id"],
     ),
 )
+
+# Queries of shapes filter on the organization, live shapes and the geometry. The
+# organization is a btree_gist column of the spatial index so that a single index scan
+# serves the three conditions.
+Index(
+    "ix_shapes_organization_id_geom_live",
+    shapes.c.organization_id,
+    shapes.c.geom,
+    postgresql_using="gist",
+    postgresql_where=text("deleted_at IS NULL"),
+)
+
+# Index used to CLUSTER shapes, see app.db.maintenance. Shapes of an organization are
+# stored together, ordered along the space-filling curve of the geometry btree order.
+Index(
+    "ix_shapes_organization_id_centroid",
+    shapes.c.organization_id,
+    func.ST_Centroid(shapes.c.geom),
+)
+
+# Delta exports query the shapes of an organization updated since the last export, see
+# app.crud.shape_export. Shapes are soft deleted, and deletes also set updated_at, so
+# that delta exports have their tombstones.
+Index(
+    "ix_shapes_organization_id_updated_at",
+    shapes.c.organization_id,
+    shapes.c.updated_at,
+)
@@ -5,6 +5,7 @@ from alembic_utils.pg_trigger import PGTrigger
 __all__ = [
     "users_insert_trigger",
     "organizations_insert_trigger",
+    "shapes_geojson_trigger",
 ]
 entities = []
 
@@ -31,3 +32,18 @@ organizations_insert_trigger = PGTrigger(
     ),
 )
 entities.append(organizations_insert_trigger)
+
+shapes_geojson_trigger = PGTrigger(
+    schema="public",
+    signature="shapes_geojson_trigger",
+    on_entity="public.shapes",
+    is_constraint=False,
+    definition=dedent(
+        """
+        BEFORE INSERT OR UPDATE OF uuid, geom, properties, name ON public.shapes
+        FOR EACH ROW
+        EXECUTE FUNCTION set_shape_geojson()
+    """.strip()
+    ),
+)
+entities.append(shapes_geojson_trigger)
@@ -0,0 +1,146 @@
+"""Connection pools of the app database.
+
+Each API worker holds two pools of connections to the app database: the SQLAlchemy
+pool of :data:`app.db.engine.engine`, used by the CRUD routes, and the asyncpg pool
+used by the tiler. They are sized by ``engine_opts`` and ``tiler_pool_options``, and a
+worker opens at most :func:`max_connections` connections.
+
+To run more workers than the database accepts connections, put PgBouncer in front of
+it in transaction pooling mode and set ``pgbouncer``. Both pools then stay small
+client-side pools of PgBouncer connections.
+
+Both pools report the time spent waiting for a connection (``db.pool.wait_duration_s``)
+and the number of connections in use (``db.pool.connections_in_use``), tagged with
+the name of the pool. Long waits mean that a pool is too small for the load of the
+worker.
+
+The CRUD routes and their dependencies run in the AnyIO threadpool, and a connection
+is only returned to the pool once the teardown of its dependency runs in a thread. If
+every thread waited for a connection, no connection would be returned. So the
+threadpool has more threads than the SQLAlchemy pool has connections, see
+:func:`threadpool_size`, and waits for a connection time out after ``pool_timeout``
+seconds with a 503 response, see :func:`pool_timeout_handler`.
+"""
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
+
+import anyio.to_thread
+from buildpg import asyncpg
+from fastapi import Request, status
+from fastapi.responses import JSONResponse
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from app.core.config import Settings, get_tiler_settings
+from app.core.logging import get_logger
+from app.core.stats import stats
+
+logger = get_logger(__name__)
+
+
+def max_connections(settings: Settings) -> int:
+    """Return the maximum number of app database connections opened by an API worker."""
+    engine_opts = settings.engine_opts
+    return (
+        engine_opts.pool_size
+        + engine_opts.max_overflow
+        + settings.tiler_pool_options.db_max_conn_size
+    )
+
+
+DEFAULT_THREADPOOL_SIZE = 40
+"""Default number of threads of the AnyIO threadpool."""
+
+
+def threadpool_size(settings: Settings) -> int:
+    """Return the number of threads of the threadpool running sync routes.
+
+    It is twice the number of connections of the SQLAlchemy pool, so that threads
+    are left to return connections when as many threads wait for one.
+    """
+    engine_opts = settings.engine_opts
+    return max(
+        DEFAULT_THREADPOOL_SIZE, 2 * (engine_opts.pool_size + engine_opts.max_overflow)
+    )
+
+
+def set_threadpool_size(settings: Settings) -> None:
+    """Resize the threadpool to :func:`threadpool_size`. Call it in the event loop."""
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = threadpool_size(settings)
+
+
+async def pool_timeout_handler(request: Request, exc: PoolTimeoutError) -> JSONResponse:
+    """Return 503 when no connection of the app database is available in time."""
+    logger.warning(
+        "Timed out waiting for a database connection: %s",
+        exc,
+        extra={"request_path": request.url.path},
+    )
+    return JSONResponse(
+        {"detail": "The service is busy, retry later."},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": "1"},
+    )
+
+
+def _report_pool(name: str, wait_duration_s: float, in_use: int) -> None:
+    tags = [f"pool:{name}"]
+    stats.timing("db.pool.wait_duration_s", wait_duration_s, tags=tags)
+    stats.gauge("db.pool.connections_in_use", in_use, tags=tags)
+
+
+class TimedQueuePool(QueuePool):
+    """SQLAlchemy queue pool reporting the time spent waiting for connections."""
+
+    name = "app"
+
+    def _do_get(self) -> Any:
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            _report_pool(self.name, time.perf_counter() - start, self.checkedout())
+
+
+async def create_tiler_pool(settings: Settings) -> asyncpg.BuildPgPool:
+    """Create the asyncpg pool of the tiler.
+
+    This replaces :func:`timvt.db.connect_to_db`, which does not accept connection
+    options.
+    """
+    tiler_settings = get_tiler_settings()
+    connect_kwargs = {}
+    if settings.pgbouncer:
+        # PgBouncer in transaction mode does not keep named prepared statements
+        # between transactions
+        connect_kwargs["statement_cache_size"] = 0
+    logger.info(
+        "Each API worker uses up to %d app database connections.",
+        max_connections(settings),
+    )
+    return await asyncpg.create_pool_b(
+        tiler_settings.database_url,
+        min_size=tiler_settings.db_min_conn_size,
+        max_size=tiler_settings.db_max_conn_size,
+        max_queries=tiler_settings.db_max_queries,
+        max_inactive_connection_lifetime=tiler_settings.db_max_inactive_conn_lifetime,
+        **connect_kwargs,
+    )
+
+
+@asynccontextmanager
+async def acquire(
+    pool: asyncpg.BuildPgPool, name: str = "tiler"
+) -> AsyncIterator[asyncpg.BuildPgConnection]:
+    """Acquire a connection from an asyncpg pool, reporting the time waited."""
+    start = time.perf_counter()
+    conn = await pool.acquire()
+    _report_pool(
+        name, time.perf_counter() - start, pool.get_size() - pool.get_idle_size()
+    )
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
@@ -5,23 +5,21 @@ See `FastAPI dependency injection <https://fastapi.tiangolo.com/tutorial/depende
 import logging
 from functools import lru_cache
 from http import HTTPStatus
-from typing import Any, AsyncGenerator, Dict, Optional, Protocol, cast
+from typing import Any, Dict, Generator, Optional, cast
 
-import walrus
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPAuthorizationCredentials
-from pydantic import UUID4  # pylint: disable=no-name-in-module
-from sqlalchemy import text
 from sqlalchemy.engine import Connection, Engine
 
+from app.core.cache import Cache, get_cache, get_user_cache, user_org_key
 from app.core.config import Settings, get_settings
 from app.core.logging import get_logger
 from app.core.security import VerifyToken, token_auth_scheme
-from app.core.stats import time_db_query
 from app.crud.organization import get_active_organization
 from app.crud.user import create_or_update_user_from_bearer_data
-from app.db.app_user import set_app_user_id, set_app_user_org
+from app.db.app_user import set_app_user_settings
 from app.db.engine import engine
+from app.db.hooks import begin
 from app.db.osm import osm_engine
 from app.schemas import User, UserOrganization
 from app.schemas.organizations import Organization, StripeSubscriptionStatus
@@ -34,17 +32,51 @@ async def get_engine() -> Engine:
     return engine
 
 
-async def get_connection(
+async def get_request_body(
+    request: Request, settings: Settings = Depends(get_settings)
+) -> bytes:
+    """Return the raw request body, which sync routes cannot await.
+
+    Bodies larger than ``batch_query_max_bytes`` are rejected with a 413 error, from
+    their ``Content-Length`` if they have one, or as soon as they are read past it.
+    """
+    max_bytes = settings.batch_query_max_bytes
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > max_bytes:
+        raise HTTPException(
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            f"The request body is larger than {max_bytes} bytes.",
+        )
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(
+                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                f"The request body is larger than {max_bytes} bytes.",
+            )
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def get_connection(
     engine: Engine = Depends(get_engine),  # pylint: disable=redefined-outer-name
-) -> AsyncGenerator[Connection, None]:
-    """Yield a connection with an open transaction."""
-    # engine.begin() yields a connection and also opens a transaction.
-    # the context manager will close the connection and transaction
-    with engine.begin() as conn:
+) -> Generator[Connection, None, None]:
+    """Yield a connection with an open transaction.
+
+    Like the other dependencies using the database, this is not a coroutine so that
+    FastAPI runs it in its threadpool. The database driver is synchronous and would
+    block the event loop, which the tiler shares.
+    """
+    # begin() yields a connection and also opens a transaction.
+    # the context manager will close the connection and transaction, and then run
+    # callbacks registered with app.db.hooks.after_commit
+    with begin(engine) as conn:
         yield conn
 
 
-async def verify_token(
+def verify_token(
     token: HTTPAuthorizationCredentials = Depends(token_auth_scheme),
     settings: Settings = Depends(get_settings),
 ) -> Dict[str, Any]:
@@ -59,47 +91,14 @@ async def verify_token(
     return payload
 
 
-class Cache(Protocol):
-    """Abstract protocol for what methods a cache needs to contain."""
-
-    def set(self, key: Any, value: Any, timeout: Optional[Any] = None) -> Any:
-        ...
-
-    def get(self, key: Any, default: Optional[Any] = None) -> Any:
-        ...
-
-    def delete(self, key: Any) -> Any:
-        ...
-
-
-@lru_cache()
-def get_cache() -> Optional[Cache]:
-    settings = get_settings()
-    opts = settings.cache
-    conn = settings.redis_connection
-    if opts.enabled:
-        try:
-            db = walrus.Database(
-                host=conn.host,
-                port=conn.port,
-                db=int(conn.path[1:]) if conn.path else None,
-                password=conn.password,
-            )
-            cache: walrus.Cache = db.cache(default_timeout=opts.timeout)
-            return cache
-        except Exception as exc:  # pylint: disable=broad-except
-            logger.error("Error initializing the cache: %s", exc)
-    return None
-
-
 def _current_user_key_fn(sub_id: str) -> str:
     return f"app:cache:user_org:{sub_id}"
 
 
-async def get_current_user(
+def get_current_user(
     engine: Engine = Depends(get_engine),  # pylint: disable=redefined-outer-name
     auth_jwt_payload: Dict[str, Any] = Depends(verify_token),
-    cache: Optional[Cache] = Depends(get_cache),
+    cache: Optional[Cache] = Depends(get_user_cache),
 ) -> User:
     """Return the current user from the bearer token.
 
@@ -147,19 +146,15 @@ async def get_current_user(
     return cast(User, user)
 
 
-def _current_user_org_key_fn(user_id: int) -> str:
-    return f"app:cache:user_org:{user_id}"
-
-
-async def get_current_user_org(
+def get_current_user_org(
     engine: Engine = Depends(get_engine),  # pylint: disable=redefined-outer-name
     user: User = Depends(get_current_user),
-    cache: Optional[Cache] = Depends(get_cache),
+    cache: Optional[Cache] = Depends(get_user_cache),
 ) -> UserOrganization:
     user_id = user.id
     if user_id is None:
         raise HTTPException(403)
-    key = _current_user_org_key_fn(user_id)
+    key = user_org_key(user_id)
     org = None
     if cache:
         try:
@@ -191,28 +186,14 @@ class UserConnection(UserOrganization):
     connection: Connection
 
 
-def set_app_user_settings(conn: Connection, user_id: int, org_id: UUID4):
-    """Set up a SQLAlchemy session for RLS.
-
-    - Set role to `app_user`
-    - Set `app.user_id` setting to the ``user_id``
-    - Set `app.user_org` setting to the ``org_id``
-
-    """
-    with time_db_query("set_app_user_settings"):
-        conn.execute(text("SET LOCAL ROLE app_user"))
-    set_app_user_id(conn, user_id, local=True)
-    set_app_user_org(conn, org_id, local=True)
-
-
-async def get_app_user_connection(
+def get_app_user_connection(
     user_org: UserOrganization = Depends(get_current_user_org),
     conn=Depends(get_connection, use_cache=False),
 ) -> UserConnection:
     """Configure database session for an authorized user.
 
-    Adds a hook which inserts ``SET LOCAL app.user_id = :user_id``
-    at the start of each transaction.
+    Sets the role and the ``app.user_id`` and ``app.user_org`` settings used by RLS
+    locally to the transaction of the connection.
 
     """
     set_app_user_settings(conn, user_org.user.id, user_org.organization.id)
@@ -231,9 +212,9 @@ def get_osm_engine() -> Engine:
     return osm_engine
 
 
-async def get_osm_conn(
+def get_osm_conn(
     engine=Depends(get_osm_engine),  # pylint: disable=redefined-outer-name
-) -> AsyncGenerator[Connection, None]:
+) -> Generator[Connection, None, None]:
     """Return a connection to an OSM database."""
     # TODO: should we disallow writes to it?
     with engine.begin() as conn:
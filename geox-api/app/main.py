@@ -4,13 +4,15 @@ import logging
 
 from datadog import initialize
 from fastapi import FastAPI
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
 
 from app import routes
 from app.core.config import get_settings
 from app.core.logging import get_logger
-from app.core.stats import attach_stats_middleware, stats
+from app.core.stats import add_metrics_route, attach_stats_middleware, stats
+from app.db.pool import pool_timeout_handler, set_threadpool_size
 from app.tiler import add_tiler_routes
 
 logger = get_logger(__name__)
@@ -35,6 +37,7 @@ app = FastAPI(
             allow_credentials=True,
             allow_methods=["*"],
             allow_headers=["*"],
+            expose_headers=["ETag", "X-Next-Cursor"],
         ),
     ],
 )
@@ -55,10 +58,13 @@ for route in [
 
 add_tiler_routes(app)
 attach_stats_middleware(app)
+add_metrics_route(app)
+app.add_exception_handler(PoolTimeoutError, pool_timeout_handler)
 
 
 @app.on_event("startup")
 async def startup():
+    set_threadpool_size(settings)
     stats.start()
 
 
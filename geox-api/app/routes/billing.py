@@ -1,12 +1,12 @@
 # pylint: disable=too-many-locals
 import logging
-from typing import Optional
 
 import stripe
 from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import JSONResponse
 from sqlalchemy.engine import Engine
 
+from app.core.cache import invalidate_user_orgs
 from app.core.config import get_settings
 from app.core.logging import get_logger
 from app.crud.organization import (
@@ -18,12 +18,12 @@ from app.crud.organization import (
     update_payment_time,
     update_stripe_subscription_status,
 )
+from app.db.hooks import after_commit, begin
 from app.dependencies import (
-    Cache,
     UserConnection,
     get_app_user_connection,
-    get_cache,
     get_engine,
+    get_request_body,
     verify_token,
 )
 from app.schemas.common import BaseModel
@@ -46,7 +46,7 @@ class CheckoutSession(BaseModel):
 
 
 @router.post("/billing/create-checkout-session", dependencies=[Depends(verify_token)])
-async def create_checkout_session(
+def create_checkout_session(
     checkout_session: CheckoutSession,
     user_conn: UserConnection = Depends(get_app_user_connection),
 ) -> JSONResponse:
@@ -68,7 +68,7 @@ class BillingPortalSession(BaseModel):
 @router.post(
     "/billing/create-customer-portal-session", dependencies=[Depends(verify_token)]
 )
-async def create_customer_portal_session(
+def create_customer_portal_session(
     billing_portal_session: BillingPortalSession,
     user_conn: UserConnection = Depends(get_app_user_connection),
 ) -> JSONResponse:
@@ -90,17 +90,16 @@ async def create_customer_portal_session(
 
 
 @router.post("/billing/webhook", dependencies=[Depends(get_engine)])
-async def webhook_received(
+def webhook_received(
     request: Request,
+    request_data: bytes = Depends(get_request_body),
     engine: Engine = Depends(get_engine),
-    cache: Optional[Cache] = Depends(get_cache),
 ) -> JSONResponse:
     # To do development work on this webhook, you want to use the Stripe CLI
     # https://stripe.com/docs/stripe-cli
     # or use ngrok
     # See https://dashboard.stripe.com/webhooks/we_1LxitiEKpERrAtCsMdHGmOVq for the webhooks
     webhook_secret = settings.stripe_webhook_secret
-    request_data = await request.body()
 
     if not webhook_secret:
         raise HTTPException(status_code=400, detail="Webhook secret not configured")
@@ -122,9 +121,7 @@ async def webhook_received(
         # This event pairs a user ID with their subscription ID
         user_id = int(data["object"]["client_reference_id"])
 
-        with engine.begin() as conn:
-            if cache:
-                cache.delete(f"app:cache:user_org:{user_id}")
+        with begin(engine) as conn:
             subscription_id = str(data["object"]["subscription"])
             customer_id = str(data["object"]["customer"])
             org = get_active_organization(conn, user_id)
@@ -133,28 +130,25 @@ async def webhook_received(
                 add_stripe_customer(
                     conn, organization_id=org.id, stripe_customer_id=customer_id
                 )
+            after_commit(conn, lambda: invalidate_user_orgs([user_id]))
     elif event_type == "invoice.paid":
         # This event pairs a subscription ID with a payment time
-        with engine.begin() as conn:
+        with begin(engine) as conn:
             subscription_id = str(data["object"]["subscription"])
             # Clear cache for all users in the org
             org = get_org_by_subscription_id(conn, subscription_id)
             users = get_all_org_members(conn, org.id)
-            for u in users:
-                if cache:
-                    cache.delete(f"app:cache:user_org:{u.id}")
+            after_commit(conn, lambda: invalidate_user_orgs(u.id for u in users))
             update_payment_time(conn, stripe_sub_id=subscription_id)
             logging.info({"msg": "Payment succeeded."})
     elif event_type.startswith("customer.subscription."):
         # This event pairs a subscription ID with a trial end time
-        with engine.begin() as conn:
+        with begin(engine) as conn:
             subscription_id = str(data["object"]["id"])
             status = data["object"]["status"]
             org = get_org_by_subscription_id(conn, subscription_id)
             users = get_all_org_members(conn, org.id)
-            for u in users:
-                if cache:
-                    cache.delete(f"app:cache:user_org:{u.id}")
+            after_commit(conn, lambda: invalidate_user_orgs(u.id for u in users))
             update_stripe_subscription_status(
                 conn, stripe_sub_id=subscription_id, status=status
             )
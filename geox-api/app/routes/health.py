@@ -40,7 +40,7 @@ async def subscription_health() -> Dict[str, str]:
 
 
 @router.get("/db_health", tags=["health"])
-async def db_health(conn: Connection = Depends(get_connection)) -> JSONResponse:
+def db_health(conn: Connection = Depends(get_connection)) -> JSONResponse:
     try:
         res = conn.execute(text("SELECT 1")).scalar()
         assert res == 1
@@ -15,7 +15,7 @@ async def info(settings: Settings = Depends(get_settings)):
 
 
 @router.get("/current_user", include_in_schema=False)
-async def current_user(
+def current_user(
     user_connection: UserConnection = Depends(get_app_user_connection),
 ):
     """Retrieve information about the current authorized user."""
@@ -17,7 +17,7 @@ from app.crud.namespaces import (
     select_namespaces,
     update_namespace,
 )
-from app.crud.shape import select_shape_metadata
+from app.crud.shape import delete_many_shapes, select_shape_metadata
 from app.dependencies import (
     UserConnection,
     get_app_user_connection,
@@ -26,8 +26,6 @@ from app.dependencies import (
 )
 from app.schemas import Namespace, NamespaceCreate, NamespaceUpdate, RequestErrorModel
 from app.schemas.namespaces_api import NamespaceResponse
-from sqlalchemy import delete
-from app.db.metadata import shapes as shapes_tbl
 
 # from app.crud.namespaces import *
 
@@ -60,7 +58,7 @@ def _responses(*args):
     responses=_responses("NAMESPACE_EXISTS"),
     response_model=Namespace,
 )
-async def _post_namespaces(
+def _post_namespaces(
     namespace: NamespaceCreate,
     user_conn: UserConnection = Depends(get_app_user_connection),
 ) -> Namespace:
@@ -83,7 +81,7 @@ async def _post_namespaces(
     responses=_responses("NAMESPACE_DOES_NOT_EXIST"),
     response_model=NamespaceResponse,
 )
-async def _get_namespaces__namespace_id(
+def _get_namespaces__namespace_id(
     namespace_id: UUID4,
     user_conn: UserConnection = Depends(get_app_user_connection),
 ) -> NamespaceResponse:
@@ -98,7 +96,7 @@ async def _get_namespaces__namespace_id(
 
 
 @router.get("/geofencer/namespaces", response_model=List[NamespaceResponse])
-async def _get_namespaces(
+def _get_namespaces(
     # pylint: disable=redefined-builtin
     id: Optional[UUID4] = Query(default=None, title="ID of the namespace"),
     # pylint: enable=redefined-builtin
@@ -124,15 +122,21 @@ async def _get_namespaces(
     "/geofencer/namespaces/{namespace_id}/relationships/shapes",
     response_model=NamespaceResponse,
 )
-async def _patch_namespaces_shapes(
+def _patch_namespaces_shapes(
     reqBody: Dict[str, Any],
     namespace_id: UUID4 = Path(title="Namespace to edit"),
     user_conn: UserConnection = Depends(get_app_user_connection),
 ) -> Namespace:
     if "data" in reqBody and not reqBody['data']:
-        deleteStmt = delete(shapes_tbl).where(shapes_tbl.c.namespace_id == namespace_id)
         try:
-            user_conn.connection.execute(deleteStmt)
+            # Soft delete, so that delta exports include the deleted shapes
+            delete_many_shapes(
+                user_conn.connection,
+                user_id=user_conn.user.id,
+                namespace_id=namespace_id,
+                organization_id=user_conn.organization.id,
+                exclusive=True,
+            )
             namespace = NamespaceResponse.from_orm(get_namespace(user_conn.connection, namespace_id))
             return namespace
         except Exception:
@@ -147,7 +151,7 @@ async def _patch_namespaces_shapes(
     responses=_responses("NAMESPACE_DOES_NOT_EXIST", "NAMESPACE_EXISTS"),
     response_model=NamespaceResponse,
 )
-async def _patch_namespaces(
+def _patch_namespaces(
     data: NamespaceUpdate,
     namespace_id: UUID4 = Path(title="Namespace to edit"),
     user_conn: UserConnection = Depends(get_app_user_connection),
@@ -176,7 +180,7 @@ async def _patch_namespaces(
     status_code=204,
     responses=_responses("NAMESPACE_DOES_NOT_EXIST"),
 )
-async def _delete_namespaces(
+def _delete_namespaces(
     namespace_id: UUID4,
     user_conn: UserConnection = Depends(get_app_user_connection),
 ) -> None:
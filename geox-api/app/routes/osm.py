@@ -13,7 +13,7 @@ router = APIRouter(tags=["osm"])
 
 
 @router.get("/osm")
-async def get_shapes_from_osm(
+def get_shapes_from_osm(
     query: str, geographic_reference: str, conn: Connection = Depends(get_osm_conn)
 ) -> List[Feature]:
     """Get shapes from OSM by amenity."""
@@ -1,10 +1,17 @@
-from typing import List, Optional, Tuple
+from typing import List, Optional, Tuple, cast
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from pydantic import UUID4  # pylint: disable=no-name-in-module
 
 from app.core.datatypes import Latitude, Longitude
-from app.crud.shape import get_shape_metadata_matching_search, select_shape_metadata
+from app.core.responses import JSONArrayResponse
+from app.core.versions import etag_matches, get_etag, not_modified
+from app.crud.shape import (
+    decode_cursor,
+    encode_cursor,
+    get_shape_metadata_matching_search_json,
+    select_shape_metadata_json,
+)
 from app.dependencies import (
     UserConnection,
     get_app_user_connection,
@@ -35,13 +42,13 @@ def _get_shape_metadata__bbox(
     user_conn: UserConnection = Depends(get_app_user_connection),
     offset: int = Query(default=0, title="Item offset", ge=0),
     limit: int = Query(default=DEFAULT_LIMIT, title="Number of shapes to retrieve", ge=1),
-) -> List[GeoShapeMetadata]:
+) -> Response:
     """Get shape metadata by bounding box."""
     bbox = ViewportBounds(min_x=min_x, min_y=min_y, max_x=max_x, max_y=max_y)
-    shapes = list(
-        select_shape_metadata(user_conn.connection, bbox=bbox, limit=limit, offset=offset)
+    rows = select_shape_metadata_json(
+        user_conn.connection, bbox=bbox, limit=limit, offset=offset
     )
-    return shapes
+    return JSONArrayResponse([row.json for row in rows])
 
 
 @router.get(
@@ -54,12 +61,12 @@ def _get_shape_metadata__search(
     offset: int = Query(default=0, title="Item offset", ge=0),
     limit: int = Query(default=DEFAULT_LIMIT, title="Number of shapes to retrieve", ge=1),
     user_conn: UserConnection = Depends(get_app_user_connection),
-) -> List[GeoShapeMetadata]:
+) -> Response:
     """Get shape metadata by bounding box."""
-    shapes = get_shape_metadata_matching_search(
+    shapes = get_shape_metadata_matching_search_json(
         user_conn.connection, query, limit, offset
     )
-    return shapes
+    return JSONArrayResponse(shapes)
 
 
 @router.get(
@@ -68,9 +75,18 @@ def _get_shape_metadata__search(
     tags=["shape-metadata"],
 )
 def _get_shape_metadata(
+    request: Request,
     user_conn: UserConnection = Depends(get_app_user_connection),
     # Query(default=0, title="Item offset", ge=0),
     offset: int = Query(default=0),
+    cursor: Optional[str] = Query(
+        default=None,
+        title="Pagination cursor",
+        description=(
+            "Return the shapes after this cursor. Use the `X-Next-Cursor` header of the "
+            "previous page. Unlike `offset`, it is fast for pages deep in the results."
+        ),
+    ),
     limit: int = Query(default=DEFAULT_LIMIT),
     user: Optional[bool] = Query(
         default=None,
@@ -82,8 +98,16 @@ def _get_shape_metadata(
     bbox: Optional[Tuple[Longitude, Latitude, Longitude, Latitude]] = Query(
         default=None, title="Bounding box (min x, min y, max x, max y)"
     ),
-) -> List[GeoShapeMetadata]:
-    """Get all shape metadata with pagination."""
+) -> Response:
+    """Get all shape metadata with pagination.
+
+    If the page is full, the `X-Next-Cursor` header has the cursor of the next page.
+
+    The response has an `ETag` header. Requests with a matching `If-None-Match`
+    header return 304 if no shapes in the organization (or in `namespace`) were
+    modified since.
+
+    """
     bbox_obj: Optional[ViewportBounds]
     if bbox:
         try:
@@ -92,15 +116,28 @@ def _get_shape_metadata(
             raise HTTPException(422, "Invalid bbox") from None
     else:
         bbox_obj = None
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as exc:
+        raise HTTPException(422, str(exc)) from None
     user_id = user_conn.user.id if user else None
-    return list(
-        select_shape_metadata(
-            user_conn.connection,
-            namespace_id=namespace,
-            limit=limit,
-            offset=offset,
-            created_by_user_id=user_id,
-            shape_id=shape_id,
-            bbox=bbox_obj,
-        )
+    etag = get_etag(
+        user_conn.organization.id, [namespace] if namespace else None, user_id
+    )
+    if etag_matches(request, etag):
+        return not_modified(cast(str, etag))
+    headers = {"ETag": etag} if etag else {}
+    rows = select_shape_metadata_json(
+        user_conn.connection,
+        namespace_id=namespace,
+        limit=limit,
+        offset=offset,
+        created_by_user_id=user_id,
+        shape_id=shape_id,
+        bbox=bbox_obj,
+        after=after,
     )
+    if len(rows) == limit:
+        headers["X-Next-Cursor"] = encode_cursor(rows[-1].uuid)
+    # Serialized by the database
+    return JSONArrayResponse([row.json for row in rows], headers=headers)
@@ -1,30 +1,64 @@
 """Shape routes."""
 import logging
-from typing import Any, Dict, List, Optional, Tuple, Union
-
-from fastapi import APIRouter, Depends, HTTPException, Path, Query, status
+import os
+import shutil
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union, cast
+from uuid import uuid4
+
+import s3fs
+from fastapi import (
+    APIRouter,
+    Body,
+    Depends,
+    File,
+    Form,
+    HTTPException,
+    Path,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+    status,
+)
+from fastapi.responses import StreamingResponse
 from geojson_pydantic import Feature, LineString, Point, Polygon
 from pydantic import UUID4  # pylint: disable=no-name-in-module
 
 from app.core.celery_app import celery_app
 from app.core.config import Settings, get_settings
-from app.core.datatypes import Latitude, Longitude
+from app.core.datatypes import Latitude, Longitude, ShapeFormat
 from app.core.logging import get_logger
+from app.core.responses import JSONArrayResponse
+from app.core.versions import etag_matches, get_etag, not_modified
 from app.crud import shape as crud
-from app.crud.namespaces import get_default_namespace
+from app.crud.namespaces import get_default_namespace, namespace_exists
 from app.crud.shape import (
     ShapeDoesNotExist,
-    create_many_shapes,
     create_shape,
+    decode_cursor,
     delete_many_shapes,
     delete_shape,
+    encode_cursor,
     get_shape,
-    select_shapes,
+    select_shapes_json,
+    stream_shape_features,
     update_shape,
 )
+from app.crud.shape_batch import (
+    BATCH_MEDIA_TYPES,
+    BatchOperation,
+    InvalidGeometriesError,
+    InvalidPointsError,
+    parse_geometries,
+    parse_points,
+    stream_shapes_containing_points,
+    stream_shapes_related_to_geoms,
+)
+from app.crud.shape_bulk import copy_many_shapes
 from app.dependencies import (
     UserConnection,
     get_app_user_connection,
+    get_request_body,
     verify_subscription,
     verify_token,
 )
@@ -40,7 +74,7 @@ from app.schemas import (
     ShapesDeletedResponse,
     ViewportBounds,
 )
-from app.worker import copy_to_s3
+from app.worker import copy_to_s3, import_path, import_shapes
 
 logger = get_logger(__name__)
 
@@ -62,8 +96,19 @@ def _responses(*args: str) -> Union[Dict[Union[int, str], Dict[str, Any]], None]
     return dict(_RESPONSES[key] for key in args)
 
 
+def _s3_upload_credentials(settings: Settings) -> Tuple[Optional[str], Optional[str]]:
+    aws_secret_access_key: Optional[str]
+    if settings.aws_s3_upload_secret_access_key:
+        aws_secret_access_key = (
+            settings.aws_s3_upload_secret_access_key.get_secret_value()
+        )
+    else:
+        aws_secret_access_key = None
+    return settings.aws_s3_upload_access_key_id, aws_secret_access_key
+
+
 def run_shapes_export(
-    user_conn: UserConnection, settings: Settings
+    user_conn: UserConnection, settings: Settings, snapshot: bool = False
 ) -> CeleryTaskResponse:
     org = user_conn.organization
     if not org.s3_export_enabled:
@@ -75,20 +120,14 @@ def run_shapes_export(
         raise HTTPException(
             status_code=501, detail="Data export is not configured."  # type: ignore
         )
-    aws_secret_access_key: Optional[str]
-    if settings.aws_s3_upload_secret_access_key:
-        aws_secret_access_key = (
-            settings.aws_s3_upload_secret_access_key.get_secret_value()
-        )
-    else:
-        aws_secret_access_key = None
-    aws_access_key_id = settings.aws_s3_upload_access_key_id
+    aws_access_key_id, aws_secret_access_key = _s3_upload_credentials(settings)
     task = copy_to_s3.delay(
         org.id,
         settings.aws_s3_url,
         aws_access_key_id=aws_access_key_id,
         aws_secret_access_key=aws_secret_access_key,
         app_env=settings.app_env,
+        snapshot=snapshot,
     )
     return CeleryTaskResponse(task_id=task.id)
 
@@ -113,6 +152,11 @@ def get_status(task_id: str) -> CeleryTaskResult:
     responses=_responses("SERVICE_MISSING_FROM_SERVER"),
 )
 def shapes_export(
+    snapshot: bool = Query(
+        False,
+        description="If true, export all shapes. Otherwise only the shapes changed "
+        "since the last export are exported, unless a snapshot is due.",
+    ),
     user_conn: UserConnection = Depends(get_app_user_connection),
     settings: Settings = Depends(get_settings),
 ) -> CeleryTaskResponse:
@@ -121,12 +165,89 @@ def shapes_export(
     This is an async task. Use `/tasks/results/{task_id}` to retrieve the status and results.
     """
     # Needs to go before /geofencer/shapes/{shape_id}
-    return run_shapes_export(user_conn, settings)
+    return run_shapes_export(user_conn, settings, snapshot=snapshot)
+
+
+@router.post(
+    "/geofencer/shapes/bulk/import",
+    response_model=CeleryTaskResponse,
+    responses=_responses("SERVICE_MISSING_FROM_SERVER"),
+)
+def bulk_import_shapes(
+    file: Optional[UploadFile] = File(
+        default=None,
+        description=(
+            "File with the shapes: newline delimited JSON (`.ndjson`, `.geojsonl`) with "
+            "a shape or GeoJSON feature per line, or JSON with a GeoJSON feature "
+            "collection or a list of shapes."
+        ),
+    ),
+    key: Optional[str] = Form(
+        default=None,
+        description="Key of a file already uploaded to the import prefix of the organization.",
+    ),
+    namespace: Optional[UUID4] = Query(default=None),
+    user_conn: UserConnection = Depends(get_app_user_connection),
+    settings: Settings = Depends(get_settings),
+) -> CeleryTaskResponse:
+    """Import many shapes from a file.
+
+    This is an async task. Use `/tasks/results/{task_id}` to retrieve the status and
+    progress: rows processed, rows failed and rows per second.
+    """
+    # Needs to go before /geofencer/shapes/{shape_id}
+    if settings.aws_s3_url is None:
+        raise HTTPException(
+            status_code=501, detail="Data import is not configured."  # type: ignore
+        )
+    if (file is None) == (key is None):
+        raise HTTPException(422, "Exactly one of file or key is required.")
+    if namespace and not namespace_exists(user_conn.connection, namespace):
+        raise HTTPException(404, f"Namespace {namespace} does not exist.")
+    org_id = str(user_conn.organization.id)
+    aws_access_key_id, aws_secret_access_key = _s3_upload_credentials(settings)
+    if file is not None:
+        # Keep the file extension, which determines the format
+        key = f"{uuid4()}/{os.path.basename(file.filename or '') or 'data.json'}"
+    try:
+        path = import_path(settings.aws_s3_url, org_id, cast(str, key))
+    except ValueError as exc:
+        raise HTTPException(422, str(exc)) from None
+    if file is not None:
+        fs = s3fs.S3FileSystem(key=aws_access_key_id, secret=aws_secret_access_key)
+        with fs.open(path.replace("s3://", ""), "wb") as f:
+            shutil.copyfileobj(file.file, f)
+    task = import_shapes.delay(
+        org_id,
+        user_conn.user.id,
+        path,
+        namespace_id=str(namespace) if namespace else None,
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key,
+    )
+    return CeleryTaskResponse(task_id=task.id)
 
 
-@router.post("/geofencer/shapes/bulk", response_model=ShapesCreatedResponse)
+@router.post(
+    "/geofencer/shapes/bulk",
+    response_model=ShapesCreatedResponse,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": {
+                        "type": "array",
+                        "items": {"$ref": "#/components/schemas/GeoShapeCreate"},
+                    }
+                }
+            },
+        }
+    },
+)
 def bulk_create_shapes(
-    data: List[GeoShapeCreate],
+    # Shapes are validated by copy_many_shapes, much faster than with pydantic
+    data: List[Any] = Body(...),
     user_conn: UserConnection = Depends(get_app_user_connection),
     namespace: Optional[UUID4] = Query(default=None),
     include_shapes: Optional[bool] = Query(
@@ -136,15 +257,16 @@ def bulk_create_shapes(
 ) -> ShapesCreatedResponse:
     """Create multiple shapes."""
     # Needs to go before /geofencer/shapes/{shape_id}
-    res = create_many_shapes(
+    res = copy_many_shapes(
         user_conn.connection,
         data,
         user_id=user_conn.user.id,
         organization_id=user_conn.organization.id,
         namespace_id=namespace,
+        include_shapes=bool(include_shapes),
     )
     return ShapesCreatedResponse(
-        num_shapes=len(res.shapes_created),
+        num_shapes=res.num_created,
         num_failed=len(res.shapes_failed),
         shapes_failed_indexes=res.shapes_failed,
         shapes=res.shapes_created if include_shapes else None,
@@ -199,21 +321,246 @@ def get_shapes_containing_point(
     return shapes
 
 
+def _stream_matches(
+    batches: Iterator[List[Tuple[int, str, Optional[float]]]]
+) -> Iterator[bytes]:
+    """Encode batches of matches of input indexes and shape IDs as NDJSON."""
+    for batch in batches:
+        yield "".join(
+            f'{{"index": {idx}, "uuid": "{uuid}"}}\n'
+            if distance is None
+            else f'{{"index": {idx}, "uuid": "{uuid}", "distance": {distance}}}\n'
+            for idx, uuid, distance in batch
+        ).encode()
+
+
+@router.post(
+    "/geofencer/shapes/op/contains/batch",
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "content": {"application/x-ndjson": {}},
+            "description": 'Newline delimited matches: `{"index": 0, "uuid": "..."}`.',
+        },
+        413: {"description": "Too many points, or request body too large."},
+        422: {"description": "Invalid points."},
+    },
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                media_type: {
+                    "schema": {
+                        "type": "array",
+                        "items": {
+                            "type": "array",
+                            "items": {"type": "number"},
+                            "minItems": 2,
+                            "maxItems": 2,
+                        },
+                    }
+                }
+                if media_type == "application/json"
+                else {}
+                for media_type in BATCH_MEDIA_TYPES
+            },
+        }
+    },
+)
+def get_shapes_containing_points(
+    request: Request,
+    data: bytes = Depends(get_request_body),
+    namespace_ids: Optional[List[UUID4]] = Query(
+        None,
+        description="Namespaces of the shapes. If not included, defaults to all namespaces.",
+    ),
+    user_conn: UserConnection = Depends(get_app_user_connection),
+    settings: Settings = Depends(get_settings),
+) -> StreamingResponse:
+    """Get the shapes containing each of many points.
+
+    The points are a JSON array of `[longitude, latitude]` positions, or an Arrow or
+    Parquet table with the columns `lng` and `lat`, as given by the `Content-Type`
+    header.
+
+    The response streams a match per point and shape containing it, with the index
+    of the point in the request and the ID of the shape. Matches are not sorted.
+
+    """
+    try:
+        points = parse_points(
+            data, request.headers.get("content-type", "application/json")
+        )
+    except InvalidPointsError as exc:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, str(exc)) from None
+    if len(points) > settings.batch_query_max_size:
+        raise HTTPException(
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            f"At most {settings.batch_query_max_size} points can be queried at once.",
+        )
+    batches = stream_shapes_containing_points(
+        user_conn.connection, points, namespace_ids=namespace_ids
+    )
+    return StreamingResponse(_stream_matches(batches), media_type="application/x-ndjson")
+
+
+@router.post(
+    "/geofencer/shapes/op/batch/{operation}",
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "content": {"application/x-ndjson": {}},
+            "description": (
+                'Newline delimited matches: `{"index": 0, "uuid": "..."}`, with the'
+                " `distance` in meters for `dwithin` and `nearest`."
+            ),
+        },
+        413: {"description": "Too many geometries, or request body too large."},
+        422: {"description": "Invalid geometries."},
+    },
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                media_type: {
+                    "schema": {
+                        "type": "array",
+                        "items": {"type": "object", "description": "GeoJSON geometry"},
+                    }
+                }
+                if media_type == "application/json"
+                else {}
+                for media_type in BATCH_MEDIA_TYPES
+            },
+        }
+    },
+)
+def get_shapes_related_to_geoms(
+    request: Request,
+    operation: BatchOperation,
+    data: bytes = Depends(get_request_body),
+    distance: Optional[float] = Query(
+        None, ge=0, description="Distance in meters. Required by `dwithin`."
+    ),
+    limit: Optional[int] = Query(
+        None,
+        ge=1,
+        description=(
+            "Maximum number of shapes matched per geometry. "
+            "Defaults to 1 for `nearest`, and to all shapes otherwise."
+        ),
+    ),
+    namespace_ids: Optional[List[UUID4]] = Query(
+        None,
+        description="Namespaces of the shapes. If not included, defaults to all namespaces.",
+    ),
+    user_conn: UserConnection = Depends(get_app_user_connection),
+    settings: Settings = Depends(get_settings),
+) -> StreamingResponse:
+    """Get the shapes related to each of many geometries.
+
+    The geometries are a JSON array of GeoJSON geometries or features, or an Arrow or
+    Parquet table with a WKB column `geometry`, as given by the `Content-Type` header.
+
+    The response streams a match per geometry and shape related to it, with the index
+    of the geometry in the request and the ID of the shape. The nearest shapes of a
+    geometry are ordered by distance, other matches are not sorted.
+
+    """
+    if operation == BatchOperation.dwithin and distance is None:
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY, "dwithin requires a distance."
+        )
+    try:
+        geoms = parse_geometries(
+            data, request.headers.get("content-type", "application/json")
+        )
+    except InvalidGeometriesError as exc:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, str(exc)) from None
+    if len(geoms) > settings.batch_query_max_size:
+        raise HTTPException(
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            f"At most {settings.batch_query_max_size} geometries can be queried at once.",
+        )
+    batches = stream_shapes_related_to_geoms(
+        user_conn.connection,
+        operation,
+        geoms,
+        namespace_ids=namespace_ids,
+        distance=distance,
+        limit=limit,
+    )
+    return StreamingResponse(_stream_matches(batches), media_type="application/x-ndjson")
+
+
 @router.get("/geofencer/shapes/{shape_id}", response_model=GeoShape)
 def _get_shapes__shape_id(
+    request: Request,
+    response: Response,
     shape_id: UUID4,  # = Path(title="ID of the shape to get."),
     user_conn: UserConnection = Depends(get_app_user_connection),
-) -> GeoShape:
-    """Read a shape."""
+) -> Union[GeoShape, Response]:
+    """Read a shape.
+
+    The response has an `ETag` header. Requests with a matching `If-None-Match`
+    header return 304 if no shapes were modified since.
+
+    """
+    etag = get_etag(user_conn.organization.id)
+    if etag_matches(request, etag):
+        return not_modified(cast(str, etag))
     try:
         shape = get_shape(user_conn.connection, shape_id)
     except ShapeDoesNotExist as exc:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail=str(exc)) from None
+    if etag:
+        response.headers["ETag"] = etag
     return shape
 
 
-@router.get("/geofencer/shapes", response_model=List[GeoShape])
+_STREAM_MEDIA_TYPES = {
+    ShapeFormat.ndjson: "application/x-ndjson",
+    ShapeFormat.geojson_stream: "application/geo+json",
+}
+
+
+def _shape_format(request: Request, format_: Optional[ShapeFormat]) -> ShapeFormat:
+    if format_ is not None:
+        return format_
+    if "application/x-ndjson" in request.headers.get("accept", ""):
+        return ShapeFormat.ndjson
+    return ShapeFormat.json
+
+
+def _stream_features(
+    batches: Iterator[List[str]], format_: ShapeFormat
+) -> Iterator[bytes]:
+    """Encode batches of GeoJSON features as NDJSON or as a feature collection."""
+    if format_ == ShapeFormat.ndjson:
+        for batch in batches:
+            yield "".join(f"{feature}\n" for feature in batch).encode()
+        return
+    yield b'{"type": "FeatureCollection", "features": ['
+    sep = ""
+    for batch in batches:
+        if batch:
+            yield (sep + ",".join(batch)).encode()
+            sep = ","
+    yield b"]}"
+
+
+@router.get(
+    "/geofencer/shapes",
+    response_model=List[GeoShape],
+    responses={
+        200: {
+            "content": {media_type: {} for media_type in _STREAM_MEDIA_TYPES.values()},
+            "description": "Shapes, or GeoJSON features if streamed.",
+        }
+    },
+)
 def _get_shapes(
+    request: Request,
     namespace: Optional[UUID4] = Query(
         default=None,
         title="Namespace of shapes",
@@ -226,12 +573,35 @@ def _get_shapes(
     ),
     user_conn: UserConnection = Depends(get_app_user_connection),
     offset: int = Query(default=0, title="Item offset", ge=0),
-    limit: int = Query(default=300, title="Number of shapes to retrieve", ge=1),
+    cursor: Optional[str] = Query(
+        default=None,
+        title="Pagination cursor",
+        description=(
+            "Return the shapes after this cursor. Use the `X-Next-Cursor` header of the "
+            "previous page. Unlike `offset`, it is fast for pages deep in the results."
+        ),
+    ),
+    limit: Optional[int] = Query(
+        default=None,
+        title="Number of shapes to retrieve",
+        description="Defaults to 300, or to all shapes if the response is streamed.",
+        ge=1,
+    ),
     shape_id: Optional[List[UUID4]] = Query(None, alias="id", title="List of shape IDs"),
     bbox: Optional[Tuple[Longitude, Latitude, Longitude, Latitude]] = Query(
         default=None, title="Bounding box (min x, min y, max x, max y)"
     ),
-) -> List[GeoShape]:
+    format_: Optional[ShapeFormat] = Query(
+        default=None,
+        alias="format",
+        title="Response format",
+        description=(
+            "`ndjson` streams newline delimited GeoJSON features and `geojson-stream` "
+            "streams a GeoJSON feature collection. Defaults to `ndjson` if the "
+            "`Accept` header is `application/x-ndjson`, and to `json` otherwise."
+        ),
+    ),
+) -> Response:
     """Read shapes.
 
     Will return 200 even if no shapes match the query, including the case in which the
@@ -239,6 +609,15 @@ def _get_shapes(
 
     All non-empty query parameters are combined with `AND`.
 
+    Streamed responses are serialized by the database and sent as they are read,
+    so they can be used to export all shapes of an organization.
+
+    If the page is full, the `X-Next-Cursor` header has the cursor of the next page.
+
+    The response has an `ETag` header, which depends on the format. Requests with a
+    matching `If-None-Match` header return 304 if no shapes in the organization (or
+    in `namespace`) were modified since.
+
     """
     bbox_obj: Optional[ViewportBounds]
     if bbox:
@@ -248,9 +627,26 @@ def _get_shapes(
             raise HTTPException(422, "Invalid bbox") from None
     else:
         bbox_obj = None
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as exc:
+        raise HTTPException(422, str(exc)) from None
     user_id = user_conn.user.id if user else None
-    return list(
-        select_shapes(
+    format_ = _shape_format(request, format_)
+    # The format can depend on the Accept header, so it is part of the ETag
+    etag = get_etag(
+        user_conn.organization.id,
+        [namespace] if namespace else None,
+        user_id,
+        format_.value,
+    )
+    headers = {"Vary": "Accept"}
+    if etag_matches(request, etag):
+        return not_modified(cast(str, etag), headers)
+    if etag:
+        headers["ETag"] = etag
+    if format_ in _STREAM_MEDIA_TYPES:
+        batches = stream_shape_features(
             user_conn.connection,
             created_by_user_id=user_id,
             namespace_id=namespace,
@@ -258,8 +654,28 @@ def _get_shapes(
             limit=limit,
             shape_id=shape_id,
             bbox=bbox_obj,
+            after=after,
         )
+        return StreamingResponse(
+            _stream_features(batches, format_),
+            media_type=_STREAM_MEDIA_TYPES[format_],
+            headers=headers,
+        )
+    limit = limit or 300
+    rows = select_shapes_json(
+        user_conn.connection,
+        created_by_user_id=user_id,
+        namespace_id=namespace,
+        offset=offset,
+        limit=limit,
+        shape_id=shape_id,
+        bbox=bbox_obj,
+        after=after,
     )
+    if len(rows) == limit:
+        headers["X-Next-Cursor"] = encode_cursor(rows[-1].uuid)
+    # Serialized by the database
+    return JSONArrayResponse([row.json for row in rows], headers=headers)
 
 
 # Update
@@ -0,0 +1,103 @@
+"""Benchmark the serialization of shapes in read routes.
+
+Compares the latency of the two ways read routes can build their responses, from the
+execution of the query to the bytes of the response body:
+
+- pydantic: select the columns of the shapes, parse each row into a model, then
+  validate and encode the response model, as FastAPI does for a route returning
+  models. See :func:`app.crud.shape.select_shapes`.
+- json: select rows serialized as JSON by the database with ``json_build_object``,
+  and join them, see :class:`app.core.responses.JSONArrayResponse` and
+  :func:`app.crud.shape.select_shapes_json`.
+
+Shapes are read as an existing user, so this needs the app database. Both methods
+read the same page of the user's shapes.
+
+Usage::
+
+    python -m app.scripts.benchmark_serialization USER_ID --rows 300 --repeat 20
+"""
+import asyncio
+import json
+import math
+import time
+from functools import partial
+from typing import Any, Callable, List
+
+import typer
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from sqlalchemy.engine import Connection
+
+from app.core.responses import JSONArrayResponse
+from app.crud.organization import get_active_organization
+from app.crud.shape import (
+    select_shape_metadata,
+    select_shape_metadata_json,
+    select_shapes,
+    select_shapes_json,
+)
+from app.db.app_user import set_app_user_settings
+from app.db.engine import engine
+from app.schemas import GeoShape, GeoShapeMetadata
+
+
+def _pydantic(
+    model: Any, select: Callable[..., Any], conn: Connection, limit: int
+) -> bytes:
+    field = create_response_field(name="response", type_=List[model])  # type: ignore
+    content = asyncio.run(
+        serialize_response(
+            field=field,
+            response_content=list(select(conn, limit=limit)),
+            is_coroutine=True,
+        )
+    )
+    return JSONResponse(content).body
+
+
+def _json(select: Callable[..., Any], conn: Connection, limit: int) -> bytes:
+    return JSONArrayResponse([row.json for row in select(conn, limit=limit)]).body
+
+
+def _time(func: Callable[[], Any], repeat: int) -> float:
+    """Return the best time of ``repeat`` runs."""
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(
+    user_id: int = typer.Argument(..., help="User reading the shapes."),
+    rows: int = typer.Option(300, help="Number of rows per response."),
+    repeat: int = typer.Option(20, help="Number of runs. The best one is reported."),
+) -> None:
+    """Print the per-row latency of reading shapes and shape metadata."""
+    with engine.begin() as conn:
+        organization_id = get_active_organization(conn, user_id).id
+        set_app_user_settings(conn, user_id, organization_id)
+        typer.echo(f"{'model':<20}{'method':<12}{'ms':>10}{'us/row':>10}")
+        for model, select, select_json in [
+            (GeoShape, select_shapes, select_shapes_json),
+            (GeoShapeMetadata, select_shape_metadata, select_shape_metadata_json),
+        ]:
+            pydantic = partial(_pydantic, model, select, conn, rows)
+            json_ = partial(_json, select_json, conn, rows)
+            # Both methods must return the same JSON
+            expected = json.loads(pydantic())
+            assert json.loads(json_()) == expected
+            num_rows = max(len(expected), 1)
+            for method, func in [("pydantic", pydantic), ("json", json_)]:
+                duration = _time(func, repeat)
+                typer.echo(
+                    f"{model.__name__:<20}{method:<12}{duration * 1e3:>10.2f}"
+                    f"{duration / num_rows * 1e6:>10.2f}"
+                )
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,133 @@
+"""Benchmark the latency of rendering shape tiles.
+
+Compares the two ways :class:`app.tiler.authorized_tile_function.AuthorizedTileFunction`
+has fetched tiles from the database:
+
+- transaction: render the query with buildpg, then run it in an explicit transaction
+  that is rolled back. This is three round trips per tile.
+- prepared: run the same query text with bound parameters, which asyncpg prepares
+  once per connection. This is one round trip per tile.
+
+Tiles are rendered for the shapes of an existing organization, so this needs the app
+database. The tile cache is not used.
+
+Usage::
+
+    python -m app.scripts.benchmark_tiles ORGANIZATION_ID --zoom 12 --repeat 5
+"""
+import asyncio
+import os
+import statistics
+import time
+from typing import Any, Awaitable, Callable, List
+from uuid import UUID
+
+import morecantile
+import typer
+from buildpg import Func, asyncpg, clauses, render
+
+from app.core.config import get_settings
+from app.db.pool import create_tiler_pool
+from app.tiler.authorized_tile_function import AuthorizedTileFunction
+from app.tiler.router import current_dir
+
+_TileFetcher = Callable[[asyncpg.BuildPgPool, morecantile.Tile], Awaitable[Any]]
+
+
+def _transaction(layer: AuthorizedTileFunction, organization_id: UUID) -> _TileFetcher:
+    """Fetch tiles as before the prepared statement path."""
+
+    async def fetch(pool: asyncpg.BuildPgPool, tile: morecantile.Tile) -> Any:
+        async with pool.acquire() as conn:
+            transaction = conn.transaction()
+            await transaction.start()
+            sql_query = clauses.Select(
+                Func(
+                    layer.function_name,
+                    ":z",
+                    ":x",
+                    ":y",
+                    ":filter_organization_id",
+                    ":namespace_ids",
+                ),
+            )
+            q, p = render(
+                str(sql_query),
+                x=tile.x,
+                y=tile.y,
+                z=tile.z,
+                filter_organization_id=str(organization_id),
+                namespace_ids=None,
+            )
+            content = await conn.fetchval(q, *p)
+            await transaction.rollback()
+        return content
+
+    return fetch
+
+
+def _prepared(layer: AuthorizedTileFunction, organization_id: UUID) -> _TileFetcher:
+    tms = morecantile.tms.get("WebMercatorQuad")
+
+    async def fetch(pool: asyncpg.BuildPgPool, tile: morecantile.Tile) -> Any:
+        return await layer.get_tile(pool, tile, tms, organization_id=organization_id)
+
+    return fetch
+
+
+def _percentile(values: List[float], q: int) -> float:
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+async def _run(
+    organization_id: UUID,
+    tiles: List[morecantile.Tile],
+    repeat: int,
+) -> None:
+    layer = AuthorizedTileFunction.from_file(
+        id="generate_shape_tile",
+        infile=os.path.join(current_dir, "generate_shape_tile.sql"),
+    )
+    pool = await create_tiler_pool(get_settings())
+    try:
+        typer.echo(f"{'method':<14}{'p50 ms':>10}{'p99 ms':>10}")
+        for method, fetch in [
+            ("transaction", _transaction(layer, organization_id)),
+            ("prepared", _prepared(layer, organization_id)),
+        ]:
+            # Warm up the connections and the database caches
+            for tile in tiles:
+                await fetch(pool, tile)
+            durations = []
+            for _ in range(repeat):
+                for tile in tiles:
+                    start = time.perf_counter()
+                    await fetch(pool, tile)
+                    durations.append((time.perf_counter() - start) * 1e3)
+            typer.echo(
+                f"{method:<14}{_percentile(durations, 50):>10.2f}"
+                f"{_percentile(durations, 99):>10.2f}"
+            )
+    finally:
+        await pool.close()
+
+
+def main(
+    organization_id: UUID = typer.Argument(..., help="Organization of the shapes."),
+    zoom: int = typer.Option(12, help="Zoom level of the tiles."),
+    bbox: str = typer.Option(
+        "-122.52,37.70,-122.35,37.83",
+        help="Bounds of the tiles as west,south,east,north in WGS84.",
+    ),
+    repeat: int = typer.Option(5, help="Number of times each tile is fetched."),
+) -> None:
+    """Print the p50 and p99 latencies of fetching tiles from the database."""
+    west, south, east, north = (float(x) for x in bbox.split(","))
+    tms = morecantile.tms.get("WebMercatorQuad")
+    tiles = list(tms.tiles(west, south, east, north, [zoom]))
+    typer.echo(f"{len(tiles)} tiles, {repeat} runs")
+    asyncio.run(_run(organization_id, tiles, repeat))
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -1,15 +1,21 @@
-from typing import Any
+from typing import Any, List
 
 import morecantile
-from buildpg import Func, asyncpg, clauses, render
+from buildpg import asyncpg
 from timvt import layer
 
 from app.core.stats import time_db_query
+from app.db.pool import acquire
 
 
 class AuthorizedTileFunction(layer.Function):
     """Custom Function Layer: SQL function takes xyz input and an organization ID"""
 
+    @property
+    def tile_query(self) -> str:
+        """Query of a tile, with the parameters z, x, y, organization ID and namespaces."""
+        return f"SELECT {self.function_name}($1, $2, $3, $4, $5)"
+
     async def get_tile(
         self,
         pool: asyncpg.BuildPgPool,
@@ -22,43 +28,41 @@ class AuthorizedTileFunction(layer.Function):
 
         We moved this to a db migration on Jan 9 2023, since we identified
         that the function was getting created/replaced needlessly
+
+        The query text is the same for every tile, so asyncpg prepares it once per
+        connection and keeps it in the statement cache of the connection. Each tile is
+        then a single round trip binding the parameters. The function is read-only, so
+        it does not need an explicit transaction.
         """
+        async with acquire(pool) as conn:
+            with time_db_query("get_tile_fetchval"):
+                content = await conn.fetchval(
+                    self.tile_query, *self.tile_params(tile, **kwargs)
+                )
 
-        async with pool.acquire() as conn:
-            transaction = conn.transaction()
-            await transaction.start()
+        return content
 
-            # with time_db_query("get_tile_sql"):
-            #     import time
-            #     start = time.time()
-            #     await conn.execute(self.sql)
-            #     end = time.time() - start
-            #     print(end)
+    def tile_params(self, tile: morecantile.Tile, **kwargs: Any) -> List[Any]:
+        """Return the parameters of :attr:`tile_query`."""
+        return [
+            tile.z,
+            tile.x,
+            tile.y,
+            str(kwargs["organization_id"]),
+            kwargs.get("namespace_ids"),
+        ]
 
-            sql_query = clauses.Select(
-                Func(
-                    self.function_name,
-                    ":z",
-                    ":x",
-                    ":y",
-                    ":filter_organization_id",
-                    ":namespace_ids",
-                ),
-            )
-            q, p = render(
-                str(sql_query),
-                x=tile.x,
-                y=tile.y,
-                z=tile.z,
-                filter_organization_id=str(kwargs["organization_id"]),
-                namespace_ids=kwargs.get("namespace_ids"),
-            )
 
-            # execute the query
-            with time_db_query("get_tile_fetchval"):
-                content = await conn.fetchval(q, *p)
+class NamespaceLayersTileFunction(AuthorizedTileFunction):
+    """Tile function with an MVT layer per namespace, named after the namespace ID.
 
-            # rollback
-            await transaction.rollback()
+    The ``properties`` keyword argument of :meth:`get_tile`, if given, is the list of
+    shape properties included in the tile.
+    """
 
-        return content
+    @property
+    def tile_query(self) -> str:
+        return f"SELECT {self.function_name}($1, $2, $3, $4, $5, $6)"
+
+    def tile_params(self, tile: morecantile.Tile, **kwargs: Any) -> List[Any]:
+        return super().tile_params(tile, **kwargs) + [kwargs.get("properties")]
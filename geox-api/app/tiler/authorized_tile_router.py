@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional, cast
 
 from fastapi import APIRouter, Depends, Query, Request, Response
 from morecantile.commons import Tile
@@ -9,8 +9,10 @@ from timvt.factory import TILE_RESPONSE_PARAMS
 from timvt.layer import Layer
 from timvt.resources.enums import MimeTypes
 
+from app.core.versions import etag_matches, get_etag, not_modified
 from app.dependencies import get_current_user_org, verify_token
 from app.schemas.user_organizations import UserOrganization
+from app.tiler.cache import TileCache, get_tile_cache, tile_variant
 
 router = APIRouter(tags=["geofencer"])
 
@@ -29,21 +31,47 @@ async def get_shape_tile(
         None,
         description="List of namespaces to query. If not included, defaults to all namespaces",
     ),
+    properties: Optional[List[str]] = Query(
+        None,
+        description="Shape properties included in the tile. If not included, defaults to all "
+        "properties. Only used by layers that support it, e.g. generate_namespace_layers_tile, "
+        "which returns a layer per namespace.",
+    ),
     tile: Tile = Depends(TileParams),
     tms: TileMatrixSet = Depends(TileMatrixSetParams),
     layer: Layer = Depends(LayerParams),
     # Can use get_current_user_org instead of get_user_connection because currently
     # the tiler uses a separate connection pool
     user_org: UserOrganization = Depends(get_current_user_org),
+    tile_cache: Optional[TileCache] = Depends(get_tile_cache),
 ):
     """Get a tile of shape."""
     org_id = user_org.organization.id
+    variant = tile_variant(layer.id, properties)
+    etag = get_etag(org_id, namespace_ids, variant)
+    if etag_matches(request, etag):
+        return not_modified(cast(str, etag))
+    headers = {"ETag": etag} if etag else None
+
+    if tile_cache:
+        content = tile_cache.get(org_id, namespace_ids, tile.z, tile.x, tile.y, variant)
+        if content is not None:
+            return Response(content, media_type=MimeTypes.pbf.value, headers=headers)
+
     pool = request.app.state.pool
-    kwargs = {"organization_id": org_id, "namespace_ids": namespace_ids}
+    kwargs = {
+        "organization_id": org_id,
+        "namespace_ids": namespace_ids,
+        "properties": properties,
+    }
 
-    content = await layer.get_tile(pool, tile, tms, **kwargs)
+    content = bytes(await layer.get_tile(pool, tile, tms, **kwargs))
+    # Do not cache the tile if shapes were written while it was rendered, since
+    # it may contain data from before the write.
+    if tile_cache and get_etag(org_id, namespace_ids, variant) == etag:
+        tile_cache.set(org_id, namespace_ids, tile.z, tile.x, tile.y, content, variant)
 
-    return Response(bytes(content), media_type=MimeTypes.pbf.value)
+    return Response(content, media_type=MimeTypes.pbf.value, headers=headers)
 
 
 # SUPPORT CENSUS DEMO
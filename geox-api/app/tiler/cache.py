@@ -0,0 +1,395 @@
+"""Cache of rendered MVT tiles.
+
+Tiles are cached per organization, set of namespaces, variant (layer and properties)
+and z/x/y. Each organization
+also has an index of its cached tiles, a Redis sorted set updated atomically, so that
+a write to shapes only evicts the tiles that intersect the bounding box of the
+geometries it touched.
+
+The tiles are stored in the app cache (Redis), so that all workers, including the
+Celery workers writing shapes, share the same tiles and invalidations. Tiles are not
+cached when the app cache is unavailable.
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Protocol,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import redis
+from pydantic import UUID4  # pylint: disable=no-name-in-module
+
+from app.core.cache import Cache, get_cache, get_redis
+from app.core.config import get_settings
+from app.core.logging import get_logger
+from app.core.stats import count_cache_lookup
+
+logger = get_logger(__name__)
+
+BBox = Tuple[float, float, float, float]
+"""Bounding box (min x, min y, max x, max y) in WGS84 coordinates."""
+
+
+def tile_bounds(z: int, x: int, y: int) -> BBox:
+    """Return the WGS84 bounding box of a Web Mercator tile."""
+    n = 2.0**z
+
+    def lng(x_: float) -> float:
+        return x_ / n * 360.0 - 180.0
+
+    def lat(y_: float) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y_ / n))))
+
+    return (lng(x), lat(y + 1), lng(x + 1), lat(y))
+
+
+def tiles_in_bbox(bbox: BBox, z: int) -> Iterator[Tuple[int, int, int]]:
+    """Yield the z/x/y of the Web Mercator tiles of zoom ``z`` intersecting ``bbox``."""
+    n = 2**z
+
+    def tile_x(lng: float) -> int:
+        return min(max(int((lng + 180.0) / 360.0 * n), 0), n - 1)
+
+    def tile_y(lat: float) -> int:
+        # Web Mercator is bounded at about 85.0511 degrees
+        lat = min(max(lat, -85.0511287798), 85.0511287798)
+        y_ = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n
+        return min(max(int(y_), 0), n - 1)
+
+    min_x, min_y, max_x, max_y = bbox
+    for x in range(tile_x(min_x), tile_x(max_x) + 1):
+        # y increases southward
+        for y in range(tile_y(max_y), tile_y(min_y) + 1):
+            yield z, x, y
+
+
+def bbox_intersects(a: BBox, b: BBox) -> bool:
+    """Check whether two bounding boxes intersect (edges included)."""
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def bbox_union(bboxes: Iterable[Optional[Sequence[float]]]) -> Optional[BBox]:
+    """Return the bounding box containing all bounding boxes, ignoring missing ones."""
+    out: Optional[List[float]] = None
+    for bbox in bboxes:
+        if bbox is None or any(v is None for v in bbox):
+            continue
+        if out is None:
+            out = [float(v) for v in bbox[:4]]
+        else:
+            out = [
+                min(out[0], bbox[0]),
+                min(out[1], bbox[1]),
+                max(out[2], bbox[2]),
+                max(out[3], bbox[3]),
+            ]
+    return cast_bbox(out)
+
+
+def cast_bbox(value: Optional[Sequence[float]]) -> Optional[BBox]:
+    """Convert a sequence of four numbers to a :data:`BBox`."""
+    if value is None:
+        return None
+    return (float(value[0]), float(value[1]), float(value[2]), float(value[3]))
+
+
+def _namespace_key(namespace_ids: Optional[Sequence[UUID4]]) -> str:
+    if not namespace_ids:
+        return "all"
+    ids = ",".join(sorted({str(x) for x in namespace_ids}))
+    return hashlib.md5(ids.encode()).hexdigest()
+
+
+def tile_variant(layer_id: str, properties: Optional[Sequence[str]] = None) -> str:
+    """Return the variant of a tile for :class:`TileCache`.
+
+    Args:
+        layer_id: ID of the tile function.
+        properties: Properties included in the tile, or ``None`` for all of them.
+
+    """
+    if properties is None:
+        return layer_id
+    names = ",".join(sorted(set(properties)))
+    return f"{layer_id}:{hashlib.md5(names.encode()).hexdigest()}"
+
+
+class TileIndex(Protocol):
+    """Index of the cached tiles of each organization.
+
+    Its operations are atomic, so that concurrent writes and invalidations do not
+    lose each other's changes. Tile keys are ordered by when they were added.
+    """
+
+    def add(self, index_key: str, tile_keys: Sequence[str], max_size: int) -> List[str]:
+        """Add tile keys to an index, and return the oldest keys over ``max_size``.
+
+        The returned keys are removed from the index.
+        """
+        ...
+
+    def keys(self, index_key: str) -> List[str]:
+        """Return the tile keys of an index."""
+        ...
+
+    def remove(self, index_key: str, tile_keys: Sequence[str]) -> int:
+        """Remove tile keys from an index, and return the number removed."""
+        ...
+
+
+class RedisTileIndex:
+    """:class:`TileIndex` of Redis sorted sets, scored by the time tiles were added.
+
+    Args:
+        database: Redis client, e.g. from :func:`app.core.cache.get_redis`.
+        timeout: Timeout of tiles in seconds. Keys of tiles older than that are
+            pruned from the index when keys are added. ``0`` means no timeout.
+
+    """
+
+    def __init__(self, database: redis.Redis, timeout: int = 0) -> None:
+        self.database = database
+        self.timeout = timeout
+
+    def add(self, index_key: str, tile_keys: Sequence[str], max_size: int) -> List[str]:
+        now = time.time()
+        # MULTI/EXEC, so that the set is trimmed to the keys just added
+        pipe = self.database.pipeline()
+        if self.timeout:
+            pipe.zremrangebyscore(index_key, "-inf", now - self.timeout)
+        pipe.zadd(index_key, {key: now for key in tile_keys})
+        pipe.zrange(index_key, 0, -(max_size + 1))
+        pipe.zremrangebyrank(index_key, 0, -(max_size + 1))
+        evicted = pipe.execute()[-2]
+        return [_decode(key) for key in evicted]
+
+    def keys(self, index_key: str) -> List[str]:
+        return [_decode(key) for key in self.database.zrange(index_key, 0, -1)]
+
+    def remove(self, index_key: str, tile_keys: Sequence[str]) -> int:
+        if not tile_keys:
+            return 0
+        return int(self.database.zrem(index_key, *tile_keys))
+
+
+class MemoryTileIndex:
+    """In-process :class:`TileIndex`, for tests."""
+
+    def __init__(self) -> None:
+        self._indexes: Dict[str, "OrderedDict[str, None]"] = {}
+        self._lock = threading.Lock()
+
+    def add(self, index_key: str, tile_keys: Sequence[str], max_size: int) -> List[str]:
+        with self._lock:
+            index = self._indexes.setdefault(index_key, OrderedDict())
+            for key in tile_keys:
+                index[key] = None
+                index.move_to_end(key)
+            evicted = list(index)[: max(len(index) - max_size, 0)]
+            for key in evicted:
+                del index[key]
+            return evicted
+
+    def keys(self, index_key: str) -> List[str]:
+        with self._lock:
+            return list(self._indexes.get(index_key, ()))
+
+    def remove(self, index_key: str, tile_keys: Sequence[str]) -> int:
+        with self._lock:
+            index = self._indexes.get(index_key, OrderedDict())
+            removed = 0
+            for key in tile_keys:
+                if key in index:
+                    del index[key]
+                    removed += 1
+            return removed
+
+
+def _decode(key: Union[bytes, str]) -> str:
+    return key.decode() if isinstance(key, bytes) else key
+
+
+def _tile_zxy(tile_key: str) -> Tuple[int, int, int]:
+    """Return the z/x/y of a tile key of :class:`TileCache`."""
+    z, x, y = tile_key.rsplit(":", 1)[-1].split("/")
+    return int(z), int(x), int(y)
+
+
+class TileCache:
+    """Rendered tiles of an organization, evicted by bounding box.
+
+    Args:
+        cache: Key-value store of the tiles.
+        index: Index of the tiles of each organization.
+        timeout: Timeout of tiles in seconds. ``0`` means no timeout.
+        max_tiles_per_organization: Maximum size of an organization's index.
+            The oldest tiles are evicted first.
+
+    """
+
+    def __init__(
+        self,
+        cache: Cache,
+        index: TileIndex,
+        timeout: int = 3600,
+        max_tiles_per_organization: int = 10000,
+    ) -> None:
+        self.cache = cache
+        self.index = index
+        self.timeout = timeout
+        self.max_tiles_per_organization = max_tiles_per_organization
+
+    @staticmethod
+    def _index_key(organization_id: UUID4) -> str:
+        return f"app:cache:tile_index:{organization_id}"
+
+    @staticmethod
+    def _tile_key(
+        organization_id: UUID4,
+        namespace_ids: Optional[Sequence[UUID4]],
+        z: int,
+        x: int,
+        y: int,
+        variant: str = "",
+    ) -> str:
+        prefix = f"app:cache:tile:{organization_id}:{_namespace_key(namespace_ids)}"
+        if variant:
+            prefix = f"{prefix}:{variant}"
+        return f"{prefix}:{z}/{x}/{y}"
+
+    def get(
+        self,
+        organization_id: UUID4,
+        namespace_ids: Optional[Sequence[UUID4]],
+        z: int,
+        x: int,
+        y: int,
+        variant: str = "",
+    ) -> Optional[bytes]:
+        """Return a cached tile, or ``None`` if it is not cached.
+
+        ``variant`` distinguishes different tiles of the same z/x/y, see
+        :func:`tile_variant`.
+        """
+        key = self._tile_key(organization_id, namespace_ids, z, x, y, variant)
+        try:
+            content = self.cache.get(key)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Tile cache error: %s", exc)
+            count_cache_lookup("tiles", "error")
+            return None
+        count_cache_lookup("tiles", "miss" if content is None else "hit")
+        return content
+
+    def set(
+        self,
+        organization_id: UUID4,
+        namespace_ids: Optional[Sequence[UUID4]],
+        z: int,
+        x: int,
+        y: int,
+        content: bytes,
+        variant: str = "",
+    ) -> None:
+        """Cache a tile and add it to the organization's index."""
+        self.set_many(organization_id, namespace_ids, [(z, x, y, content)], variant)
+
+    def set_many(
+        self,
+        organization_id: UUID4,
+        namespace_ids: Optional[Sequence[UUID4]],
+        tiles: Sequence[Tuple[int, int, int, bytes]],
+        variant: str = "",
+    ) -> None:
+        """Cache tiles, given as z/x/y and content, with a single index update."""
+        if not tiles:
+            return
+        keys = [
+            self._tile_key(organization_id, namespace_ids, z, x, y, variant)
+            for z, x, y, _ in tiles
+        ]
+        try:
+            # Tiles are indexed before they are stored, so that an invalidation
+            # never misses a stored tile.
+            evicted = set(
+                self.index.add(
+                    self._index_key(organization_id),
+                    keys,
+                    self.max_tiles_per_organization,
+                )
+            )
+            for key in evicted:
+                self.cache.delete(key)
+            for key, (_, _, _, content) in zip(keys, tiles):
+                if key not in evicted:
+                    self.cache.set(key, bytes(content), self.timeout)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Tile cache error: %s", exc)
+
+    def invalidate(self, organization_id: UUID4, bbox: Optional[BBox] = None) -> int:
+        """Evict the cached tiles of an organization.
+
+        Args:
+            organization_id: Organization whose tiles are evicted.
+            bbox: Only tiles intersecting this bounding box are evicted. If ``None``,
+                then all of the organization's tiles are evicted.
+
+        Returns:
+            Number of tiles evicted.
+
+        """
+        index_key = self._index_key(organization_id)
+        try:
+            evicted = [
+                key
+                for key in self.index.keys(index_key)
+                if bbox is None or bbox_intersects(tile_bounds(*_tile_zxy(key)), bbox)
+            ]
+            removed = self.index.remove(index_key, evicted)
+            for key in evicted:
+                self.cache.delete(key)
+            return removed
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Tile cache error: %s", exc)
+            return 0
+
+
+@lru_cache()
+def get_tile_cache() -> Optional[TileCache]:
+    """Return the tile cache, or ``None`` if tile caching is disabled."""
+    opts = get_settings().tile_cache
+    if not opts.enabled:
+        return None
+    cache, database = get_cache(), get_redis()
+    if cache is None or database is None:
+        # An in-process cache would not see the invalidations of other processes
+        logger.info("The app cache is unavailable, tiles are not cached.")
+        return None
+    return TileCache(
+        cache,
+        RedisTileIndex(database, timeout=opts.timeout),
+        timeout=opts.timeout,
+        max_tiles_per_organization=opts.max_tiles_per_organization,
+    )
+
+
+def invalidate_tiles(organization_id: UUID4, bbox: Optional[BBox] = None) -> None:
+    """Evict an organization's cached tiles intersecting ``bbox``.
+
+    This is a no-op if tile caching is disabled.
+    """
+    tile_cache = get_tile_cache()
+    if tile_cache is not None:
+        tile_cache.invalidate(organization_id, bbox)
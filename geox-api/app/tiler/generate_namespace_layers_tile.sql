@@ -0,0 +1,78 @@
+/**
+ * Called by authorized_tile_function.py for multi-layer tiles: each namespace is a
+ * separate MVT layer named after the namespace ID, so that a map of several
+ * namespaces needs a single tile request and table scan per z/x/y.
+ * If property_names is not NULL, only these properties are included in the tile.
+ * Dev note: On hot-reloading for FastAPI, you'll have to restart the server to see changes to this file
+ */
+
+CREATE OR REPLACE FUNCTION generate_namespace_layers_tile(
+    z INTEGER,
+    x INTEGER,
+    y INTEGER,
+    filter_organization_id UUID,
+    namespace_ids UUID[],
+    property_names TEXT[]
+)
+RETURNS bytea
+AS $$
+DECLARE
+    result bytea;
+BEGIN
+    WITH
+    bounds AS (
+      SELECT ST_TileEnvelope(z, x, y) AS geom
+    )
+    , mvtgeom AS (
+      -- Use the precomputed geometry simplified for the zoom level
+      SELECT ST_AsMVTGeom(
+        CASE
+          WHEN z <= 5 THEN sh.geom_3857_z5
+          WHEN z <= 9 THEN sh.geom_3857_z9
+          WHEN z <= 12 THEN sh.geom_3857_z12
+          ELSE sh.geom_3857
+        END
+        , bounds.geom
+      ) AS geom
+      , CASE
+          WHEN property_names IS NULL THEN sh.properties - '__uuid'
+          ELSE (
+            SELECT COALESCE(jsonb_object_agg(key, value), '{}'::JSONB)
+            FROM jsonb_each(sh.properties)
+            WHERE key = ANY(property_names) AND key <> '__uuid'
+          )
+        END AS properties
+      , sh.uuid AS "__uuid"
+      , sh.namespace_id AS "__namespace_id"
+      FROM public.shapes sh, bounds
+      WHERE 1=1
+        AND sh.organization_id = filter_organization_id
+        AND sh.deleted_at IS NULL
+        -- Bounding box test only: ST_AsMVTGeom() clips the geometries and returns
+        -- NULL for those outside of the tile
+        AND sh.geom && ST_Transform(bounds.geom, 4326)
+        -- If the namespace parameter is empty, get all data
+        AND COALESCE(sh.namespace_id = ANY(namespace_ids), TRUE)
+    )
+    , layers AS (
+      SELECT
+        mvtgeom."__namespace_id" AS namespace_id
+        , ST_AsMVT(mvtgeom.*, mvtgeom."__namespace_id"::TEXT) AS layer
+      FROM mvtgeom
+      WHERE mvtgeom.geom IS NOT NULL
+      GROUP BY mvtgeom."__namespace_id"
+    )
+    -- A tile with several layers is the concatenation of the layers
+    SELECT COALESCE(string_agg(layers.layer, ''::bytea ORDER BY layers.namespace_id), ''::bytea)
+    INTO result
+    FROM layers
+    ;
+
+    RETURN result
+    ;
+END;
+$$
+LANGUAGE 'plpgsql'
+STABLE
+PARALLEL SAFE
+;
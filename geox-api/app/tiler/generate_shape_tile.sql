@@ -20,7 +20,16 @@ BEGIN
       SELECT ST_TileEnvelope(z, x, y) AS geom
     )
     , mvtgeom AS (
-      SELECT ST_AsMVTGeom(ST_Transform(sh.geom, 3857), bounds.geom) AS geom
+      -- Use the precomputed geometry simplified for the zoom level
+      SELECT ST_AsMVTGeom(
+        CASE
+          WHEN z <= 5 THEN sh.geom_3857_z5
+          WHEN z <= 9 THEN sh.geom_3857_z9
+          WHEN z <= 12 THEN sh.geom_3857_z12
+          ELSE sh.geom_3857
+        END
+        , bounds.geom
+      ) AS geom
       , sh.properties - '__uuid' AS properties
       , sh.uuid AS "__uuid"
       , sh.namespace_id AS "__namespace_id"
@@ -28,13 +37,16 @@ BEGIN
       WHERE 1=1
         AND sh.organization_id = filter_organization_id
         AND sh.deleted_at IS NULL
-        AND ST_Intersects(sh.geom, ST_Transform(bounds.geom, 4326))
+        -- Bounding box test only: ST_AsMVTGeom() clips the geometries and returns
+        -- NULL for those outside of the tile
+        AND sh.geom && ST_Transform(bounds.geom, 4326)
 	-- If the namespace parameter is empty, get all data
 	AND COALESCE(namespace_id = ANY(namespace_ids), TRUE)
     )
     SELECT ST_AsMVT(mvtgeom.*)::bytea
     INTO result
     FROM mvtgeom
+    WHERE mvtgeom.geom IS NOT NULL
     ;
 
     RETURN result
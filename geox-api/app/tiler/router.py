@@ -1,19 +1,23 @@
 import os
 
 from fastapi import Depends, FastAPI
-from timvt.db import close_db_connection, connect_to_db, register_table_catalog
+from timvt.db import close_db_connection, register_table_catalog
 from timvt.layer import FunctionRegistry
 
-from app.core.config import get_tiler_settings
+from app.core.config import get_settings
+from app.db.pool import create_tiler_pool
 from app.dependencies import verify_token
-from app.tiler.authorized_tile_function import AuthorizedTileFunction
+from app.tiler.authorized_tile_function import (
+    AuthorizedTileFunction,
+    NamespaceLayersTileFunction,
+)
 from app.tiler.authorized_tile_router import router
 
 current_dir = os.path.dirname(__file__)
 
 
 def add_tiler_routes(app: FastAPI) -> None:
-    """Note: Uses a separate async Postgres connection"""
+    """Note: Uses a separate async Postgres connection pool, see app.db.pool"""
     # Add Function registry to the application state
     app.state.timvt_function_catalog = FunctionRegistry()
 
@@ -23,8 +27,7 @@ def add_tiler_routes(app: FastAPI) -> None:
     @app.on_event("startup")
     async def startup_event():
         """Application startup: register the database connection and create table list."""
-        pg_settings = get_tiler_settings()
-        await connect_to_db(app, pg_settings)  # noqa
+        app.state.pool = await create_tiler_pool(get_settings())
         await register_table_catalog(app)
 
     @app.on_event("shutdown")
@@ -38,5 +41,11 @@ def add_tiler_routes(app: FastAPI) -> None:
             infile=os.path.join(current_dir, "generate_shape_tile.sql"),
         )
     )
+    app.state.timvt_function_catalog.register(
+        NamespaceLayersTileFunction.from_file(
+            id="generate_namespace_layers_tile",
+            infile=os.path.join(current_dir, "generate_namespace_layers_tile.sql"),
+        )
+    )
 
     app.include_router(router, tags=["tiles"])
@@ -1,16 +1,41 @@
 """Celery worker."""
-from functools import lru_cache
-from typing import Any, Dict, Optional, cast
-from uuid import UUID, uuid4
+import datetime
+import itertools
+import json
+import time
+from functools import lru_cache, partial
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from uuid import UUID
 
-import geopandas as gpd
+import ijson
+import psycopg2
+import pyarrow as pa
 import s3fs
+from celery import Task
 from celery.utils.log import get_task_logger
 from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
 
 from app.core.celery_app import celery_app
 from app.core.config import get_settings
 from app.core.datatypes import AppEnvEnum
+from app.core.versions import get_etag
+from app.crud.shape_bulk import copy_many_shapes
+from app.crud.shape_export import (
+    MANIFEST_NAME,
+    export_manifest,
+    get_export_state,
+    get_export_time,
+    new_export_id,
+    next_export,
+    save_export_state,
+    stream_export_batches,
+    write_partitioned_geoparquet,
+)
+from app.db.app_user import set_app_user_settings
+from app.db.hooks import begin
+from app.db.maintenance import cluster_shapes as cluster_shapes_table
+from app.tiler.cache import BBox, cast_bbox, get_tile_cache, tile_variant, tiles_in_bbox
 
 _settings = get_settings()
 
@@ -38,85 +63,52 @@ def get_postgres_engine():
     return create_engine(postgres_connection_url, pool_pre_ping=True, future=True, **opts)
 
 
-def send_data_to_s3(
-    df: gpd.GeoDataFrame,
-    organization_id: str,
+def export_path(
     aws_s3_url: str,
-    aws_access_key_id: Optional[str] = None,
-    aws_secret_access_key: Optional[str] = None,
+    organization_id: str,
+    export_id: str,
     app_env: AppEnvEnum = AppEnvEnum.dev,
 ) -> str:
-    """Send data to S3.
-
-    Returns:
-        Output path in S3 of the files written.
-    """
+    """Return the S3 directory of the files of an export, without the S3 protocol."""
     # if app-env is development the organization_id is ignored in the S3
     # output path ignored and result goes to a fake UUID path on S3.
     if app_env == AppEnvEnum.dev:
         organization_id = str(UUID(int=0))
-    rnd = str(uuid4())[:6]
-    now = df["exported_at"][0]
-    export_id = (
-        f"{now.year}/{now.month:02d}/{now.day:02d}/{now.hour:02d}/{now.minute:02d}/"
-        f"{now.second:02d}/{now.microsecond:06d}/{rnd}"
-    )
-    df["export_id"] = export_id
-    path = (
-        f"{aws_s3_url}export/shapes/{organization_id}/{export_id}/data.parquet"
-    ).replace("s3://", "")
-    fs = s3fs.S3FileSystem(key=aws_access_key_id, secret=aws_secret_access_key)
-    # fs.open() does not need the S3 protocol so remove it from the path
-    with fs.open(path, "wb") as f:
-        df.to_parquet(
-            f,
-            index=False,
-            compression="snappy",
-            engine="pyarrow",
-        )
-    return path
+    path = f"{aws_s3_url}export/shapes/{organization_id}/{export_id}/"
+    return path.replace("s3://", "")
 
 
-def query_shapes_table(
-    organization_id: str,
-) -> gpd.GeoDataFrame:
-    engine = get_postgres_engine()
-    with engine.begin() as conn:
-        logger.debug(f"Copy shapes for {organization_id}")
-        # TODO: save as geoparquet with geopandas
-        query = text(
-            """
-                SELECT
-                    s.uuid :: TEXT AS uuid,
-                    s.name,
-                    -- WKB Format in WG84 projection
-                    s.geom,
-                    -- to avoid certain issues writing to parquet it is easier to
-                    -- save the object as a string
-                    s.properties::TEXT AS properties,
-                    -- ensure that there is no timezone
-                    s.created_at::TIMESTAMP AS created_at,
-                    s.updated_at::TIMESTAMP AS updated_at,
-                    s.deleted_at::TIMESTAMP AS deleted_at,
-                    (now() at time zone 'utc')::TIMESTAMP AS exported_at,
-                    s.organization_id :: TEXT AS organization_id,
-                    s.namespace_id :: TEXT AS namespace_id,
-                    n.name :: TEXT AS namespace_name,
-                    n.slug :: TEXT AS namespace_slug
-                FROM shapes AS s
-                INNER JOIN namespaces AS n
-                ON TRUE
-                    AND s.namespace_id = n.id
-                    AND n.organization_id = :organization_id
-                    AND s.organization_id = :organization_id
-                    AND s.deleted_at IS NULL
-                ORDER BY s.uuid
-                """
-        )
-        df = gpd.read_postgis(
-            query, conn, geom_col="geom", params={"organization_id": organization_id}
-        )
-        return cast(gpd.GeoDataFrame, df)
+def send_data_to_s3(
+    batches: Iterable[pa.RecordBatch],
+    path: str,
+    make_manifest: Callable[[List[Dict[str, Any]]], Dict[str, Any]],
+    aws_access_key_id: Optional[str] = None,
+    aws_secret_access_key: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Send data to S3 as GeoParquet files partitioned by namespace.
+
+    Files are uploaded in parts as batches are written, so only a part and a batch
+    are in memory at a time. The manifest is written once all files are.
+
+    Args:
+        path: S3 directory of the files.
+        make_manifest: Return the manifest of the export from its files, see
+            :func:`app.crud.shape_export.export_manifest`.
+
+    Returns:
+        The manifest of the export.
+    """
+    fs = s3fs.S3FileSystem(key=aws_access_key_id, secret=aws_secret_access_key)
+    # fs.open() does not need the S3 protocol so remove it from the path
+    files = write_partitioned_geoparquet(
+        lambda name: fs.open(f"{path}{name}", "wb"),
+        batches,
+        max_file_size=_settings.export_max_file_size,
+    )
+    manifest = make_manifest(files)
+    with fs.open(f"{path}{MANIFEST_NAME}", "w") as f:
+        json.dump(manifest, f)
+    return manifest
 
 
 @celery_app.task(acks_late=True)
@@ -126,6 +118,7 @@ def copy_to_s3(
     aws_access_key_id: Optional[str] = None,
     aws_secret_access_key: Optional[str] = None,
     app_env: AppEnvEnum = AppEnvEnum.dev,
+    snapshot: bool = False,
 ) -> Dict[str, Any]:
     """
     Copy data from postgres shapes into S3.
@@ -135,6 +128,10 @@ def copy_to_s3(
     1. Export shapes from the organization in the App to S3
     2. Copy shapes from S3 into Snowflake
 
+    Exports are incremental, see :mod:`app.crud.shape_export`. Only the shapes changed
+    since the previous export are exported, except for every
+    ``export_snapshot_every``-th export, which is a snapshot of all shapes.
+
     Args:
         organization_id: Organization ID - only shapes from that organization are extracted.
         app_db_connection_url: Connection URL for the app database. The workers run in a seperate processes
@@ -142,26 +139,420 @@ def copy_to_s3(
         aws_s3_url: S3 url where shape files will go(``s3://bucket-name/path/to/place/files/``)
         aws_access_key_id:. AWS access key to be able to write to ``aws_s3_url``.
         aws_secret_access_key (Optional[str], optional): AWS access key to be able to write to ``aws_s3_url``.
+        snapshot: If true, export a snapshot even if a delta is due.
     Returns:
-        Dict[str, Any]: A dictionary with the number of shapes written.
+        Dict[str, Any]: A dictionary with the number of shapes written and the type of
+        the export.
     """
-    df = query_shapes_table(organization_id)
-    # NOTE: Exiting if no shapes are exported means that if there were shapes exported,
-    # and the user deleted all shapes, then those shapes would not be deleted. Is this the
-    # desired behavior? Not sure.
-    num_rows = df.shape[0]
-    if num_rows:
-        output_path = send_data_to_s3(
-            df,
+    engine = get_postgres_engine()
+    # The server-side cursor of the query needs a transaction. The export state stays
+    # locked until the file is written, and is only saved if it is.
+    with engine.begin() as conn:
+        logger.debug(f"Copy shapes for {organization_id}")
+        state = get_export_state(conn, organization_id)
+        export_type, since = next_export(
+            state, _settings.export_snapshot_every, snapshot=snapshot
+        )
+        exported_at = get_export_time(conn)
+        export_id = new_export_id(exported_at)
+        # Shapes written by transactions still running are exported by the next export
+        exported_until = exported_at - datetime.timedelta(
+            seconds=_settings.export_overlap
+        )
+        if since is not None:
+            exported_until = max(exported_until, since)
+        batches = stream_export_batches(
+            conn,
             organization_id,
-            aws_s3_url,
+            exported_at,
+            export_id,
+            export_type=export_type,
+            since=since,
+            batch_size=_settings.export_batch_size,
+        )
+        first = next((x for x in batches if x.num_rows), None)
+        if first is None:
+            logger.debug("No changes, not exporting shapes to S3.")
+            save_export_state(conn, organization_id, exported_until)
+            return {"num_rows": 0, "export_type": export_type.value}
+        output_path = export_path(aws_s3_url, organization_id, export_id, app_env=app_env)
+        manifest = send_data_to_s3(
+            itertools.chain([first], batches),
+            output_path,
+            partial(
+                export_manifest, organization_id, export_id, export_type, exported_at
+            ),
             aws_access_key_id=aws_access_key_id,
             aws_secret_access_key=aws_secret_access_key,
-            app_env=app_env,
         )
-        logger.debug("Exported data to %s", output_path)
-    else:
-        logger.debug("No results, not exporting shapes to S3.")
+        save_export_state(
+            conn,
+            organization_id,
+            exported_until,
+            export_type=export_type,
+            export_id=export_id,
+        )
+    logger.debug(
+        "Exported %s to %s in %d files",
+        export_type.value,
+        output_path,
+        len(manifest["files"]),
+    )
     return {
-        "num_rows": num_rows,
+        "num_rows": manifest["num_rows"],
+        "export_type": export_type.value,
+        "num_files": len(manifest["files"]),
     }
+
+
+@celery_app.task(acks_late=True)
+def cluster_shapes() -> None:
+    """Reorder the shapes table, see :func:`app.db.maintenance.cluster_shapes`."""
+    cluster_shapes_table(get_postgres_engine(), _settings.shapes_cluster_lock_timeout)
+
+
+NDJSON_SUFFIXES = (".ndjson", ".jsonl", ".geojsonl", ".geojsons")
+"""Suffixes of files read as newline delimited JSON. Other files are read as JSON."""
+
+MAX_FAILED_RANGES = 1000
+"""Maximum number of ranges of failed shapes reported by :func:`import_shapes`."""
+
+
+def import_path(aws_s3_url: str, organization_id: str, key: str) -> str:
+    """Return the S3 path of a file to import for an organization.
+
+    Raises:
+        ValueError: ``key`` is not a relative path below the organization prefix.
+
+    """
+    if not key or key.startswith("/") or ".." in key.split("/"):
+        raise ValueError(f"Invalid import key: {key!r}")
+    return f"{aws_s3_url}import/shapes/{organization_id}/{key}"
+
+
+def _decode_shape(obj: Any) -> Any:
+    if isinstance(obj, (str, bytes)):
+        try:
+            return json.loads(obj)
+        except ValueError:
+            # invalid shape
+            return None
+    return obj
+
+
+def _read_json_items(f: IO[bytes]) -> Iterator[Any]:
+    """Stream the items of a JSON list, or the features of an object, from a file."""
+    _, event, _ = next(ijson.parse(f), (None, None, None))
+    f.seek(0)
+    if event == "start_array":
+        yield from ijson.items(f, "item", use_float=True)
+        return
+    has_features = False
+    for feature in ijson.items(f, "features.item", use_float=True):
+        has_features = True
+        yield feature
+    if not has_features:
+        # A single shape, or an empty feature collection: it is small
+        f.seek(0)
+        data = next(ijson.items(f, "", use_float=True))
+        if not (isinstance(data, dict) and data.get("type") == "FeatureCollection"):
+            yield data
+
+
+def read_shapes_file(f: IO[bytes], path: str) -> Iterator[Any]:
+    """Read shapes to import from a file.
+
+    The file is either newline delimited JSON, with one shape or GeoJSON feature per
+    line, or JSON with a GeoJSON feature collection or a list of shapes or features.
+    Both are read incrementally, so that large files are not held in memory. JSON
+    files must be seekable.
+
+    Shapes are only decoded. They are validated when they are inserted, see
+    :func:`app.crud.shape_bulk.parse_shapes`.
+
+    Yields:
+        Shapes, or ``None`` for lines that are not valid JSON.
+
+    """
+    items: Iterator[Any]
+    if path.lower().endswith(NDJSON_SUFFIXES):
+        items = (line for line in f if line.strip())
+    else:
+        items = _read_json_items(f)
+    for item in items:
+        yield _decode_shape(item)
+
+
+def add_failed_ranges(
+    ranges: List[List[int]], indexes: Iterable[int], max_ranges: int = MAX_FAILED_RANGES
+) -> bool:
+    """Add indexes to sorted ranges ``[first, last]`` of consecutive indexes.
+
+    Indexes must be greater than those already in ``ranges``.
+
+    Returns:
+        ``False`` if indexes were not added because there are ``max_ranges`` ranges.
+
+    """
+    for idx in sorted(indexes):
+        if ranges and ranges[-1][1] == idx - 1:
+            ranges[-1][1] = idx
+        elif len(ranges) < max_ranges:
+            ranges.append([idx, idx])
+        else:
+            return False
+    return True
+
+
+def _import_chunk(
+    chunk: List[Tuple[int, Any]],
+    organization_id: str,
+    user_id: int,
+    namespace_id: Optional[str],
+) -> Tuple[int, List[int]]:
+    """Insert a chunk of shapes in one transaction.
+
+    Returns:
+        The number of shapes created and the indexes of the shapes that failed.
+
+    """
+    try:
+        with begin(get_postgres_engine()) as conn:
+            set_app_user_settings(conn, user_id, UUID(organization_id))
+            res = copy_many_shapes(
+                conn,
+                [shape for _, shape in chunk],
+                user_id=user_id,
+                organization_id=UUID(organization_id),
+                namespace_id=UUID(namespace_id) if namespace_id else None,
+            )
+    except (SQLAlchemyError, psycopg2.Error) as exc:
+        # e.g. invalid geometries, or properties that are not valid JSONB, such as
+        # NaN, in COPY: the whole chunk is rolled back
+        logger.warning(
+            "Failed to import shapes %d-%d: %s", chunk[0][0], chunk[-1][0], exc
+        )
+        return 0, [idx for idx, _ in chunk]
+    return res.num_created, [chunk[i][0] for i in res.shapes_failed]
+
+
+@celery_app.task(bind=True, acks_late=True)
+def import_shapes(
+    self: Task,
+    organization_id: str,
+    user_id: int,
+    path: str,
+    namespace_id: Optional[str] = None,
+    aws_access_key_id: Optional[str] = None,
+    aws_secret_access_key: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Import shapes from a file in S3.
+
+    Shapes are inserted in chunks of ``bulk_import_chunk_size``, each in its own
+    transaction. The task state is ``PROGRESS`` while the shapes are imported, with
+    the same information as the result.
+
+    Args:
+        organization_id: Organization of the new shapes.
+        user_id: User creating the shapes. Row level security is enforced for this user.
+        path: S3 path of the file, see :func:`read_shapes_file` for the formats.
+        namespace_id: Namespace of shapes without a namespace. Defaults to the default
+            namespace of the organization.
+        aws_access_key_id: AWS access key to be able to read ``path``.
+        aws_secret_access_key: AWS secret access key to be able to read ``path``.
+
+    Returns:
+        Dict[str, Any]: The number of rows processed, created and failed, the ranges
+        ``[first, last]`` of indexes of the rows that failed, and the throughput in rows
+        per second. At most :data:`MAX_FAILED_RANGES` ranges are reported, and
+        ``failed_ranges_truncated`` is true if there are more.
+
+    """
+    start = time.monotonic()
+    progress: Dict[str, Any] = {
+        "rows_processed": 0,
+        "rows_created": 0,
+        "rows_failed": 0,
+        "failed_ranges": [],
+        "failed_ranges_truncated": False,
+        "rows_per_second": 0.0,
+    }
+    fs = s3fs.S3FileSystem(key=aws_access_key_id, secret=aws_secret_access_key)
+    with fs.open(path.replace("s3://", ""), "rb") as f:
+        shapes = enumerate(read_shapes_file(f, path))
+        while chunk := list(itertools.islice(shapes, _settings.bulk_import_chunk_size)):
+            num_created, failed = _import_chunk(
+                chunk, organization_id, user_id, namespace_id
+            )
+            progress["rows_processed"] += len(chunk)
+            progress["rows_created"] += num_created
+            progress["rows_failed"] += len(failed)
+            if not add_failed_ranges(progress["failed_ranges"], failed):
+                progress["failed_ranges_truncated"] = True
+            elapsed = time.monotonic() - start
+            progress["rows_per_second"] = progress["rows_processed"] / elapsed
+            self.update_state(state="PROGRESS", meta=progress)
+            logger.debug("Imported %d shapes to %s", progress["rows_processed"], path)
+    if progress["rows_created"] and _settings.tile_cache.seed_after_import:
+        seed_tiles.delay(organization_id)
+    return progress
+
+
+TILE_QUERIES = {
+    "generate_shape_tile": (
+        "SELECT generate_shape_tile(:z, :x, :y, CAST(:organization_id AS UUID), "
+        "CAST(:namespace_ids AS UUID[]))"
+    ),
+    "generate_namespace_layers_tile": (
+        "SELECT generate_namespace_layers_tile(:z, :x, :y, "
+        "CAST(:organization_id AS UUID), CAST(:namespace_ids AS UUID[]), NULL)"
+    ),
+}
+"""Queries of the tile functions that can be pre-rendered, by layer ID.
+
+These render the same tiles as :mod:`app.tiler.authorized_tile_function`.
+"""
+
+
+def query_shapes_extent(
+    organization_id: str, namespace_ids: Optional[List[str]] = None
+) -> Optional[BBox]:
+    """Return the bounding box of an organization's shapes, or ``None`` if it has none."""
+    engine = get_postgres_engine()
+    query = text(
+        """
+        SELECT ST_XMin(extent), ST_YMin(extent), ST_XMax(extent), ST_YMax(extent)
+        FROM (
+            SELECT ST_Extent(geom) AS extent
+            FROM shapes
+            WHERE organization_id = :organization_id
+                AND deleted_at IS NULL
+                AND COALESCE(namespace_id = ANY(CAST(:namespace_ids AS UUID[])), TRUE)
+        ) AS shapes_extent
+        """
+    )
+    params = {"organization_id": organization_id, "namespace_ids": namespace_ids}
+    with engine.connect() as conn:
+        row = conn.execute(query, params).first()
+    if row is None or row[0] is None:
+        return None
+    return cast_bbox(row)
+
+
+SEED_BATCH_SIZE = 100
+"""Number of tiles pre-rendered by :func:`seed_tiles` between writes to the cache."""
+
+
+@celery_app.task(acks_late=True)
+def seed_all_tiles() -> int:
+    """Pre-render the tiles of every organization with shapes, see :func:`seed_tiles`.
+
+    Returns:
+        int: The number of organizations whose tiles are pre-rendered.
+
+    """
+    if get_tile_cache() is None:
+        logger.info("The tile cache is disabled, not seeding tiles.")
+        return 0
+    query = text("SELECT DISTINCT organization_id FROM shapes WHERE deleted_at IS NULL")
+    with get_postgres_engine().connect() as conn:
+        organization_ids = [str(x) for x in conn.execute(query).scalars()]
+    for organization_id in organization_ids:
+        seed_tiles.delay(organization_id)
+    return len(organization_ids)
+
+
+@celery_app.task(acks_late=True)
+def seed_tiles(
+    organization_id: str,
+    namespace_ids: Optional[List[str]] = None,
+    layer: str = "generate_shape_tile",
+    min_zoom: Optional[int] = None,
+    max_zoom: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Pre-render the tiles of an organization's shapes into the tile cache.
+
+    Tiles covering the extent of the shapes are rendered from the lowest zoom level
+    up, until ``seed_max_tiles`` tiles are rendered. Tiles already cached are kept.
+    This runs after imports (see ``seed_after_import``), and for all organizations on
+    the schedule ``seed_schedule``, see :func:`seed_all_tiles`.
+
+    Rendered tiles are cached in batches of :data:`SEED_BATCH_SIZE`, each with a
+    single update of the organization's tile index. A batch is dropped if the shapes
+    are written while it is rendered.
+
+    Args:
+        organization_id: Organization of the shapes.
+        namespace_ids: Namespaces of the tiles, as in the ``namespace_ids`` query
+            parameter of the tile route. Defaults to all namespaces.
+        layer: Tile function, one of :data:`TILE_QUERIES`.
+        min_zoom: Lowest zoom level. Defaults to ``seed_min_zoom``.
+        max_zoom: Highest zoom level. Defaults to ``seed_max_zoom``.
+
+    Returns:
+        Dict[str, Any]: The number of tiles rendered and cached, of tiles already
+        cached, and of tiles dropped because the shapes were written.
+
+    """
+    opts = _settings.tile_cache
+    result = {"tiles_rendered": 0, "tiles_cached": 0, "tiles_dropped": 0}
+    tile_cache = get_tile_cache()
+    if tile_cache is None:
+        logger.info("The tile cache is disabled, not seeding tiles.")
+        return result
+    if layer not in TILE_QUERIES:
+        raise ValueError(f"Tiles of layer {layer!r} cannot be pre-rendered.")
+    bbox = query_shapes_extent(organization_id, namespace_ids)
+    if bbox is None:
+        logger.debug("No shapes, not seeding tiles.")
+        return result
+    min_zoom = opts.seed_min_zoom if min_zoom is None else min_zoom
+    max_zoom = opts.seed_max_zoom if max_zoom is None else max_zoom
+    # Seeding more tiles than an organization can cache would evict the first ones
+    max_tiles = min(opts.seed_max_tiles, tile_cache.max_tiles_per_organization)
+    tiles = itertools.islice(
+        itertools.chain.from_iterable(
+            tiles_in_bbox(bbox, z) for z in range(min_zoom, max_zoom + 1)
+        ),
+        max_tiles,
+    )
+    org_id = UUID(organization_id)
+    ns_ids = [UUID(x) for x in namespace_ids] if namespace_ids else None
+    variant = tile_variant(layer)
+    query = text(TILE_QUERIES[layer])
+    rendered: List[Tuple[int, int, int, bytes]] = []
+    batch_etag: Optional[str] = None
+
+    def cache_rendered() -> None:
+        # As in the tile route, do not cache tiles rendered during a write: the batch
+        # is dropped if the shapes changed since its first tile was rendered
+        if not rendered:
+            return
+        if get_etag(org_id, ns_ids, variant) == batch_etag:
+            tile_cache.set_many(org_id, ns_ids, rendered, variant)
+            result["tiles_rendered"] += len(rendered)
+        else:
+            result["tiles_dropped"] += len(rendered)
+        rendered.clear()
+
+    with get_postgres_engine().connect() as conn:
+        for z, x, y in tiles:
+            if tile_cache.get(org_id, ns_ids, z, x, y, variant) is not None:
+                result["tiles_cached"] += 1
+                continue
+            if not rendered:
+                batch_etag = get_etag(org_id, ns_ids, variant)
+            params = {
+                "z": z,
+                "x": x,
+                "y": y,
+                "organization_id": organization_id,
+                "namespace_ids": namespace_ids,
+            }
+            content = conn.execute(query, params).scalar()
+            rendered.append((z, x, y, bytes(content or b"")))
+            if len(rendered) >= SEED_BATCH_SIZE:
+                cache_rendered()
+    cache_rendered()
+    logger.debug("Seeded tiles for %s: %s", organization_id, result)
+    return result
@@ -0,0 +1,46 @@
+"""Test the in-process caches."""
+from typing import Any, Optional
+
+from app.core.cache import MemoryCache, TieredCache
+
+
+class _BrokenCache:
+    """Cache that is down."""
+
+    def get(self, key: Any, default: Optional[Any] = None) -> Any:
+        raise ConnectionError("down")
+
+    def set(self, key: Any, value: Any, timeout: Optional[Any] = None) -> Any:
+        raise ConnectionError("down")
+
+    def delete(self, key: Any) -> Any:
+        raise ConnectionError("down")
+
+
+def test_tiered_cache_reads_through() -> None:
+    remote = MemoryCache()
+    cache = TieredCache(MemoryCache(), remote)
+    remote.set("key", 1)
+    assert cache.get("key") == 1
+    # copied to the local cache
+    remote.delete("key")
+    assert cache.get("key") == 1
+
+
+def test_tiered_cache_delete() -> None:
+    remote = MemoryCache()
+    cache = TieredCache(MemoryCache(), remote)
+    cache.set("key", 1)
+    assert remote.get("key") == 1
+    assert cache.delete("key") == 1
+    assert cache.get("key") is None
+    assert remote.get("key") is None
+
+
+def test_tiered_cache_remote_down() -> None:
+    cache = TieredCache(MemoryCache(), _BrokenCache())
+    assert cache.get("key", "default") == "default"
+    assert not cache.set("key", 1)
+    assert cache.get("key") == 1
+    cache.delete("key")
+    assert cache.get("key") is None
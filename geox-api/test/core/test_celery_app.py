@@ -0,0 +1,13 @@
+"""Test the Celery beat schedule."""
+import pytest
+from celery.schedules import crontab
+
+from app.core.celery_app import parse_crontab
+
+
+def test_parse_crontab() -> None:
+    assert parse_crontab("0 4 * * sun") == crontab(
+        minute="0", hour="4", day_of_week="sun"
+    )
+    with pytest.raises(ValueError):
+        parse_crontab("0 4 * *")
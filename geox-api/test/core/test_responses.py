@@ -0,0 +1,16 @@
+"""Test responses serialized without pydantic."""
+import json
+
+from app.core.responses import JSONArrayResponse
+
+
+def test_json_array_response() -> None:
+    items = [{"a": 1}, {"b": [1, 2]}, None]
+    response = JSONArrayResponse([json.dumps(x) for x in items], headers={"ETag": '"1"'})
+    assert json.loads(response.body) == items
+    assert response.media_type == "application/json"
+    assert response.headers["ETag"] == '"1"'
+
+
+def test_json_array_response_empty() -> None:
+    assert json.loads(JSONArrayResponse([]).body) == []
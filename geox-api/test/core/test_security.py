@@ -0,0 +1,112 @@
+# pylint: disable=redefined-outer-name
+"""Test JWT verification caches."""
+import json
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from app.core.security import CachedJWKClient, VerifyToken
+
+_DOMAIN = "example.auth0.com"
+_AUDIENCE = "https://api.example.com"
+
+
+class _JWKClient(CachedJWKClient):
+    """JWKS client serving keys from memory, counting fetches."""
+
+    def __init__(self, keys: Dict[str, Any], **kwargs: Any) -> None:
+        super().__init__("https://example.com/jwks.json", **kwargs)
+        self.keys = keys
+        self.num_fetches = 0
+
+    def fetch_data(self) -> Any:
+        self.num_fetches += 1
+        return {"keys": [self._jwk(kid, key) for kid, key in self.keys.items()]}
+
+    @staticmethod
+    def _jwk(kid: str, key: rsa.RSAPrivateKey) -> Dict[str, Any]:
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(key.public_key()))
+        return {**jwk, "kid": kid, "use": "sig", "alg": "RS256"}
+
+
+def _key() -> rsa.RSAPrivateKey:
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def _token(key: rsa.RSAPrivateKey, kid: str, expires_in: float = 600) -> str:
+    payload = {
+        "sub": "auth0|1",
+        "aud": [_AUDIENCE],
+        "iss": f"https://{_DOMAIN}/",
+        "exp": int(time.time() + expires_in),
+    }
+    return jwt.encode(payload, key, algorithm="RS256", headers={"kid": kid})
+
+
+@pytest.fixture()
+def key() -> rsa.RSAPrivateKey:
+    return _key()
+
+
+def test_jwk_client_caches_keys(key: rsa.RSAPrivateKey) -> None:
+    client = _JWKClient({"a": key})
+    token = _token(key, "a")
+    for _ in range(3):
+        assert client.get_signing_key_from_jwt(token).key_id == "a"
+    assert client.num_fetches == 1
+
+
+def test_jwk_client_rotation(key: rsa.RSAPrivateKey) -> None:
+    client = _JWKClient({"a": key}, min_refresh_interval=0)
+    client.refresh()
+    client.keys = {"b": _key()}
+    assert client.get_signing_key("b").key_id == "b"
+    assert client.num_fetches == 2
+
+
+def test_jwk_client_unknown_key_rate_limited(key: rsa.RSAPrivateKey) -> None:
+    client = _JWKClient({"a": key}, min_refresh_interval=60)
+    client.refresh()
+    for _ in range(3):
+        with pytest.raises(jwt.PyJWKClientError):
+            client.get_signing_key("unknown")
+    assert client.num_fetches == 1
+
+
+def _verify(client: _JWKClient, tokens: List[str], timeout: int = 60) -> List[Any]:
+    settings = SimpleNamespace(
+        auth_domain=_DOMAIN,
+        auth_client_id="client-id",
+        auth_audience=_AUDIENCE,
+        auth_algorithms="RS256",
+        auth_jwks_lifespan=3600,
+        auth_token_cache_timeout=timeout,
+        auth_token_cache_maxsize=100,
+    )
+    results = []
+    for token in tokens:
+        verifier = VerifyToken(token, settings)  # type: ignore
+        verifier.jwks_client = client
+        results.append(verifier.verify())
+    return results
+
+
+def test_verify_token_cached(key: rsa.RSAPrivateKey) -> None:
+    client = _JWKClient({"a": key})
+    token = _token(key, "a")
+    payloads = _verify(client, [token, token])
+    assert payloads[0]["sub"] == payloads[1]["sub"] == "auth0|1"
+    # The cached payload is used even if the signing key is no longer available
+    client.keys = {"b": _key()}
+    client.refresh()
+    assert _verify(client, [token])[0]["sub"] == "auth0|1"
+
+
+def test_verify_token_expired_not_cached(key: rsa.RSAPrivateKey) -> None:
+    client = _JWKClient({"a": key})
+    token = _token(key, "a", expires_in=-10)
+    assert _verify(client, [token])[0]["status"] == "error"
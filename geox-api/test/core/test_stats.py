@@ -0,0 +1,99 @@
+"""Test the in-process metrics registry."""
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from pydantic import SecretStr  # pylint: disable=no-name-in-module
+
+from app.core import stats as stats_module
+from app.core.cache import MemoryCache, TieredCache
+from app.core.stats import MetricsRegistry, Stats
+
+
+def test_registry() -> None:
+    registry = MetricsRegistry(
+        namespace="geox_api", constant_tags=["env:test"], buckets=[0.1, 1.0]
+    )
+    registry.increment("db.num_queries", tags=["query_name:get_shapes"])
+    registry.increment("db.num_queries", tags=["query_name:get_shapes"])
+    registry.gauge("db.pool.connections_in_use", 3)
+    for value in [0.05, 0.5, 5.0]:
+        registry.timing("endpoints.request_duration_s", value, tags=['path:/a"b'])
+    get = registry.registry.get_sample_value
+    labels = {"env": "test", "query_name": "get_shapes"}
+    assert get("geox_api_db_num_queries_total", labels) == 2
+    assert get("geox_api_db_pool_connections_in_use", {"env": "test"}) == 3
+    labels = {"env": "test", "path": '/a"b'}
+    name = "geox_api_endpoints_request_duration_s"
+    assert get(f"{name}_bucket", {**labels, "le": "0.1"}) == 1
+    assert get(f"{name}_bucket", {**labels, "le": "1.0"}) == 2
+    assert get(f"{name}_bucket", {**labels, "le": "+Inf"}) == 3
+    assert get(f"{name}_sum", labels) == pytest.approx(5.55)
+    assert get(f"{name}_count", labels) == 3
+    text = registry.render().decode()
+    assert "# TYPE geox_api_endpoints_request_duration_s histogram" in text
+    assert 'geox_api_db_num_queries_total{env="test",query_name="get_shapes"} 2.0' in text
+
+
+def test_registry_labels() -> None:
+    registry = MetricsRegistry()
+    registry.increment("num_requests", tags=["path:/a"])
+    # The labels of a metric are those of its first use
+    registry.increment("num_requests", tags=["status:200"])
+    registry.increment("num_requests")
+    get = registry.registry.get_sample_value
+    assert get("num_requests_total", {"path": "/a"}) == 1
+    assert get("num_requests_total", {"path": ""}) == 2
+
+
+def test_stats_timer() -> None:
+    registry = MetricsRegistry()
+    with Stats(registry).timer("duration_s"):
+        pass
+    assert registry.registry.get_sample_value("duration_s_count") == 1
+
+
+def test_cache_lookups(monkeypatch) -> None:
+    registry = MetricsRegistry()
+    monkeypatch.setattr(stats_module, "stats", Stats(registry))
+    cache = TieredCache(MemoryCache(), name="users")
+    cache.set("key", "value")
+    cache.get("key")
+    cache.get("other")
+    get = registry.registry.get_sample_value
+    assert get("cache_num_lookups_total", {"cache": "users", "result": "local_hit"}) == 1
+    assert get("cache_num_lookups_total", {"cache": "users", "result": "miss"}) == 1
+
+
+def test_metrics_route(monkeypatch) -> None:
+    registry = MetricsRegistry()
+    registry.increment("num_requests")
+    monkeypatch.setattr(stats_module, "registry", registry)
+    settings = stats_module.settings.copy(update={"metrics_token": None})
+    monkeypatch.setattr(stats_module, "settings", settings)
+    app = FastAPI()
+    stats_module.add_metrics_route(app)
+    response = TestClient(app).get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "num_requests_total 1.0" in response.text
+
+
+def test_metrics_route_token(monkeypatch) -> None:
+    monkeypatch.setattr(stats_module, "registry", MetricsRegistry())
+    settings = stats_module.settings.copy(update={"metrics_token": SecretStr("secret")})
+    monkeypatch.setattr(stats_module, "settings", settings)
+    app = FastAPI()
+    stats_module.add_metrics_route(app)
+    client = TestClient(app)
+    assert client.get("/metrics").status_code == 401
+    headers = {"Authorization": "Bearer other"}
+    assert client.get("/metrics", headers=headers).status_code == 401
+    headers = {"Authorization": "Bearer secret"}
+    assert client.get("/metrics", headers=headers).status_code == 200
+
+
+def test_metrics_disabled(monkeypatch) -> None:
+    monkeypatch.setattr(stats_module, "registry", None)
+    app = FastAPI()
+    stats_module.add_metrics_route(app)
+    assert TestClient(app).get("/metrics").status_code == 404
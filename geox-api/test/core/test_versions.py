@@ -0,0 +1,50 @@
+# pylint: disable=redefined-outer-name
+"""Test edit versions and ETags."""
+import uuid
+
+import pytest
+from starlette.requests import Request
+
+from app.core.cache import MemoryCache
+from app.core.versions import EditVersions, etag_matches, make_etag, not_modified
+
+
+@pytest.fixture()
+def versions() -> EditVersions:
+    return EditVersions(MemoryCache(maxsize=100))
+
+
+def _request(if_none_match: str) -> Request:
+    headers = [(b"if-none-match", if_none_match.encode())]
+    return Request({"type": "http", "headers": headers})
+
+
+def test_bump(versions: EditVersions) -> None:
+    org_id = uuid.uuid4()
+    namespace_id = uuid.uuid4()
+    other_namespace_id = uuid.uuid4()
+    org_version = versions.get(org_id)
+    namespace_version = versions.get(org_id, [namespace_id])
+    other_namespace_version = versions.get(org_id, [other_namespace_id])
+    assert versions.get(org_id) == org_version
+    versions.bump(org_id, [namespace_id])
+    assert versions.get(org_id) != org_version
+    assert versions.get(org_id, [namespace_id]) != namespace_version
+    assert versions.get(org_id, [other_namespace_id]) == other_namespace_version
+
+
+def test_etag_matches() -> None:
+    etag = make_etag("a")
+    assert etag_matches(_request(etag), etag)
+    assert etag_matches(_request(f'"other", W/{etag}'), etag)
+    assert etag_matches(_request("*"), etag)
+    assert not etag_matches(_request('"other"'), etag)
+    assert not etag_matches(_request("*"), None)
+
+
+def test_not_modified() -> None:
+    etag = make_etag("a")
+    response = not_modified(etag, {"Vary": "Accept"})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.headers["Vary"] == "Accept"
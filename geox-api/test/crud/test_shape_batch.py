@@ -0,0 +1,311 @@
+# pylint: disable=redefined-outer-name
+"""Test batch spatial query helpers."""
+import io
+import json
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import shapely
+from geojson_pydantic import Polygon
+from sqlalchemy.engine import Connection
+
+from app.crud.namespaces import create_namespace
+from app.crud.organization import get_active_organization
+from app.crud.shape import create_shape
+from app.crud.shape_batch import (
+    BatchOperation,
+    InvalidGeometriesError,
+    InvalidPointsError,
+    _shapes_related_to_geoms_stmt,
+    _to_wkb,
+    parse_geometries,
+    parse_points,
+    stream_shapes_containing_points,
+    stream_shapes_related_to_geoms,
+)
+from app.crud.user import get_user_by_email
+from test.crud.common import get_alice_ids, insert_test_users_and_orgs, setup_app_user
+
+
+def test_parse_points_json() -> None:
+    positions = [[-122.26, 37.8], [-73.89, 40.9]]
+    points = parse_points(json.dumps(positions).encode())
+    np.testing.assert_array_equal(points, positions)
+    assert parse_points(b"[]", "application/json; charset=utf-8").shape == (0, 2)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [b"not json", b"{}", b"[1, 2]", b"[[1, 2, 3]]", b'[{"lng": 1}]', b"[[181, 0]]"],
+)
+def test_parse_points_invalid(data: bytes) -> None:
+    with pytest.raises(InvalidPointsError):
+        parse_points(data)
+
+
+def test_parse_points_media_type() -> None:
+    with pytest.raises(InvalidPointsError):
+        parse_points(b"-122.26,37.8", "text/csv")
+
+
+def test_to_wkb() -> None:
+    points = np.array([[-122.26, 37.8], [-73.89, 40.9]])
+    geoms = shapely.from_wkb(_to_wkb(shapely.points(points)))
+    assert [(p.x, p.y) for p in geoms] == [tuple(p) for p in points]
+
+
+def test_parse_geometries_json() -> None:
+    polygon = {
+        "type": "Polygon",
+        "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]],
+    }
+    point = {"type": "Point", "coordinates": [-122.26, 37.8]}
+    feature = {"type": "Feature", "geometry": point, "properties": {}}
+    geoms = parse_geometries(json.dumps([polygon, feature]).encode())
+    assert [g.geom_type for g in geoms] == ["Polygon", "Point"]
+    assert len(parse_geometries(b"[]")) == 0
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"not json",
+        b"{}",
+        b"[[1, 2]]",
+        b'[{"type": "Circle", "coordinates": [1, 2]}]',
+        b'[{"type": "Point", "coordinates": "a"}]',
+        b'[{"type": "Point", "coordinates": [1, 91]}]',
+        b'[{"type": "Polygon", "coordinates": []}]',
+    ],
+)
+def test_parse_geometries_invalid(data: bytes) -> None:
+    with pytest.raises(InvalidGeometriesError):
+        parse_geometries(data)
+
+
+def _to_bytes(table: pa.Table, media_type: str) -> bytes:
+    sink = io.BytesIO()
+    if media_type == "application/vnd.apache.parquet":
+        pq.write_table(table, sink)
+    elif media_type == "application/vnd.apache.arrow.file":
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    return sink.getvalue()
+
+
+_TABLE_MEDIA_TYPES = [
+    "application/vnd.apache.arrow.stream",
+    "application/vnd.apache.arrow.file",
+    "application/vnd.apache.parquet",
+]
+
+
+@pytest.mark.parametrize("media_type", _TABLE_MEDIA_TYPES)
+def test_parse_points_table(media_type: str) -> None:
+    # Several chunks, as in a table of several record batches
+    table = pa.concat_tables(
+        [
+            pa.table({"lng": [-122.26], "lat": [37.8]}),
+            pa.table({"lng": [-73.89], "lat": [40.9]}),
+        ]
+    )
+    points = parse_points(_to_bytes(table, media_type), media_type)
+    np.testing.assert_array_equal(points, [[-122.26, 37.8], [-73.89, 40.9]])
+
+
+@pytest.mark.parametrize("media_type", _TABLE_MEDIA_TYPES)
+@pytest.mark.parametrize(
+    "table",
+    [
+        pa.table({"lng": [-122.26, None], "lat": [37.8, 40.9]}),
+        pa.table({"lng": [-122.26]}),
+        pa.table({"lng": ["a"], "lat": ["b"]}),
+    ],
+)
+def test_parse_points_table_invalid(media_type: str, table: pa.Table) -> None:
+    with pytest.raises(InvalidPointsError):
+        parse_points(_to_bytes(table, media_type), media_type)
+
+
+@pytest.mark.parametrize("media_type", _TABLE_MEDIA_TYPES)
+def test_parse_geometries_table(media_type: str) -> None:
+    geoms = [shapely.Point(-122.26, 37.8), shapely.box(0, 0, 1, 1)]
+    table = pa.concat_tables(
+        [pa.table({"geometry": [shapely.to_wkb(geom)]}) for geom in geoms]
+    )
+    parsed = parse_geometries(_to_bytes(table, media_type), media_type)
+    assert list(parsed) == geoms
+
+
+@pytest.mark.parametrize("media_type", _TABLE_MEDIA_TYPES)
+@pytest.mark.parametrize(
+    "table",
+    [
+        pa.table({"geometry": pa.array([None], type=pa.binary())}),
+        pa.table({"geometry": [b"not wkb"]}),
+        pa.table({"geometry": [1]}),
+        pa.table({"geom": [shapely.to_wkb(shapely.Point(0, 0))]}),
+    ],
+)
+def test_parse_geometries_table_invalid(media_type: str, table: pa.Table) -> None:
+    with pytest.raises(InvalidGeometriesError):
+        parse_geometries(_to_bytes(table, media_type), media_type)
+
+
+def test_parse_geometries_table_corrupt() -> None:
+    with pytest.raises(InvalidGeometriesError):
+        parse_geometries(b"not arrow", "application/vnd.apache.arrow.stream")
+
+
+@pytest.mark.parametrize("operation", list(BatchOperation))
+def test_shapes_related_to_geoms_stmt(operation: BatchOperation) -> None:
+    sql = _shapes_related_to_geoms_stmt(operation).text
+    assert "CROSS JOIN LATERAL" in sql
+    assert ("<->" in sql) == (operation == BatchOperation.nearest)
+    assert (":distance" in sql) == (operation == BatchOperation.dwithin)
+    assert (":num_candidates" in sql) == (operation == BatchOperation.nearest)
+    assert ("ST_Translate" in sql) == (operation == BatchOperation.dwithin)
+    if operation not in (BatchOperation.dwithin, BatchOperation.nearest):
+        assert f"ST_{operation.value.title()}(shapes.geom, inputs.geom)" in sql
+
+
+@pytest.fixture(scope="function")
+def conn(engine) -> Iterator[Connection]:
+    conn = engine.connect()
+    trans = conn.begin()
+    try:
+        insert_test_users_and_orgs(conn)
+        yield conn
+    finally:
+        trans.rollback()
+        conn.close()
+
+
+def _box(min_x: float, min_y: float, max_x: float, max_y: float) -> Polygon:
+    return Polygon(
+        type="Polygon",
+        coordinates=[
+            [
+                (min_x, min_y),
+                (max_x, min_y),
+                (max_x, max_y),
+                (min_x, max_y),
+                (min_x, min_y),
+            ]
+        ],
+    )
+
+
+@pytest.fixture(scope="function")
+def shapes(conn: Connection) -> Dict[str, str]:
+    """Create shapes and return their IDs by name.
+
+    Alice's organization has ``a`` in the default namespace and ``b`` in another one,
+    and ``east`` and ``north`` near 60°N. Carlos's organization has ``c``, which is
+    the same square as ``a``.
+
+    """
+    alice_id, alice_org_id = get_alice_ids(conn)
+    carlos_id = get_user_by_email(conn, "carlos@example.net").id
+    carlos_org_id = get_active_organization(conn, carlos_id).id
+    namespace = create_namespace(
+        conn, "Other namespace", user_id=alice_id, organization_id=alice_org_id
+    )
+    specs = {
+        "a": (alice_id, alice_org_id, None, _box(0, 0, 1, 1)),
+        "b": (alice_id, alice_org_id, namespace.id, _box(2, 0, 3, 1)),
+        # 0.015° of longitude are ~835 m at 60°N, less than the ~1112 m of 0.01° of
+        # latitude, though they are more degrees
+        "east": (alice_id, alice_org_id, None, _box(0.015, 59.9995, 0.016, 60.0005)),
+        "north": (alice_id, alice_org_id, None, _box(-0.0005, 60.01, 0.0005, 60.011)),
+        "c": (carlos_id, carlos_org_id, None, _box(0, 0, 1, 1)),
+    }
+    ids = {
+        name: str(
+            create_shape(
+                conn,
+                geom=geom,
+                name=name,
+                user_id=user_id,
+                organization_id=org_id,
+                namespace_id=namespace_id,
+            ).uuid
+        )
+        for name, (user_id, org_id, namespace_id, geom) in specs.items()
+    }
+    ids["namespace_id"] = str(namespace.id)
+    setup_app_user(conn, alice_id)
+    return ids
+
+
+def _matches(
+    batches: Iterator[List[Tuple[int, str, Optional[float]]]]
+) -> List[Tuple[int, str]]:
+    return sorted((idx, str(uuid)) for batch in batches for idx, uuid, _ in batch)
+
+
+def test_stream_shapes_containing_points(
+    conn: Connection, shapes: Dict[str, str]
+) -> None:
+    points = np.array([[0.5, 0.5], [2.5, 0.5], [10, 10]])
+    matches = _matches(stream_shapes_containing_points(conn, points, batch_size=1))
+    # Shape c of the other organization is not visible
+    assert matches == [(0, shapes["a"]), (1, shapes["b"])]
+
+
+def test_stream_shapes_namespaces(conn: Connection, shapes: Dict[str, str]) -> None:
+    points = np.array([[0.5, 0.5], [2.5, 0.5]])
+    batches = stream_shapes_containing_points(
+        conn, points, namespace_ids=[shapes["namespace_id"]]  # type: ignore
+    )
+    assert _matches(batches) == [(1, shapes["b"])]
+
+
+def test_stream_shapes_other_organization(
+    conn: Connection, shapes: Dict[str, str]
+) -> None:
+    setup_app_user(conn, get_user_by_email(conn, "carlos@example.net").id)
+    points = np.array([[0.5, 0.5], [2.5, 0.5]])
+    assert _matches(stream_shapes_containing_points(conn, points)) == [(0, shapes["c"])]
+
+
+def test_stream_shapes_intersecting(conn: Connection, shapes: Dict[str, str]) -> None:
+    geoms = np.array(
+        [shapely.LineString([(0.5, 0.5), (2.5, 0.5)]), shapely.Point(10, 10)]
+    )
+    batches = stream_shapes_related_to_geoms(conn, BatchOperation.intersects, geoms)
+    assert _matches(batches) == sorted([(0, shapes["a"]), (0, shapes["b"])])
+
+
+def test_stream_shapes_dwithin(conn: Connection, shapes: Dict[str, str]) -> None:
+    # ~111 m east of a
+    geoms = np.array([shapely.Point(1.001, 0.5)])
+    batches = list(
+        stream_shapes_related_to_geoms(conn, BatchOperation.dwithin, geoms, distance=200)
+    )
+    assert _matches(iter(batches)) == [(0, shapes["a"])]
+    ((_, _, distance),) = batches[0]
+    assert distance == pytest.approx(111.3, abs=1)
+    batches = stream_shapes_related_to_geoms(
+        conn, BatchOperation.dwithin, geoms, distance=50
+    )
+    assert not _matches(batches)
+
+
+def test_stream_shapes_nearest(conn: Connection, shapes: Dict[str, str]) -> None:
+    geoms = np.array([shapely.Point(0, 60), shapely.Point(0.5, 0.5)])
+    batches = stream_shapes_related_to_geoms(conn, BatchOperation.nearest, geoms, limit=2)
+    matches = [match for batch in batches for match in batch]
+    first = [(str(uuid), distance) for idx, uuid, distance in matches if idx == 0]
+    # Ranked by meters, not by degrees
+    assert [uuid for uuid, _ in first] == [shapes["east"], shapes["north"]]
+    assert first[0][1] == pytest.approx(835, abs=10)
+    assert first[1][1] == pytest.approx(1112, abs=10)
+    second = [(str(uuid), distance) for idx, uuid, distance in matches if idx == 1]
+    assert second[0] == (shapes["a"], 0)
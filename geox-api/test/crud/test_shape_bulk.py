@@ -0,0 +1,41 @@
+"""Test bulk ingestion helpers."""
+import csv
+import io
+from uuid import uuid4
+
+import shapely
+
+from app.crud.shape_bulk import _CsvReader, parse_shapes
+
+
+def test_csv_reader() -> None:
+    rows = [[i, f'name, "{i}"', None, '{"a": "b\\nc"}'] for i in range(100)]
+    reader = _CsvReader(rows)
+    chunks = []
+    while chunk := reader.read(64):
+        chunks.append(chunk)
+    assert len(chunks) > 1
+    actual = list(csv.reader(io.StringIO("".join(chunks))))
+    assert actual == [[str(i), name, "", props] for i, name, _, props in rows]
+
+
+def test_parse_shapes() -> None:
+    namespace_id = uuid4()
+    other_namespace_id = uuid4()
+    point = {"type": "Point", "coordinates": [-122.26, 37.80]}
+    data = [
+        {"name": "a", "geometry": point, "namespace": str(other_namespace_id)},
+        {"type": "Feature", "geometry": point, "properties": {"name": "b", "x": 1}},
+        {"geojson": {"type": "Feature", "geometry": point, "properties": {}}},
+        None,
+        {"geometry": {"type": "Point", "coordinates": [1]}},
+        {"geometry": point, "properties": []},
+        {"geometry": point, "namespace": "not-a-uuid"},
+    ]
+    rows, failures = parse_shapes(data, namespace_id)
+    assert failures == [3, 4, 5, 6]
+    assert [row[:2] for row in rows] == [[0, "a"], [1, "b"], [2, None]]
+    assert [row[3] for row in rows] == [other_namespace_id, namespace_id, namespace_id]
+    for row in rows:
+        assert row[4].startswith("\\x")
+        assert shapely.from_wkb(row[4][2:]).equals(shapely.geometry.shape(point))
@@ -0,0 +1,123 @@
+"""Test the export of shapes as GeoParquet."""
+import datetime
+import io
+import json
+from types import SimpleNamespace
+from typing import Any, Dict, Optional
+
+import geopandas as gpd
+import pyarrow.parquet as pq
+import shapely
+
+from app.crud.shape_export import (
+    _EXPORT_SHAPES_STMTS,
+    EXPORT_SCHEMA,
+    ExportType,
+    new_export_id,
+    next_export,
+    rows_to_batch,
+    write_partitioned_geoparquet,
+)
+
+_NOW = datetime.datetime(2022, 11, 29, 13, 29, 1, 123456)
+
+
+def _row(idx: int, export_id: str, namespace_id: str = "ns1"):
+    return (
+        f"00000000-0000-0000-0000-{idx:012d}",
+        f"shape {idx}",
+        memoryview(shapely.to_wkb(shapely.Point(-122.26, 37.8 + idx / 100))),
+        json.dumps({"value": idx}),
+        _NOW,
+        _NOW,
+        None,
+        _NOW,
+        "00000000-0000-0000-0000-000000000001",
+        namespace_id,
+        "default",
+        "default",
+        export_id,
+        "snapshot",
+    )
+
+
+def test_new_export_id() -> None:
+    export_id = new_export_id(_NOW)
+    assert export_id.startswith("2022/11/29/13/29/01/123456/")
+    assert export_id != new_export_id(_NOW)
+
+
+class _File(io.BytesIO):
+    """File keeping its content once closed."""
+
+    def __init__(self, files: Dict[str, bytes], path: str) -> None:
+        super().__init__()
+        self.files = files
+        self.path = path
+
+    def close(self) -> None:
+        self.files[self.path] = self.getvalue()
+        super().close()
+
+
+def test_write_partitioned_geoparquet() -> None:
+    export_id = new_export_id(_NOW)
+    batches = [
+        rows_to_batch([_row(i, export_id, ns) for i in range(j, j + 2)])
+        for j, ns in [(0, "ns1"), (2, "ns1"), (4, "ns2")]
+    ]
+    files: Dict[str, bytes] = {}
+    written = write_partitioned_geoparquet(
+        lambda path: _File(files, path), iter([*batches, rows_to_batch([])])
+    )
+    assert [(x["path"], x["num_rows"]) for x in written] == [
+        ("namespace_id=ns1/part-00000.parquet", 4),
+        ("namespace_id=ns2/part-00000.parquet", 2),
+    ]
+    assert [x["size"] for x in written] == [len(files[x["path"]]) for x in written]
+    parquet_file = pq.ParquetFile(io.BytesIO(files[written[0]["path"]]))
+    # A row group per non-empty batch
+    assert parquet_file.metadata.num_row_groups == 2
+    assert parquet_file.schema_arrow.equals(EXPORT_SCHEMA, check_metadata=False)
+    assert (
+        json.loads(parquet_file.schema_arrow.metadata[b"geo"])["primary_column"] == "geom"
+    )
+    df = gpd.read_parquet(io.BytesIO(files[written[0]["path"]]))
+    assert df.geometry.name == "geom"
+    assert list(df["geom"].y.round(2)) == [37.8, 37.81, 37.82, 37.83]
+    assert set(df["export_id"]) == {export_id}
+
+
+def test_write_partitioned_geoparquet_max_file_size() -> None:
+    batches = [rows_to_batch([_row(i, "export")]) for i in range(3)]
+    files: Dict[str, bytes] = {}
+    written = write_partitioned_geoparquet(
+        lambda path: _File(files, path), batches, max_file_size=1
+    )
+    assert [x["path"] for x in written] == [
+        f"namespace_id=ns1/part-{i:05d}.parquet" for i in range(3)
+    ]
+
+
+def _state(snapshot_export_id: Optional[str] = "export", num_deltas: int = 0) -> Any:
+    return SimpleNamespace(
+        exported_until=_NOW, snapshot_export_id=snapshot_export_id, num_deltas=num_deltas
+    )
+
+
+def test_next_export() -> None:
+    assert next_export(None, 24) == (ExportType.snapshot, None)
+    assert next_export(_state(None), 24) == (ExportType.snapshot, _NOW)
+    assert next_export(_state(num_deltas=23), 24) == (ExportType.delta, _NOW)
+    assert next_export(_state(num_deltas=24), 24) == (ExportType.snapshot, _NOW)
+    assert next_export(_state(), 24, snapshot=True) == (ExportType.snapshot, _NOW)
+    assert next_export(_state(), 0) == (ExportType.snapshot, _NOW)
+
+
+def test_export_shapes_stmts() -> None:
+    snapshot = _EXPORT_SHAPES_STMTS[ExportType.snapshot].text
+    delta = _EXPORT_SHAPES_STMTS[ExportType.delta].text
+    assert "s.deleted_at IS NULL OR s.updated_at > " in snapshot
+    assert "'snapshot' AS export_type" in snapshot
+    assert "s.deleted_at IS NULL" not in delta.split("WHERE")[-1].split("ON TRUE")[-1]
+    assert "'delta' AS export_type" in delta
@@ -0,0 +1,140 @@
+# pylint: disable=redefined-outer-name
+"""Check that the planner uses the indexes of shapes for the queries of the app."""
+import json
+from typing import Any, Dict, Iterator, Set
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from app.crud.shape import (
+    _SHAPES_CONTAINING_POINT_STMT,
+    GeometryOperation,
+    _select_shapes_query,
+    _shapes_related_to_geom_stmt,
+)
+from app.db.maintenance import SHAPES_CLUSTER_INDEX
+from app.schemas import ViewportBounds
+from test.crud.common import get_alice_ids, insert_test_users_and_orgs, setup_app_user
+
+LIVE_SHAPES_INDEX = "ix_shapes_organization_id_geom_live"
+
+
+@pytest.fixture(scope="function")
+def conn(engine) -> Iterator[Connection]:
+    """Connection with shapes of all organizations spread over the world."""
+    conn = engine.connect()
+    trans = conn.begin()
+    try:
+        insert_test_users_and_orgs(conn)
+        conn.execute(
+            text(
+                """
+                INSERT INTO shapes (
+                    name, geom, organization_id, namespace_id,
+                    created_by_user_id, updated_by_user_id, deleted_at
+                )
+                SELECT
+                    'shape ' || i,
+                    ST_SetSRID(
+                        ST_MakePoint(-180 + random() * 360, -80 + random() * 160), 4326
+                    ),
+                    n.organization_id,
+                    n.id,
+                    m.user_id,
+                    m.user_id,
+                    -- some deleted shapes
+                    CASE WHEN i % 10 = 0 THEN now() END
+                FROM namespaces AS n
+                INNER JOIN organization_members AS m
+                    ON m.organization_id = n.organization_id
+                CROSS JOIN generate_series(1, 2000) AS i
+                WHERE n.is_default
+                """
+            )
+        )
+        conn.execute(text("ANALYZE shapes"))
+        # The tables are too small for index scans to be cheaper than sequential scans
+        conn.execute(text("SET LOCAL enable_seqscan = off"))
+        yield conn
+    finally:
+        trans.rollback()
+        conn.close()
+
+
+def _index_names(plan: Dict[str, Any]) -> Set[str]:
+    names = {plan["Index Name"]} if "Index Name" in plan else set()
+    for subplan in plan.get("Plans", []):
+        names |= _index_names(subplan)
+    return names
+
+
+def explain(conn: Connection, stmt: Any, params: Dict[str, Any]) -> Set[str]:
+    """Return the indexes used by the plan of a statement."""
+    if not isinstance(stmt, str):
+        compiled = stmt.compile(
+            dialect=conn.dialect, compile_kwargs={"render_postcompile": True}
+        )
+        stmt = str(compiled)
+        # bind processors are not applied: use the values of enums
+        params = {k: getattr(v, "value", v) for k, v in compiled.params.items()}
+        res = conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {stmt}", params)
+    else:
+        res = conn.execute(text(f"EXPLAIN (FORMAT JSON) {stmt}"), params)
+    plan = res.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return _index_names(plan[0]["Plan"])
+
+
+def test_select_shapes_bbox(conn: Connection) -> None:
+    _, org_id = get_alice_ids(conn)
+    bbox = ViewportBounds(min_x=-122.5, min_y=37.7, max_x=-122.3, max_y=37.9)
+    # UUIDs are passed as strings since the bind processors are not used
+    stmt = _select_shapes_query(organization_id=str(org_id), bbox=bbox)
+    assert LIVE_SHAPES_INDEX in explain(conn, stmt, {})
+
+
+def test_tile_query(conn: Connection) -> None:
+    _, org_id = get_alice_ids(conn)
+    # Conditions on shapes in generate_shape_tile(), which cannot be explained
+    stmt = """
+        SELECT uuid
+        FROM shapes
+        WHERE organization_id = :organization_id
+            AND deleted_at IS NULL
+            AND geom && ST_Transform(ST_TileEnvelope(12, 655, 1583), 4326)
+    """
+    assert LIVE_SHAPES_INDEX in explain(conn, stmt, {"organization_id": org_id})
+
+
+def test_shapes_containing_point(conn: Connection) -> None:
+    user_id, _ = get_alice_ids(conn)
+    setup_app_user(conn, user_id)
+    stmt = str(_SHAPES_CONTAINING_POINT_STMT)
+    indexes = explain(conn, stmt, {"lat": 37.8, "lng": -122.26})
+    assert LIVE_SHAPES_INDEX in indexes
+
+
+@pytest.mark.parametrize("operation", list(GeometryOperation))
+def test_shapes_related_to_geom(conn: Connection, operation: GeometryOperation) -> None:
+    user_id, _ = get_alice_ids(conn)
+    setup_app_user(conn, user_id)
+    stmt = str(_shapes_related_to_geom_stmt(operation))
+    geom = {"type": "Point", "coordinates": [-122.26, 37.8]}
+    indexes = explain(conn, stmt, {"geom": json.dumps(geom)})
+    assert LIVE_SHAPES_INDEX in indexes
+
+
+def test_cluster_index(conn: Connection) -> None:
+    res = conn.execute(
+        text(
+            """
+            SELECT indisclustered
+            FROM pg_index
+            WHERE indexrelid = CAST(:index AS regclass)
+            """
+        ),
+        {"index": SHAPES_CLUSTER_INDEX},
+    )
+    assert res.scalar()
@@ -0,0 +1,60 @@
+import asyncio
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from app.core.config import EngineOptions, Settings, TilerPoolOptions
+from app.db import pool
+
+
+def test_max_connections():
+    settings = Settings(
+        engine_opts=EngineOptions(pool_size=5, max_overflow=10),
+        tiler_pool_options=TilerPoolOptions(db_max_conn_size=4),
+    )
+    assert pool.max_connections(settings) == 19
+
+
+def test_timed_queue_pool(monkeypatch):
+    reported = []
+    monkeypatch.setattr(
+        pool, "_report_pool", lambda *args: reported.append(args)  # type: ignore
+    )
+    engine = create_engine("sqlite://", poolclass=pool.TimedQueuePool, future=True)
+    with engine.connect():
+        with engine.connect():
+            pass
+    assert [(name, in_use) for name, _, in_use in reported] == [("app", 1), ("app", 2)]
+    assert all(wait >= 0 for _, wait, _ in reported)
+
+
+def test_threadpool_size():
+    settings = Settings(engine_opts=EngineOptions(pool_size=10, max_overflow=20))
+    assert pool.threadpool_size(settings) == 60
+    settings = Settings(engine_opts=EngineOptions(pool_size=5, max_overflow=0))
+    assert pool.threadpool_size(settings) == pool.DEFAULT_THREADPOOL_SIZE
+
+
+def test_set_threadpool_size():
+    settings = Settings(engine_opts=EngineOptions(pool_size=30, max_overflow=20))
+
+    async def total_tokens() -> float:
+        pool.set_threadpool_size(settings)
+        return pool.anyio.to_thread.current_default_thread_limiter().total_tokens
+
+    assert asyncio.run(total_tokens()) == 100
+
+
+def test_pool_timeout_handler():
+    app = FastAPI()
+    app.add_exception_handler(PoolTimeoutError, pool.pool_timeout_handler)
+
+    @app.get("/")
+    def route():
+        raise PoolTimeoutError("QueuePool limit reached")
+
+    response = TestClient(app).get("/")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
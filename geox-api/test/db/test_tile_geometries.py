@@ -0,0 +1,55 @@
+# pylint: disable=redefined-outer-name
+"""Test the Web Mercator geometries of shapes used by tiles."""
+from typing import Iterator
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from test.crud.common import get_alice_ids, insert_test_users_and_orgs
+
+# Bounds of Web Mercator coordinates in meters
+_MAX_Y = 20037508.35
+
+
+@pytest.fixture(scope="function")
+def conn(engine) -> Iterator[Connection]:
+    conn = engine.connect()
+    trans = conn.begin()
+    try:
+        insert_test_users_and_orgs(conn)
+        yield conn
+    finally:
+        trans.rollback()
+        conn.close()
+
+
+def test_polar_geometries(conn: Connection) -> None:
+    user_id, org_id = get_alice_ids(conn)
+    row = conn.execute(
+        text(
+            """
+            INSERT INTO shapes (
+                name, geom, organization_id, namespace_id,
+                created_by_user_id, updated_by_user_id
+            )
+            SELECT
+                'world',
+                ST_MakeEnvelope(-180, -90, 180, 90, 4326),
+                n.organization_id,
+                n.id,
+                :user_id,
+                :user_id
+            FROM namespaces AS n
+            WHERE n.organization_id = :org_id AND n.is_default
+            RETURNING
+                ST_YMin(geom_3857) AS ymin,
+                ST_YMax(geom_3857) AS ymax,
+                geom_3857_z5 IS NOT NULL AS has_z5
+            """
+        ),
+        {"org_id": org_id, "user_id": user_id},
+    ).one()
+    assert row.ymin >= -_MAX_Y - 1
+    assert row.ymax <= _MAX_Y + 1
+    assert row.has_z5
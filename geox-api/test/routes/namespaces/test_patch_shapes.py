@@ -0,0 +1,45 @@
+"""Test PATCH /geofencer/namespaces/{namespace_id}/relationships/shapes"""
+import pyarrow as pa
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+from app.crud.shape_export import (
+    EXPORT_SCHEMA,
+    ExportType,
+    get_export_time,
+    new_export_id,
+    stream_export_batches,
+)
+
+from .conftest import ExampleDbAbc
+
+
+def test_delete_shapes(client: TestClient, db: ExampleDbAbc) -> None:
+    conn = db.conn
+    namespace_id = db["example.com"].namespaces["new-namespace"].id
+    shape_ids = {
+        str(x)
+        for x in conn.execute(
+            text("SELECT uuid FROM shapes WHERE namespace_id = :namespace_id"),
+            {"namespace_id": namespace_id},
+        ).scalars()
+    }
+    assert shape_ids
+    since = conn.execute(text("SELECT max(updated_at) FROM shapes")).scalar()
+    response = client.patch(
+        f"/geofencer/namespaces/{namespace_id}/relationships/shapes", json={"data": []}
+    )
+    assert response.status_code == 200
+    # The next delta export has a tombstone of each deleted shape
+    exported_at = get_export_time(conn)
+    batches = stream_export_batches(
+        conn,
+        db["example.com"].id,
+        exported_at,
+        new_export_id(exported_at),
+        export_type=ExportType.delta,
+        since=since,
+    )
+    rows = pa.Table.from_batches(list(batches), schema=EXPORT_SCHEMA).to_pylist()
+    assert {row["uuid"] for row in rows} == shape_ids
+    assert all(row["deleted_at"] is not None and row["geom"] is None for row in rows)
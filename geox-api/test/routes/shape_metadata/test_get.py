@@ -113,3 +113,24 @@ def test_read_shapes_by_bbox(client: TestClient, db: ExampleDbAbc) -> None:
             "short-bulldozer",
         },
     )
+
+
+def test_read_shapes_cursor(client: TestClient, db: ExampleDbAbc) -> None:
+    """Paging with the cursor returns every shape once, in order."""
+    shape_ids = []
+    params = {"limit": 2}
+    for _ in range(5):
+        response = client.get("/geofencer/shape-metadata", params=params)
+        assert response.status_code == 200
+        shape_ids.extend(shp["uuid"] for shp in response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+        params["cursor"] = cursor
+    assert len(shape_ids) == 5
+    assert shape_ids == sorted(set(shape_ids))
+
+
+def test_read_shapes_invalid_cursor(client: TestClient, db: ExampleDbAbc) -> None:
+    response = client.get("/geofencer/shape-metadata", params={"cursor": "abc"})
+    assert response.status_code == 422
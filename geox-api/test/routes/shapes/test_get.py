@@ -1,6 +1,7 @@
 # pylint: disable=unused-argument
 """Test PATCH /geofencer/shapes/{shape_id}."""
-from typing import Set
+import json
+from typing import Dict, Set
 
 import pytest
 from fastapi.testclient import TestClient
@@ -109,3 +110,78 @@ def test_read_shapes_by_bbox(client: TestClient, db: ExampleDbAbc) -> None:
             "short-bulldozer",
         },
     )
+
+
+ALL_SHAPE_NAMES = {
+    "pink-objective",
+    "convoluted-sledder",
+    "isobaric-concentration",
+    "short-bulldozer",
+    "thundering-use",
+}
+
+
+@pytest.mark.parametrize(
+    "params,headers",
+    [
+        [{"format": "ndjson"}, {}],
+        [{}, {"Accept": "application/x-ndjson"}],
+    ],
+)
+def test_read_shapes_ndjson(
+    client: TestClient, db: ExampleDbAbc, params: Dict[str, str], headers: Dict[str, str]
+) -> None:
+    response = client.get("/geofencer/shapes", params=params, headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    features = [json.loads(line) for line in response.text.splitlines()]
+    assert {x["properties"]["name"] for x in features} == ALL_SHAPE_NAMES
+    assert all(x["type"] == "Feature" for x in features)
+    assert all(x["geometry"]["type"] == "Polygon" for x in features)
+
+
+def test_read_shapes_geojson_stream(client: TestClient, db: ExampleDbAbc) -> None:
+    response = client.get("/geofencer/shapes", params={"format": "geojson-stream"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/geo+json"
+    data = response.json()
+    assert data["type"] == "FeatureCollection"
+    assert {x["properties"]["name"] for x in data["features"]} == ALL_SHAPE_NAMES
+
+
+def test_read_shapes_geojson_stream_empty(client: TestClient, db: ExampleDbAbc) -> None:
+    namespace_id = get_unused_namespace_id(db.conn)
+    response = client.get(
+        "/geofencer/shapes",
+        params={"format": "geojson-stream", "namespace": str(namespace_id)},
+    )
+    assert response.json() == {"type": "FeatureCollection", "features": []}
+
+
+def test_read_shapes_etag_depends_on_format(client: TestClient, db: ExampleDbAbc) -> None:
+    response = client.get("/geofencer/shapes")
+    assert response.headers["Vary"] == "Accept"
+    etag = response.headers.get("ETag")
+    if etag is None:
+        pytest.skip("Edit versions are unavailable")
+    response = client.get("/geofencer/shapes", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["Vary"] == "Accept"
+    response = client.get(
+        "/geofencer/shapes",
+        headers={"If-None-Match": etag, "Accept": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.headers["Vary"] == "Accept"
+
+
+def test_read_shapes_cursor(client: TestClient, db: ExampleDbAbc) -> None:
+    response = client.get("/geofencer/shapes", params={"limit": 3})
+    first_page = [shp["uuid"] for shp in response.json()]
+    cursor = response.headers["X-Next-Cursor"]
+    response = client.get("/geofencer/shapes", params={"limit": 3, "cursor": cursor})
+    second_page = [shp["uuid"] for shp in response.json()]
+    assert "X-Next-Cursor" not in response.headers
+    assert len(first_page + second_page) == 5
+    assert first_page + second_page == sorted(first_page + second_page)
@@ -0,0 +1,104 @@
+# pylint: disable=redefined-outer-name
+"""Test POST /geofencer/shapes/op/contains/batch and /geofencer/shapes/op/batch/{operation}"""
+import json
+from typing import Any, Dict, List
+
+from fastapi.testclient import TestClient
+from pytest_fastapi_deps import fastapi_dep  # pylint: disable=unused-import
+
+from app.core.config import Settings, get_settings
+from app.main import app
+
+from .conftest import ExampleDbAbc
+
+# In San Francisco, which is in alice's new-namespace
+_SF = [-122.45, 37.75]
+
+
+def _get_settings_override() -> Settings:
+    return get_settings().copy(update={"batch_query_max_size": 1})
+
+
+def _lines(text: str) -> List[Dict[str, Any]]:
+    return [json.loads(line) for line in text.splitlines()]
+
+
+def test_contains_batch(client: TestClient, db: ExampleDbAbc) -> None:
+    response = client.post("/geofencer/shapes/op/contains/batch", json=[_SF, [0, 0]])
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    sf_uuid = str(db.shapes["isobaric-concentration"].uuid)
+    assert _lines(response.text) == [{"index": 0, "uuid": sf_uuid}]
+
+
+def test_contains_batch_namespace(client: TestClient, db: ExampleDbAbc) -> None:
+    response = client.post(
+        "/geofencer/shapes/op/contains/batch",
+        json=[_SF],
+        params={"namespace_ids": [str(db["example.com"].default_namespace.id)]},
+    )
+    assert response.status_code == 200
+    assert not _lines(response.text)
+
+
+def test_contains_batch_invalid(client: TestClient, db: ExampleDbAbc) -> None:
+    response = client.post(
+        "/geofencer/shapes/op/contains/batch",
+        data=b"not json",
+        headers={"Content-Type": "application/json"},
+    )
+    assert response.status_code == 422
+
+
+def test_contains_batch_too_large(
+    client: TestClient, db: ExampleDbAbc, fastapi_dep
+) -> None:
+    with fastapi_dep(app).override({get_settings: _get_settings_override}):
+        response = client.post("/geofencer/shapes/op/contains/batch", json=[_SF, _SF])
+    assert response.status_code == 413
+
+
+def test_batch_intersects(client: TestClient, db: ExampleDbAbc) -> None:
+    geoms = [
+        {"type": "Point", "coordinates": _SF},
+        {"type": "Point", "coordinates": [0, 0]},
+    ]
+    response = client.post("/geofencer/shapes/op/batch/intersects", json=geoms)
+    assert response.status_code == 200
+    sf_uuid = str(db.shapes["isobaric-concentration"].uuid)
+    assert _lines(response.text) == [{"index": 0, "uuid": sf_uuid}]
+
+
+def test_batch_nearest(client: TestClient, db: ExampleDbAbc) -> None:
+    geoms = [{"type": "Point", "coordinates": _SF}]
+    response = client.post("/geofencer/shapes/op/batch/nearest", json=geoms)
+    assert response.status_code == 200
+    sf_uuid = str(db.shapes["isobaric-concentration"].uuid)
+    assert _lines(response.text) == [{"index": 0, "uuid": sf_uuid, "distance": 0.0}]
+
+
+def test_batch_dwithin_no_distance(client: TestClient, db: ExampleDbAbc) -> None:
+    geoms = [{"type": "Point", "coordinates": _SF}]
+    response = client.post("/geofencer/shapes/op/batch/dwithin", json=geoms)
+    assert response.status_code == 422
+
+
+def test_batch_invalid(client: TestClient, db: ExampleDbAbc) -> None:
+    geoms = [{"type": "Point", "coordinates": [0, 91]}]
+    response = client.post("/geofencer/shapes/op/batch/intersects", json=geoms)
+    assert response.status_code == 422
+
+
+def test_batch_too_large(client: TestClient, db: ExampleDbAbc, fastapi_dep) -> None:
+    geoms = [{"type": "Point", "coordinates": _SF}] * 2
+    with fastapi_dep(app).override({get_settings: _get_settings_override}):
+        response = client.post("/geofencer/shapes/op/batch/intersects", json=geoms)
+    assert response.status_code == 413
+
+
+def test_batch_body_too_large(client: TestClient, db: ExampleDbAbc, fastapi_dep) -> None:
+    geoms = [{"type": "Point", "coordinates": _SF}]
+    settings = get_settings().copy(update={"batch_query_max_bytes": 10})
+    with fastapi_dep(app).override({get_settings: lambda: settings}):
+        response = client.post("/geofencer/shapes/op/batch/intersects", json=geoms)
+    assert response.status_code == 413
@@ -0,0 +1,44 @@
+"""Test FastAPI dependencies."""
+from typing import Iterator
+
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from app.core.config import get_settings
+from app.dependencies import get_request_body
+
+
+@pytest.fixture()
+def client() -> TestClient:
+    app = FastAPI()
+
+    @app.post("/")
+    def post(data: bytes = Depends(get_request_body)) -> int:
+        return len(data)
+
+    settings = get_settings().copy(update={"batch_query_max_bytes": 10})
+    app.dependency_overrides[get_settings] = lambda: settings
+    return TestClient(app)
+
+
+def _chunks(size: int) -> Iterator[bytes]:
+    for _ in range(size):
+        yield b"x"
+
+
+def test_get_request_body(client: TestClient) -> None:
+    response = client.post("/", data=b"x" * 10)
+    assert response.status_code == 200
+    assert response.json() == 10
+
+
+def test_get_request_body_content_length(client: TestClient) -> None:
+    response = client.post("/", data=b"x" * 11)
+    assert response.status_code == 413
+
+
+def test_get_request_body_chunked(client: TestClient) -> None:
+    # Without Content-Length, the body is rejected while it is read
+    assert client.post("/", data=_chunks(10)).json() == 10
+    assert client.post("/", data=_chunks(11)).status_code == 413
@@ -0,0 +1,118 @@
+"""Test Celery worker helpers."""
+import io
+import json
+from types import SimpleNamespace
+from typing import Any, List, Optional
+from uuid import uuid4
+
+import pytest
+
+from app import worker
+from app.core.cache import MemoryCache
+from app.tiler.cache import MemoryTileIndex, TileCache, tile_variant, tiles_in_bbox
+from app.worker import add_failed_ranges, import_path, read_shapes_file
+
+_FEATURE = {
+    "type": "Feature",
+    "geometry": {"type": "Point", "coordinates": [-122.26, 37.80]},
+    "properties": {"name": "lake-merritt"},
+}
+
+
+def test_read_shapes_file_feature_collection() -> None:
+    data = {
+        "type": "FeatureCollection",
+        "features": [_FEATURE, {"type": "Feature", "geometry": 1}],
+    }
+    f = io.BytesIO(json.dumps(data).encode())
+    shapes = list(read_shapes_file(f, "shapes.geojson"))
+    assert shapes == data["features"]
+
+
+@pytest.mark.parametrize(
+    "data,expected",
+    [
+        ([_FEATURE, {"geojson": _FEATURE}], [_FEATURE, {"geojson": _FEATURE}]),
+        ({"geojson": _FEATURE}, [{"geojson": _FEATURE}]),
+        ({"type": "FeatureCollection", "features": []}, []),
+    ],
+)
+def test_read_shapes_file_json(data: Any, expected: List[Any]) -> None:
+    f = io.BytesIO(json.dumps(data).encode())
+    assert list(read_shapes_file(f, "shapes.json")) == expected
+
+
+def test_read_shapes_file_streams() -> None:
+    class _File(io.BytesIO):
+        max_read = 0
+
+        def read(self, size: Optional[int] = -1) -> bytes:
+            data = super().read(size)
+            self.max_read = max(self.max_read, len(data))
+            return data
+
+    data = {"type": "FeatureCollection", "features": [_FEATURE] * 10000}
+    f = _File(json.dumps(data).encode())
+    shapes = read_shapes_file(f, "shapes.geojson")
+    assert next(shapes) == _FEATURE
+    assert sum(1 for _ in shapes) == 9999
+    assert f.max_read < len(f.getvalue()) / 10
+
+
+def test_read_shapes_file_ndjson() -> None:
+    lines = [json.dumps(_FEATURE), "not json", "", json.dumps({"geojson": _FEATURE})]
+    f = io.BytesIO("\n".join(lines).encode())
+    shapes = list(read_shapes_file(f, "shapes.ndjson"))
+    assert shapes == [_FEATURE, None, {"geojson": _FEATURE}]
+
+
+@pytest.mark.parametrize("key", ["", "/abs.json", "../other-org/data.json"])
+def test_import_path_invalid(key: str) -> None:
+    with pytest.raises(ValueError):
+        import_path("s3://bucket/prefix/", "org", key)
+
+
+def test_add_failed_ranges() -> None:
+    ranges: List[List[int]] = []
+    assert add_failed_ranges(ranges, [3, 1, 2, 7], max_ranges=3)
+    assert add_failed_ranges(ranges, [8, 10], max_ranges=3)
+    assert ranges == [[1, 3], [7, 8], [10, 10]]
+    assert not add_failed_ranges(ranges, [11, 20], max_ranges=3)
+    assert ranges == [[1, 3], [7, 8], [10, 11]]
+
+
+def test_seed_tiles_write_during_batch(monkeypatch) -> None:
+    tile_cache = TileCache(MemoryCache(maxsize=100), MemoryTileIndex(), timeout=0)
+    version = {"value": 0, "num_rendered": 0}
+
+    class _Conn:
+        def __enter__(self) -> "_Conn":
+            return self
+
+        def __exit__(self, *args: Any) -> None:
+            pass
+
+        def execute(self, *args: Any) -> Any:
+            version["num_rendered"] += 1
+            # A shape is written while the 6th tile, in the 2nd batch, is rendered
+            if version["num_rendered"] == 6:
+                version["value"] += 1
+            return SimpleNamespace(scalar=lambda: b"tile")
+
+    bbox = (-180.0, -85.0, 180.0, 85.0)
+    monkeypatch.setattr(worker, "SEED_BATCH_SIZE", 4)
+    monkeypatch.setattr(worker, "get_tile_cache", lambda: tile_cache)
+    monkeypatch.setattr(worker, "query_shapes_extent", lambda *args: bbox)
+    monkeypatch.setattr(
+        worker, "get_postgres_engine", lambda: SimpleNamespace(connect=_Conn)
+    )
+    monkeypatch.setattr(worker, "get_etag", lambda *args: str(version["value"]))
+    organization_id = uuid4()
+    result = worker.seed_tiles(str(organization_id), min_zoom=2, max_zoom=2)
+    assert result == {"tiles_rendered": 12, "tiles_cached": 0, "tiles_dropped": 4}
+    variant = tile_variant("generate_shape_tile")
+    cached = [
+        tile_cache.get(organization_id, None, z, x, y, variant) is not None
+        for z, x, y in tiles_in_bbox(bbox, 2)
+    ]
+    assert cached == [True] * 4 + [False] * 4 + [True] * 8
@@ -0,0 +1,129 @@
+# pylint: disable=redefined-outer-name
+"""Test the MVT tile cache."""
+import uuid
+
+import pytest
+
+from app.core.cache import MemoryCache
+from app.tiler.cache import (
+    MemoryTileIndex,
+    TileCache,
+    bbox_union,
+    tile_bounds,
+    tile_variant,
+    tiles_in_bbox,
+)
+
+# Lake Merritt, Oakland, CA
+LAKE_MERRITT = (-122.269, 37.796, -122.245, 37.812)
+# Van Cortlandt Park, Bronx, NY
+VAN_CORTLANDT = (-73.897, 40.890, -73.886, 40.911)
+
+
+@pytest.fixture()
+def tile_cache() -> TileCache:
+    return TileCache(
+        MemoryCache(maxsize=100),
+        MemoryTileIndex(),
+        timeout=0,
+        max_tiles_per_organization=3,
+    )
+
+
+def test_tile_bounds() -> None:
+    assert tile_bounds(0, 0, 0) == pytest.approx(
+        (-180, -85.0511287798, 180, 85.0511287798)
+    )
+    min_x, min_y, max_x, max_y = tile_bounds(1, 0, 0)
+    assert (min_x, max_x) == (-180, 0)
+    assert min_y == pytest.approx(0)
+
+
+def test_tiles_in_bbox() -> None:
+    assert list(tiles_in_bbox((-180, -90, 180, 90), 0)) == [(0, 0, 0)]
+    assert len(list(tiles_in_bbox((-180, -90, 180, 90), 2))) == 16
+    tiles = list(tiles_in_bbox(LAKE_MERRITT, 14))
+    assert tiles
+    for z, x, y in tiles:
+        min_x, min_y, max_x, max_y = tile_bounds(z, x, y)
+        assert min_x <= LAKE_MERRITT[2] and LAKE_MERRITT[0] <= max_x
+        assert min_y <= LAKE_MERRITT[3] and LAKE_MERRITT[1] <= max_y
+
+
+def test_bbox_union() -> None:
+    assert bbox_union([]) is None
+    assert bbox_union([None, (None, None, None, None)]) is None
+    assert bbox_union([LAKE_MERRITT, None, VAN_CORTLANDT]) == (
+        -122.269,
+        37.796,
+        -73.886,
+        40.911,
+    )
+
+
+def test_get_set(tile_cache: TileCache) -> None:
+    org_id = uuid.uuid4()
+    namespace_id = uuid.uuid4()
+    assert tile_cache.get(org_id, None, 0, 0, 0) is None
+    tile_cache.set(org_id, None, 0, 0, 0, b"tile")
+    assert tile_cache.get(org_id, None, 0, 0, 0) == b"tile"
+    # namespaces and organizations are cached separately
+    assert tile_cache.get(org_id, [namespace_id], 0, 0, 0) is None
+    assert tile_cache.get(uuid.uuid4(), None, 0, 0, 0) is None
+
+
+def test_invalidate_bbox(tile_cache: TileCache) -> None:
+    org_id = uuid.uuid4()
+    # z1 tiles: (0, 0) is north-west, (1, 0) is north-east
+    tile_cache.set(org_id, None, 1, 0, 0, b"west")
+    tile_cache.set(org_id, None, 1, 1, 0, b"east")
+    assert tile_cache.invalidate(org_id, LAKE_MERRITT) == 1
+    assert tile_cache.get(org_id, None, 1, 0, 0) is None
+    assert tile_cache.get(org_id, None, 1, 1, 0) == b"east"
+
+
+def test_invalidate_organization(tile_cache: TileCache) -> None:
+    org_id = uuid.uuid4()
+    other_org_id = uuid.uuid4()
+    tile_cache.set(org_id, None, 1, 0, 0, b"west")
+    tile_cache.set(org_id, None, 1, 1, 0, b"east")
+    tile_cache.set(other_org_id, None, 1, 0, 0, b"west")
+    assert tile_cache.invalidate(org_id) == 2
+    assert tile_cache.get(org_id, None, 1, 1, 0) is None
+    assert tile_cache.get(other_org_id, None, 1, 0, 0) == b"west"
+
+
+def test_max_tiles_per_organization(tile_cache: TileCache) -> None:
+    org_id = uuid.uuid4()
+    for x in range(4):
+        tile_cache.set(org_id, None, 2, x, 0, b"tile")
+    assert tile_cache.get(org_id, None, 2, 0, 0) is None
+    assert tile_cache.get(org_id, None, 2, 3, 0) == b"tile"
+
+
+def test_set_many(tile_cache: TileCache) -> None:
+    org_id = uuid.uuid4()
+    tile_cache.set(org_id, None, 2, 0, 0, b"old")
+    tile_cache.set_many(org_id, None, [(2, x, 1, b"tile") for x in range(3)])
+    # the oldest tile is evicted from the cache along with the index
+    assert tile_cache.get(org_id, None, 2, 0, 0) is None
+    assert tile_cache.index.keys(tile_cache._index_key(org_id)) == [
+        tile_cache._tile_key(org_id, None, 2, x, 1) for x in range(3)
+    ]
+    assert tile_cache.invalidate(org_id) == 3
+    assert tile_cache.invalidate(org_id) == 0
+
+
+def test_variants(tile_cache: TileCache) -> None:
+    org_id = uuid.uuid4()
+    layers = tile_variant("generate_namespace_layers_tile")
+    pruned = tile_variant("generate_namespace_layers_tile", ["name", "color"])
+    assert pruned == tile_variant("generate_namespace_layers_tile", ["color", "name"])
+    assert len({tile_variant("generate_shape_tile"), layers, pruned}) == 3
+    tile_cache.set(org_id, None, 0, 0, 0, b"shapes", tile_variant("generate_shape_tile"))
+    tile_cache.set(org_id, None, 0, 0, 0, b"layers", layers)
+    assert tile_cache.get(org_id, None, 0, 0, 0, layers) == b"layers"
+    assert tile_cache.get(org_id, None, 0, 0, 0, pruned) is None
+    # variants are evicted like other tiles
+    assert tile_cache.invalidate(org_id) == 2
+    assert tile_cache.get(org_id, None, 0, 0, 0, layers) is None